@@ -0,0 +1,50 @@
+"""Benchmark of the CWT backends on typical nanopore read lengths.
+
+Tombo event means of a read are a few thousand to tens of thousands of points,
+raw signals are a few hundred thousand samples.
+
+    python -m thesis.benchmarks.cwt_backends --wavelet cgau5 --lengths 5000 20000 100000
+"""
+import argparse
+import timeit
+
+import numpy as np
+
+from thesis.transforms.wavelet_transform import cwt
+from thesis.utils import constants
+
+
+def parse_arguments() -> argparse.PARSER:
+    parser = argparse.ArgumentParser(description="CWT backend benchmark")
+
+    parser.add_argument('--wavelet', type=str, help='Continuous wavelet', default='mexh')
+    parser.add_argument('--scale', type=int, help='Scale used for cwt', default=129)
+    parser.add_argument('--lengths', type=int, nargs='+', help='Signal lengths',
+                        default=[5000, 20000, 100000, 400000])
+    parser.add_argument('--repeat', type=int, help='Number of timed repetitions', default=3)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    cases = [
+        ("pywt", constants.CWT_BACKEND_PYWT, np.float64),
+        ("fft float64", constants.CWT_BACKEND_FFT, np.float64),
+        ("fft float32", constants.CWT_BACKEND_FFT, np.float32),
+    ]
+
+    for length in args.lengths:
+        signal = np.cumsum(np.random.normal(size=length)) + 100
+        reference = cwt(signal, args.wavelet, args.scale)
+        magnitude = np.max(np.abs(reference))
+
+        for name, backend, dtype in cases:
+            run = lambda: cwt(signal, args.wavelet, args.scale, True, backend, dtype)
+            best = min(timeit.repeat(run, number=1, repeat=args.repeat))
+            error = np.max(np.abs(run() - reference)) / magnitude
+
+            print("{:8} {:12} {:10.3f} s   max relative error {:.2e}".format(length, name, best, error))
+
+
+if __name__ == "__main__":
+    main()
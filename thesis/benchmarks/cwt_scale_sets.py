@@ -0,0 +1,77 @@
+"""Benchmark of CWT scale sets: transform cost against constellation fingerprint fidelity.
+
+The fingerprints of every scale set are compared with the fingerprints of the
+integer scales [1, scale>, which the fingerprinter resizes to x_size rows.
+Fidelity is the Jaccard similarity of the fingerprint sets and the fraction of
+the reference (fingerprint, offset) postings which are reproduced.
+
+    python -m thesis.benchmarks.cwt_scale_sets --file read.fast5 --wavelet mexh --backend fft
+"""
+import argparse
+import timeit
+
+import numpy as np
+
+from thesis.transforms.wavelet_transform import cwt, cwt_scales
+from thesis.fingerprinting.generators import ConstellationMapGenerator
+from thesis.preprocess.preprocessor import EmptyPreprocessor
+from thesis.utils import constants
+
+
+def parse_arguments() -> argparse.PARSER:
+    parser = argparse.ArgumentParser(description="CWT scale set benchmark")
+
+    parser.add_argument('--file', type=str, help='Signal file (a random walk signal is used if not given)')
+    parser.add_argument('--length', type=int, help='Length of the random walk signal', default=200000)
+    parser.add_argument('--wavelet', type=str, help='Continuous wavelet', default='mexh')
+    parser.add_argument('--scale', type=int, help='Scale used for cwt', default=129)
+    parser.add_argument('--backend', type=str, help='CWT implementation (pywt, fft)', default=constants.CWT_BACKEND_FFT)
+    parser.add_argument('--x_size', type=int, help='Number of rows the fingerprinter resizes the scale axis to',
+                        default=32)
+    parser.add_argument('--y_size', type=int, help='Number of columns the fingerprinter resizes a window to',
+                        default=32)
+    parser.add_argument('--window_size', type=int, help='Number of signal points of one window', default=8192)
+    parser.add_argument('--shift_size', type=int, help='Shift of consecutive windows', default=1024)
+    parser.add_argument('--repeat', type=int, help='Number of timed repetitions', default=3)
+    return parser.parse_args()
+
+
+def _postings(fingerprints: dict) -> set:
+    return {(fingerprint, offset) for fingerprint, postings in fingerprints.items() for offset, _ in postings}
+
+
+def main():
+    args = parse_arguments()
+    if args.file is not None:
+        signal = EmptyPreprocessor().preprocess(args.file)
+    else:
+        signal = np.cumsum(np.random.normal(size=args.length)) + 100
+
+    fingerprinter = ConstellationMapGenerator(args.x_size, args.y_size, args.window_size, args.shift_size, 25, 5, 3)
+    cases = [
+        ("linear", constants.SCALE_SET_LINEAR, None),
+        ("linear 2 * x_size", constants.SCALE_SET_LINEAR, 2 * args.x_size),
+        ("linear x_size", constants.SCALE_SET_LINEAR, args.x_size),
+        ("log scale", constants.SCALE_SET_LOG, None),
+        ("log 2 * x_size", constants.SCALE_SET_LOG, 2 * args.x_size),
+        ("log x_size", constants.SCALE_SET_LOG, args.x_size),
+    ]
+
+    reference = None
+    for name, scale_set, num_scales in cases:
+        scales = cwt_scales(args.scale, scale_set, num_scales)
+        run = lambda: cwt(signal, args.wavelet, scales, True, args.backend)
+        best = min(timeit.repeat(run, number=1, repeat=args.repeat))
+
+        fingerprints = fingerprinter.generate_fingerprints(run(), "read")
+        if reference is None:
+            reference = fingerprints
+        jaccard = len(reference.keys() & fingerprints.keys()) / max(len(reference.keys() | fingerprints.keys()), 1)
+        recall = len(_postings(reference) & _postings(fingerprints)) / max(len(_postings(reference)), 1)
+
+        print("{:18} {:4} scales {:8.3f} s   fingerprint jaccard {:.3f}   postings recall {:.3f}".format(
+            name, len(scales), best, jaccard, recall))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Microbenchmark of SignalExtractor construction latency.
+
+Times the lazy constructor followed by a signal read against the same work
+preceded by the full breadth-first walk the extractor used to do on every
+construction.
+
+    python -m thesis.benchmarks.extractor_construction read_1.fast5 read_2.fast5
+"""
+import argparse
+import contextlib
+import io
+import timeit
+from queue import Queue
+
+from thesis.utils.signal_extractor import SignalExtractor
+
+
+def full_tree_walk(file_handle) -> dict:
+    key_dict_flat = dict()
+    queue = Queue()
+    queue.put(file_handle)
+
+    while not queue.empty():
+        tmp = queue.get()
+        try:
+            for key in tmp.keys():
+                queue.put(tmp[key])
+                key_dict_flat[key] = tmp[key]
+        except AttributeError:
+            continue
+
+    return key_dict_flat
+
+
+def lazy(path: str) -> None:
+    SignalExtractor(path).get_signal_discrete()
+
+
+def eager(path: str) -> None:
+    extractor = SignalExtractor(path)
+    full_tree_walk(extractor._file_handle)
+    extractor.get_signal_discrete()
+
+
+def parse_arguments() -> argparse.PARSER:
+    parser = argparse.ArgumentParser(description="SignalExtractor construction benchmark")
+
+    parser.add_argument('files', type=str, nargs='+', help='fast5 files to open')
+    parser.add_argument('--repeat', type=int, help='Number of timed repetitions', default=5)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+
+    for path in args.files:
+        # the extractor prints the name of every file it opens
+        with contextlib.redirect_stdout(io.StringIO()):
+            lazy_time = min(timeit.repeat(lambda: lazy(path), number=1, repeat=args.repeat))
+            eager_time = min(timeit.repeat(lambda: eager(path), number=1, repeat=args.repeat))
+
+        print("{}: lazy {:.3f} ms, full walk {:.3f} ms".format(path, 1000 * lazy_time, 1000 * eager_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Benchmark of the MinHash engines of MinHashLSHGenerator.
+
+Times the signature generation of both engines on a random scalogram and compares
+their Jaccard estimates with the exact Jaccard similarity of overlapping windows.
+
+    python -m thesis.benchmarks.minhash_engines --length 100000 --shift_size 256
+"""
+import argparse
+import timeit
+
+import numpy as np
+
+from thesis.fingerprinting.generators import MinHashLSHGenerator, resize_windows, batched_largest_indices
+from thesis.fingerprinting.minhash import MinHashSignatures
+from thesis.utils import constants
+
+
+def parse_arguments() -> argparse.PARSER:
+    parser = argparse.ArgumentParser(description="MinHash engine benchmark")
+
+    parser.add_argument('--length', type=int, help='Number of scalogram columns', default=100000)
+    parser.add_argument('--scale', type=int, help='Number of scalogram rows', default=129)
+    parser.add_argument('--window_size', type=int, help='Window size', default=8192)
+    parser.add_argument('--shift_size', type=int, help='Shift size', default=1024)
+    parser.add_argument('--top_wavelets', type=int, help='Stars per window', default=25)
+    parser.add_argument('--signature_size', type=int, help='Signature size', default=128)
+    parser.add_argument('--repeat', type=int, help='Number of timed repetitions', default=3)
+    return parser.parse_args()
+
+
+def _estimates(result) -> np.ndarray:
+    # estimated Jaccard similarity of every window with the following one
+    if isinstance(result, MinHashSignatures):
+        return np.mean(result.signatures[1:] == result.signatures[:-1], axis=1)
+    return np.array([a.jaccard(b) for (a, _), (b, _) in zip(result[:-1], result[1:])])
+
+
+def main():
+    args = parse_arguments()
+    coefficients = np.abs(np.random.normal(size=(args.scale, args.length)))
+
+    generator = MinHashLSHGenerator(32, 32, args.window_size, args.shift_size, args.top_wavelets)
+    starts = np.arange(0, args.length - args.window_size, args.shift_size)
+    ys, xs = batched_largest_indices(resize_windows(coefficients, starts, args.window_size, 32, 32),
+                                     args.top_wavelets)
+    stars = [set(zip(x, y)) for x, y in zip(xs.tolist(), ys.tolist())]
+    exact = np.array([len(a & b) / len(a | b) for a, b in zip(stars[:-1], stars[1:])])
+
+    for engine in [constants.MINHASH_ENGINE_DATASKETCH, constants.MINHASH_ENGINE_NATIVE]:
+        generator = MinHashLSHGenerator(32, 32, args.window_size, args.shift_size, args.top_wavelets,
+                                        args.signature_size, engine=engine)
+        run = lambda: generator.generate_fingerprints(coefficients, "benchmark")
+        best = min(timeit.repeat(run, number=1, repeat=args.repeat))
+        error = _estimates(run()) - exact
+
+        print("{:12} {:8.3f} s   {} windows   Jaccard error mean {:+.4f} std {:.4f}".format(
+            engine, best, len(starts), np.mean(error), np.std(error)))
+
+
+if __name__ == "__main__":
+    main()
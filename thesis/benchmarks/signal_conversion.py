@@ -0,0 +1,59 @@
+"""Benchmark of the discrete to picoampere signal conversion.
+
+Compares the former per-sample Python conversion with the vectorized
+raw_to_picoampere path, either on a fast5 file or on a synthetic signal.
+
+    python -m thesis.benchmarks.signal_conversion --length 500000
+"""
+import argparse
+import timeit
+
+import numpy as np
+
+from thesis.utils.signal_extractor import SignalExtractor, raw_to_picoampere
+
+
+def legacy_conversion(discrete_signal: np.ndarray, offset: float, raw_unit: float) -> np.ndarray:
+    return np.array(list(map(lambda x: (x + offset) * raw_unit, discrete_signal)))
+
+
+def parse_arguments() -> argparse.PARSER:
+    parser = argparse.ArgumentParser(description="Signal conversion benchmark")
+
+    parser.add_argument('--file', type=str, help='fast5 file to read the signal from')
+    parser.add_argument('--length', type=int, help='Length of the synthetic signal', default=500000)
+    parser.add_argument('--repeat', type=int, help='Number of timed repetitions', default=5)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+
+    if args.file is not None:
+        extractor = SignalExtractor(args.file)
+        discrete_signal = extractor.get_signal_discrete()
+        offset, raw_unit = extractor._offset, extractor._raw_unit
+    else:
+        discrete_signal = np.random.randint(200, 1200, size=args.length).astype(np.int16)
+        offset, raw_unit = 4.0, 1400.0 / 8192.0
+
+    buffer = np.empty(discrete_signal.shape, dtype=np.float32)
+    cases = [
+        ("legacy map", lambda: legacy_conversion(discrete_signal, offset, raw_unit)),
+        ("vectorized float64", lambda: raw_to_picoampere(discrete_signal, offset, raw_unit, np.float64)),
+        ("vectorized float32", lambda: raw_to_picoampere(discrete_signal, offset, raw_unit, np.float32)),
+        ("vectorized float32 buffer", lambda: raw_to_picoampere(discrete_signal, offset, raw_unit, out=buffer)),
+    ]
+
+    print("Signal length: {}".format(len(discrete_signal)))
+    for name, case in cases:
+        best = min(timeit.repeat(case, number=1, repeat=args.repeat))
+        print("{:28} {:10.3f} ms".format(name, 1000 * best))
+
+    reference = legacy_conversion(discrete_signal, offset, raw_unit)
+    vectorized = raw_to_picoampere(discrete_signal, offset, raw_unit)
+    print("Max abs difference: {}".format(np.max(np.abs(reference - vectorized))))
+
+
+if __name__ == "__main__":
+    main()
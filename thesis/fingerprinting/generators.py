@@ -1,12 +1,15 @@
-from typing import Tuple, List
+from typing import Callable, Iterable, Iterator, Optional, Tuple, List, Union
 from abc import ABC, abstractmethod
 import numpy as np
-import cv2
 from datasketch import MinHash, MinHashLSH
 from lsh import MinHashSignature
 from collections import defaultdict
 
 import thesis.utils as utils
+import thesis.utils.logging
+from thesis.utils import constants
+from thesis.fingerprinting.minhash import MinHashSignatures, UniversalMinHash
+from thesis.fingerprinting.packed import FingerprintLayout, PackedFingerprints
 
 logger = utils.logging.get_logger(__name__)
 
@@ -19,6 +22,167 @@ def largest_indices(array: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
     return np.unravel_index(indices, array.shape)
 
 
+def _linear_resize_weights(source_size: int, target_size: int, dtype: np.dtype
+                           ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Source indices and weights of the bilinear resize along one axis, computed like cv2.resize with its
+    default INTER_LINEAR interpolation (pixel centre alignment, border replication).
+    """
+    position = ((np.arange(target_size) + 0.5) * (1.0 / (target_size / source_size)) - 0.5).astype(dtype)
+    first = np.floor(position).astype(np.int64)
+    fraction = (position - first).astype(dtype)
+
+    fraction[first < 0] = 0
+    first[first < 0] = 0
+    fraction[first >= source_size - 1] = 0
+    first[first >= source_size - 1] = source_size - 1
+
+    return first, np.minimum(first + 1, source_size - 1), (1 - fraction).astype(dtype), fraction
+
+
+def resize_windows(array: np.ndarray, starts: np.ndarray, window_size: int, rows: int, cols: int) -> np.ndarray:
+    """Resizes all windows array[:, start:start + window_size] to (rows, cols) at once.
+
+    Equivalent (up to floating point rounding) to calling cv2.resize(window, (cols, rows)) on every window.
+    Only the source columns some output pixel interpolates are read, once even if the windows overlap,
+    and they are reduced to the target rows before the columns of the individual windows are formed.
+
+    Args:
+        array (np.ndarray): 2D coefficient array.
+        starts (np.ndarray): start column of every window.
+        window_size (int): number of columns of a window.
+        rows (int): number of rows of the resized windows.
+        cols (int): number of columns of the resized windows.
+
+    Returns:
+        np.ndarray: (number of windows, rows, cols) array of resized windows.
+    """
+    dtype = array.dtype if array.dtype == np.float32 else np.float64
+    col_first, col_second, col_first_weight, col_second_weight = _linear_resize_weights(window_size, cols, dtype)
+    row_first, row_second, row_first_weight, row_second_weight = _linear_resize_weights(array.shape[0], rows, dtype)
+
+    starts = np.asarray(starts, dtype=np.int64)[:, None]
+    sampled, positions = np.unique(np.stack((starts + col_first, starts + col_second)), return_inverse=True)
+    positions = positions.reshape(2, len(starts), cols)
+
+    columns = np.take(array, sampled, axis=1)
+    vertical = np.take(columns, row_first, axis=0) * row_first_weight[:, None] + \
+        np.take(columns, row_second, axis=0) * row_second_weight[:, None]
+    vertical = np.ascontiguousarray(vertical.T)
+
+    resized = np.take(vertical, positions[0], axis=0) * col_first_weight[:, None] + \
+        np.take(vertical, positions[1], axis=0) * col_second_weight[:, None]
+
+    return resized.transpose(0, 2, 1)
+
+
+def batched_largest_indices(windows: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the row and column indices of the n largest values of every window in a stack.
+
+    Args:
+        windows (np.ndarray): (number of windows, rows, cols) array.
+        n (int): number of indices per window.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (number of windows, n) row and column index arrays, in descending order
+            of the values.
+    """
+    flat = windows.reshape(len(windows), -1)
+    n = min(n, flat.shape[1])
+    indices = np.argpartition(flat, -n, axis=1)[:, -n:]
+    order = np.argsort(-np.take_along_axis(flat, indices, axis=1), axis=1)
+    indices = np.take_along_axis(indices, order, axis=1)
+    return np.unravel_index(indices, windows.shape[1:])
+
+
+def iterate_window_batches(coefficients: Union[np.ndarray, Iterable[np.ndarray]],
+                           window_size: int,
+                           shift_size: int,
+                           batch_size: int = 512) -> Iterator[Tuple[np.ndarray, np.ndarray, int]]:
+    """Yields batches of window_size wide windows advancing by shift_size.
+
+    Every batch is a (starts, array, array_start) triple: the absolute start columns of the windows and
+    the array holding them, whose first column is column array_start of the scalogram. The coefficients
+    are either the full 2D scalogram or an iterable of its consecutive column blocks. For blocks only the
+    columns of windows which are not yet complete are buffered, so memory is bounded by the window and
+    block sizes instead of the signal length. Both inputs yield the same windows: every window start in
+    range(0, length - window_size, shift_size).
+    """
+    if isinstance(coefficients, np.ndarray):
+        starts = np.arange(0, coefficients.shape[1] - window_size, shift_size)
+        for i in range(0, len(starts), batch_size):
+            yield starts[i:i + batch_size], coefficients, 0
+        return
+
+    buffer = None
+    buffer_start = 0
+    window_start = 0
+    for block in coefficients:
+        buffer = block if buffer is None else np.concatenate((buffer, block), axis=1)
+        buffer_end = buffer_start + buffer.shape[1]
+
+        # a window is only used if at least one column follows it
+        starts = np.arange(window_start, buffer_end - window_size, shift_size)
+        for i in range(0, len(starts), batch_size):
+            yield starts[i:i + batch_size], buffer, buffer_start
+        if len(starts):
+            window_start = starts[-1] + shift_size
+
+        dropped = min(window_start - buffer_start, buffer.shape[1])
+        buffer = buffer[:, dropped:]
+        buffer_start += dropped
+
+
+def _number_of_windows(coefficients: Union[np.ndarray, Iterable[np.ndarray]], window_size: int, shift_size: int
+                       ) -> Optional[int]:
+    if isinstance(coefficients, np.ndarray):
+        return len(range(0, coefficients.shape[1] - window_size, shift_size))
+    return None
+
+
+def print_progress(done: int, total: Optional[int]) -> None:
+    """Progress callback printing the number of processed windows on a single console line."""
+    print("{} / {}".format(done, "?" if total is None else total), end='\r')
+
+
+def pair_target_zone(ordered_stars: np.ndarray, target_zone_size: int, chain_length: int, anchors: int = None
+                     ) -> Tuple[np.ndarray, np.ndarray]:
+    """Pairs every anchor star with the stars of its target zone.
+
+    For anchor i and every j in [1, target_zone_size) the fingerprint is
+    (f_i, f_{i+j}, t_{i+j} - t_i) followed by (f_{i+j+k}, t_{i+j+k} - t_{i+j+k-1}) for k in [1, chain_length).
+    Pairs whose chain would run past the last star are dropped. All pairs are built at once from
+    broadcasted anchor and target index arrays, in anchor major order.
+
+    Args:
+        ordered_stars (np.ndarray): (number of stars, 2) array of (t, f) stars sorted lexicographically.
+        target_zone_size (int): Size of the target zone which follows each anchor.
+        chain_length (int): Length of the consecutive chain in each target zone.
+        anchors (int, optional): Only the first anchors stars are used as anchors. Defaults to all stars.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (number of fingerprints, 1 + 2 * chain_length) fingerprint array and the
+            anchor offset of every fingerprint.
+    """
+    chain_length = max(chain_length, 1)
+    number_of_stars = len(ordered_stars)
+    number_of_anchors = number_of_stars if anchors is None else min(anchors, number_of_stars)
+    times = ordered_stars[:, 0].astype(np.int64)
+    freqs = ordered_stars[:, 1].astype(np.int64)
+
+    anchors = np.repeat(np.arange(number_of_anchors), max(target_zone_size - 1, 0))
+    targets = anchors + np.tile(np.arange(1, target_zone_size), number_of_anchors)
+    valid = targets + chain_length - 1 < number_of_stars
+    anchors, targets = anchors[valid], targets[valid]
+
+    columns = [freqs[anchors], freqs[targets], times[targets] - times[anchors]]
+    for k in range(1, chain_length):
+        columns.append(freqs[targets + k])
+        columns.append(times[targets + k] - times[targets + k - 1])
+
+    fingerprints = np.stack(columns, axis=1) if len(anchors) else np.empty((0, 1 + 2 * chain_length), dtype=np.int64)
+    return fingerprints, times[anchors]
+
+
 class FingerprintGenerator(ABC):
 
     @abstractmethod
@@ -28,7 +192,7 @@ class FingerprintGenerator(ABC):
 
 class ConstellationMapGenerator(FingerprintGenerator):
 
-    def __init__(self, x_size: int, y_size: int, window_size: int, shift_size: int, top_wavelets: int, target_zone_size: int, chain_length: int) -> None:
+    def __init__(self, x_size: int, y_size: int, window_size: int, shift_size: int, top_wavelets: int, target_zone_size: int, chain_length: int, packed: bool = False, progress: Callable[[int, Optional[int]], None] = None) -> None:
         self._x_size = x_size
         self._y_size = y_size
         self._window_size = window_size
@@ -36,71 +200,139 @@ class ConstellationMapGenerator(FingerprintGenerator):
         self._top_wavelets = top_wavelets
         self._target_zone_size = target_zone_size
         self._chain_length = chain_length
+        self._packed = packed
+        self._progress = progress
 
-    def generate_fingerprints(self, coefficients: np.ndarray, file_id: str) -> dict:
-        constellation_map = set()
+    @property
+    def layout(self) -> FingerprintLayout:
+        """Bit layout of the packed fingerprints generated with these parameters."""
+        return FingerprintLayout.for_generator(self._x_size, self._y_size, self._chain_length)
 
-        for i in range(0, coefficients.shape[1] - self._window_size, self._shift_size):
-            print("{} / {}".format(i, (coefficients.shape[1] - self._window_size) // self._shift_size), end='\r')
-            sub_array = coefficients[:, i: i + self._window_size]
-            sub_array = cv2.resize(sub_array, (self._y_size, self._x_size))
-            y, x = largest_indices(sub_array, self._top_wavelets)
-            x += ((i // self._shift_size) * (self._x_size // (self._window_size // self._shift_size)))
-            inds = list(zip(x, y))
-            constellation_map.update(inds)
+    def _window_stars(self, starts: np.ndarray, array: np.ndarray, array_start: int) -> np.ndarray:
+        # (x, y) stars of a batch of windows, x shifted by the position of the window
+        sub_arrays = resize_windows(array, starts - array_start, self._window_size, self._x_size, self._y_size)
+        y, x = batched_largest_indices(sub_arrays, self._top_wavelets)
+        x += ((starts // self._shift_size) * (self._x_size // (self._window_size // self._shift_size)))[:, None]
+        return np.stack((x.ravel(), y.ravel()), axis=1)
 
-        ordered_stars = list(constellation_map)
-        ordered_stars.sort()
+    def _output(self, fingerprints: np.ndarray, offsets: np.ndarray, file_id: str) -> Union[dict, PackedFingerprints]:
+        if self._packed:
+            return PackedFingerprints.from_fingerprints(fingerprints, offsets, file_id, self.layout)
 
-        fingerprints = []
-        offsets = []
-        for i in range(len(ordered_stars)):
-            anchor = ordered_stars[i]
+        fingerprint_dict = defaultdict(lambda: [])
+        for fingerprint, offset in zip(map(tuple, fingerprints.tolist()), offsets.tolist()):
+            fingerprint_dict[fingerprint].append((offset, file_id))
+        fingerprint_dict = dict(fingerprint_dict)
 
-            try:
-                for j in range(1, self._target_zone_size):
-                    fingerprint = (anchor[1], ordered_stars[i+j][1], ordered_stars[i+j][0] - anchor[0])
+        return fingerprint_dict
 
-                    for k in range(1, self._chain_length):
-                        fingerprint += (ordered_stars[i+j+k][1], ordered_stars[i+j+k][0] - ordered_stars[i+j+k-1][0],)
+    def generate_fingerprints(self, coefficients: Union[np.ndarray, Iterable[np.ndarray]], file_id: str
+                              ) -> Union[dict, PackedFingerprints]:
+        constellation_map = []
 
-                    fingerprints.append(fingerprint)
-                    offsets.append(anchor[0])
-            except IndexError:
-                pass
+        windows = _number_of_windows(coefficients, self._window_size, self._shift_size)
+        done = 0
+        for starts, array, array_start in iterate_window_batches(coefficients, self._window_size, self._shift_size):
+            constellation_map.append(self._window_stars(starts, array, array_start))
 
-        fingerprint_dict = defaultdict(lambda: [])
-        for idx, fingerprint in enumerate(fingerprints):
-            fingerprint_dict[fingerprint].append((offsets[idx], file_id))
-        fingerprint_dict = dict(fingerprint_dict)
+            done += len(starts)
+            if self._progress is not None:
+                self._progress(done, windows)
 
-        return fingerprint_dict
+        ordered_stars = np.unique(np.concatenate(constellation_map), axis=0) if constellation_map \
+            else np.empty((0, 2), dtype=np.int64)
+        fingerprints, offsets = pair_target_zone(ordered_stars, self._target_zone_size, self._chain_length)
+
+        return self._output(fingerprints, offsets, file_id)
+
+    def generate_fingerprint_chunks(self, coefficients: Union[np.ndarray, Iterable[np.ndarray]], file_id: str
+                                    ) -> Iterator[Union[dict, PackedFingerprints]]:
+        """Yields the fingerprints of the read in chunks while the coefficient blocks arrive.
+
+        Later windows only produce stars with larger x, so the stars left of the next window are final. An
+        anchor is paired as soon as its target zone and chains consist of final stars. The chunks together
+        hold the same fingerprints as generate_fingerprints.
+        """
+        step = self._x_size // (self._window_size // self._shift_size)
+        tail = max(self._target_zone_size - 1, 0) + max(self._chain_length, 1) - 1
+        final = np.empty((0, 2), dtype=np.int64)
+        pending = np.empty((0, 2), dtype=np.int64)
+
+        for starts, array, array_start in iterate_window_batches(coefficients, self._window_size, self._shift_size):
+            pending = np.concatenate((pending, self._window_stars(starts, array, array_start)))
+
+            boundary = (starts[-1] // self._shift_size + 1) * step
+            finished = pending[:, 0] < boundary
+            final = np.concatenate((final, np.unique(pending[finished], axis=0)))
+            pending = pending[~finished]
+
+            anchors = len(final) - tail
+            if anchors > 0:
+                fingerprints, offsets = pair_target_zone(final, self._target_zone_size, self._chain_length, anchors)
+                final = final[anchors:]
+                yield self._output(fingerprints, offsets, file_id)
+
+        final = np.concatenate((final, np.unique(pending, axis=0)))
+        fingerprints, offsets = pair_target_zone(final, self._target_zone_size, self._chain_length)
+        yield self._output(fingerprints, offsets, file_id)
 
 
 class MinHashLSHGenerator(FingerprintGenerator):
 
-    def __init__(self, x_size: int, y_size: int, window_size: int, shift_size: int, top_wavelets: int,  signature_size: int = 128) -> None:
+    def __init__(self, x_size: int, y_size: int, window_size: int, shift_size: int, top_wavelets: int,  signature_size: int = 128, progress: Callable[[int, Optional[int]], None] = None, engine: str = constants.MINHASH_ENGINE_DATASKETCH) -> None:
         self._x_size = x_size
         self._y_size = y_size
         self._window_size = window_size
         self._shift_size = shift_size
         self._top_wavelets = top_wavelets
         self._signature_size = signature_size
+        self._progress = progress
+
+        if engine not in {constants.MINHASH_ENGINE_DATASKETCH, constants.MINHASH_ENGINE_NATIVE}:
+            raise ValueError("Unknown MinHash engine {}".format(engine))
+        self._engine = engine
+        self._hasher = UniversalMinHash(x_size * y_size, signature_size) \
+            if engine == constants.MINHASH_ENGINE_NATIVE else None
+
+    def generate_fingerprints(self, coefficients: Union[np.ndarray, Iterable[np.ndarray]], file_id: str
+                              ) -> Union[List[Tuple[MinHash, str]], MinHashSignatures]:
+        chunks = []
+
+        windows = _number_of_windows(coefficients, self._window_size, self._shift_size)
+        done = 0
+        for chunk in self.generate_fingerprint_chunks(coefficients, file_id):
+            chunks.append(chunk)
+
+            done += len(chunk)
+            if self._progress is not None:
+                self._progress(done, windows)
+
+        if self._hasher is not None:
+            if not chunks:
+                return MinHashSignatures.from_windows(np.empty((0, self._signature_size)), [], file_id,
+                                                      self._hasher.seed)
+            return MinHashSignatures.concatenate(chunks)
 
-    def generate_fingerprints(self, coefficients: np.ndarray, file_id: str) -> List[Tuple[MinHash, str]]:
-        results = []
+        return [window for chunk in chunks for window in chunk]
 
-        for i in range(0, coefficients.shape[1] - self._window_size, self._shift_size):
-            print("{} / {}".format(i, (coefficients.shape[1] - self._window_size) // self._shift_size), end='\r')
-            sub_array = coefficients[:, i: i + self._window_size]
-            sub_array = cv2.resize(sub_array, (self._y_size, self._x_size))
-            y, x = largest_indices(sub_array, self._top_wavelets)
-            inds = list(zip(x, y))
+    def generate_fingerprint_chunks(self, coefficients: Union[np.ndarray, Iterable[np.ndarray]], file_id: str
+                                    ) -> Iterator[Union[List[Tuple[MinHash, str]], MinHashSignatures]]:
+        """Yields the window signatures of every batch of windows while the coefficient blocks arrive."""
+        for starts, array, array_start in iterate_window_batches(coefficients, self._window_size, self._shift_size):
+            sub_arrays = resize_windows(array, starts - array_start, self._window_size, self._x_size, self._y_size)
+            ys, xs = batched_largest_indices(sub_arrays, self._top_wavelets)
 
-            m = MinHash(num_perm=self._signature_size)
-            for star in inds:
-                m.update(str(star).encode())
+            if self._hasher is not None:
+                # star code of (x, y) is its flat index in the resized window
+                yield MinHashSignatures.from_windows(self._hasher.signatures(ys * self._y_size + xs),
+                                                     starts // self._shift_size, file_id, self._hasher.seed)
+                continue
 
-            results.append((m, "{}:{}".format(file_id, str(i // self._shift_size))))
+            results = []
+            for i, x, y in zip(starts.tolist(), xs.tolist(), ys.tolist()):
+                m = MinHash(num_perm=self._signature_size)
+                for star in zip(x, y):
+                    m.update(str(star).encode())
 
-        return results
+                results.append((m, "{}:{}".format(file_id, str(i // self._shift_size))))
+            yield results
@@ -0,0 +1,143 @@
+"""Vectorized MinHash signatures of constellation windows.
+
+Every star of a resized window is encoded as the integer row * cols + col, so a
+window is a set of codes from a fixed universe of rows * cols values. The
+universal hash functions h_i(v) = (a_i * v + b_i) mod (2^31 - 1) are evaluated
+once for the whole universe into a (codes, signature size) permutation matrix,
+and the signature of a window is the column-wise minimum of the matrix rows of
+its stars. The probability that two signature entries agree is the Jaccard
+similarity of the star sets, as for datasketch.MinHash signatures, but the hash
+functions differ, so native and datasketch signatures cannot be compared with
+each other.
+"""
+from typing import List, Sequence, Tuple
+
+import numpy as np
+from datasketch import MinHash
+
+from thesis.utils import constants
+
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+def parse_window_labels(labels: Sequence[str]) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+    """Parses "name:offset" window labels of the datasketch engine once into integer arrays.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, List[str]]: uint32 reference ID and window offset of every label and the
+            reference name of every reference ID.
+    """
+    names = dict()
+    ref_ids = np.empty(len(labels), dtype=np.uint32)
+    offsets = np.empty(len(labels), dtype=np.uint32)
+
+    for i, label in enumerate(labels):
+        name, offset = label.rsplit(":", 1)
+        ref_ids[i] = names.setdefault(name, len(names))
+        offsets[i] = int(offset)
+
+    return ref_ids, offsets, list(names)
+
+
+class UniversalMinHash():
+    """Universal hash permutations of the star codes of windows with a fixed size."""
+
+    def __init__(self, num_codes: int, signature_size: int = 128, seed: int = 1) -> None:
+        if num_codes > MERSENNE_PRIME:
+            raise ValueError("{} star codes do not fit below the prime {}".format(num_codes, MERSENNE_PRIME))
+
+        generator = np.random.RandomState(seed)
+        a = generator.randint(1, MERSENNE_PRIME, size=signature_size, dtype=np.uint64)
+        b = generator.randint(0, MERSENNE_PRIME, size=signature_size, dtype=np.uint64)
+
+        codes = np.arange(num_codes, dtype=np.uint64)[:, None]
+        # a * v + b < 2^62, no overflow in uint64
+        self.table = ((a * codes + b) % np.uint64(MERSENNE_PRIME)).astype(np.uint32)
+        self.seed = seed
+
+    @property
+    def signature_size(self) -> int:
+        return self.table.shape[1]
+
+    def signatures(self, codes: np.ndarray) -> np.ndarray:
+        """Computes the signatures of a batch of windows.
+
+        Args:
+            codes (np.ndarray): (number of windows, stars per window) array of star codes.
+
+        Returns:
+            np.ndarray: (number of windows, signature size) uint32 signatures.
+        """
+        return np.take(self.table, codes, axis=0).min(axis=1)
+
+
+class MinHashSignatures():
+    """MinHash signatures of the windows of one or more references or reads.
+
+    Attributes:
+        signatures (np.ndarray): (number of windows, signature size) uint32 signatures.
+        offsets (np.ndarray): uint32 window offset (window start // shift size) of every signature.
+        ref_ids (np.ndarray): uint32 reference ID of every signature.
+        names (List[str]): reference name of every reference ID.
+        seed (int): seed of the hash permutations.
+        engine (str): MinHash engine which computed the signatures, only signatures of the same engine and seed
+            are comparable.
+    """
+
+    def __init__(self, signatures: np.ndarray, offsets: np.ndarray, ref_ids: np.ndarray, names: List[str],
+                 seed: int = 1, engine: str = constants.MINHASH_ENGINE_NATIVE) -> None:
+        self.signatures = np.asarray(signatures, dtype=np.uint32)
+        self.offsets = np.asarray(offsets, dtype=np.uint32)
+        self.ref_ids = np.asarray(ref_ids, dtype=np.uint32)
+        self.names = list(names)
+        self.seed = seed
+        self.engine = engine
+
+    def __len__(self) -> int:
+        return len(self.signatures)
+
+    @property
+    def signature_size(self) -> int:
+        return self.signatures.shape[1]
+
+    @classmethod
+    def from_windows(cls, signatures: np.ndarray, offsets: np.ndarray, name: str, seed: int = 1
+                     ) -> "MinHashSignatures":
+        """Wraps the window signatures of a single reference or read."""
+        return cls(signatures, offsets, np.zeros(len(offsets), dtype=np.uint32), [name], seed)
+
+    @classmethod
+    def from_minhashes(cls, minhashes: List[Tuple[MinHash, str]]) -> "MinHashSignatures":
+        """Converts the (MinHash, "name:offset") list of the datasketch engine, whose hash values are 32 bit."""
+        ref_ids, offsets, names = parse_window_labels([idx for _, idx in minhashes])
+        signatures = np.array([minhash.digest() for minhash, _ in minhashes], dtype=np.uint32)
+        seed = minhashes[0][0].seed if minhashes else 1
+
+        return cls(signatures, offsets, ref_ids, names, seed, constants.MINHASH_ENGINE_DATASKETCH)
+
+    def is_compatible(self, other: "MinHashSignatures") -> bool:
+        return (self.engine, self.seed, self.signature_size) == (other.engine, other.seed, other.signature_size)
+
+    def to_minhashes(self) -> List[Tuple[MinHash, str]]:
+        """Converts the signatures into the (MinHash, "name:offset") list produced by the datasketch engine."""
+        return [(MinHash(hashvalues=signature.astype(np.uint64)), "{}:{}".format(self.names[ref_id], offset))
+                for signature, offset, ref_id in zip(self.signatures, self.offsets.tolist(), self.ref_ids.tolist())]
+
+    @classmethod
+    def concatenate(cls, signatures: Sequence["MinHashSignatures"]) -> "MinHashSignatures":
+        """Merges the signatures of several references into one database, remapping the reference IDs."""
+        seed = signatures[0].seed
+        names = dict()
+        rows, offsets, ref_ids = [], [], []
+
+        for part in signatures:
+            if not part.is_compatible(signatures[0]):
+                raise ValueError("Cannot merge signatures of different hash permutations")
+
+            mapping = np.array([names.setdefault(name, len(names)) for name in part.names], dtype=np.uint32)
+            rows.append(part.signatures)
+            offsets.append(part.offsets)
+            ref_ids.append(mapping[part.ref_ids])
+
+        return cls(np.concatenate(rows), np.concatenate(offsets), np.concatenate(ref_ids), list(names), seed,
+                   signatures[0].engine)
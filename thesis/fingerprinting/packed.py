@@ -0,0 +1,224 @@
+"""Compact representation of constellation fingerprints.
+
+A constellation fingerprint (f_a, f_p_1, dt_1, ..., f_p_n, dt_n) is bit-packed
+into a single uint64 hash: every frequency bin takes freq_bits bits and every
+time delta delta_bits bits (deltas which do not fit are saturated to the largest
+representable value). Anchor offsets and integer reference IDs are kept in
+arrays parallel to the hashes, sorted by hash, and the reference names are
+stored once in a separate ID -> name table.
+
+Existing dictionary pickles can be converted in both directions:
+
+    python -m thesis.fingerprinting.packed pack reference_database.p reference_database_packed.p
+    python -m thesis.fingerprinting.packed unpack reference_database_packed.p reference_database.p
+"""
+from typing import List, Sequence, Tuple
+import argparse
+import pickle as pp
+
+import numpy as np
+
+HASH_BITS = 64
+
+
+class FingerprintLayout():
+    """Bit layout of packed fingerprints with the given chain length."""
+
+    def __init__(self, chain_length: int, freq_bits: int, delta_bits: int = None) -> None:
+        if delta_bits is None:
+            delta_bits = min(32, (HASH_BITS - (chain_length + 1) * freq_bits) // chain_length)
+
+        if (chain_length + 1) * freq_bits + chain_length * delta_bits > HASH_BITS or delta_bits < 1:
+            raise ValueError("Fingerprints with chain length {} and {} frequency bits do not fit into {} bits".format(
+                chain_length, freq_bits, HASH_BITS))
+
+        self.chain_length = chain_length
+        self.freq_bits = freq_bits
+        self.delta_bits = delta_bits
+
+    @classmethod
+    def for_generator(cls, x_size: int, y_size: int, chain_length: int) -> "FingerprintLayout":
+        return cls(chain_length, int(max(x_size, y_size) - 1).bit_length())
+
+    @property
+    def fingerprint_length(self) -> int:
+        return 1 + 2 * self.chain_length
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, FingerprintLayout) and \
+            (self.chain_length, self.freq_bits, self.delta_bits) == \
+            (other.chain_length, other.freq_bits, other.delta_bits)
+
+    def __repr__(self) -> str:
+        return "FingerprintLayout(chain_length={}, freq_bits={}, delta_bits={})".format(
+            self.chain_length, self.freq_bits, self.delta_bits)
+
+    def pack(self, fingerprints: np.ndarray) -> np.ndarray:
+        """Packs a (number of fingerprints, 1 + 2 * chain_length) integer array into uint64 hashes."""
+        fingerprints = np.asarray(fingerprints, dtype=np.uint64).reshape(-1, self.fingerprint_length)
+        freq_mask = np.uint64((1 << self.freq_bits) - 1)
+        delta_max = np.uint64((1 << self.delta_bits) - 1)
+
+        hashes = fingerprints[:, 0] & freq_mask
+        for k in range(self.chain_length):
+            hashes = (hashes << np.uint64(self.freq_bits)) | (fingerprints[:, 1 + 2 * k] & freq_mask)
+            hashes = (hashes << np.uint64(self.delta_bits)) | np.minimum(fingerprints[:, 2 + 2 * k], delta_max)
+
+        return hashes
+
+    def unpack(self, hashes: np.ndarray) -> np.ndarray:
+        """Unpacks uint64 hashes into a (number of hashes, 1 + 2 * chain_length) integer array."""
+        hashes = np.asarray(hashes, dtype=np.uint64).copy()
+        fingerprints = np.empty((len(hashes), self.fingerprint_length), dtype=np.int64)
+        freq_mask = np.uint64((1 << self.freq_bits) - 1)
+        delta_mask = np.uint64((1 << self.delta_bits) - 1)
+
+        for k in reversed(range(self.chain_length)):
+            fingerprints[:, 2 + 2 * k] = hashes & delta_mask
+            hashes >>= np.uint64(self.delta_bits)
+            fingerprints[:, 1 + 2 * k] = hashes & freq_mask
+            hashes >>= np.uint64(self.freq_bits)
+        fingerprints[:, 0] = hashes & freq_mask
+
+        return fingerprints
+
+
+class PackedFingerprints():
+    """Packed fingerprints of one or more references, sorted by hash.
+
+    Attributes:
+        hashes (np.ndarray): uint64 fingerprint hashes in ascending order.
+        offsets (np.ndarray): uint32 anchor offset of every fingerprint.
+        ref_ids (np.ndarray): uint32 reference ID of every fingerprint.
+        names (List[str]): reference name of every reference ID.
+        layout (FingerprintLayout): bit layout of the hashes.
+    """
+
+    def __init__(self, hashes: np.ndarray, offsets: np.ndarray, ref_ids: np.ndarray, names: List[str],
+                 layout: FingerprintLayout, presorted: bool = False) -> None:
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        offsets = np.asarray(offsets, dtype=np.uint32)
+        ref_ids = np.asarray(ref_ids, dtype=np.uint32)
+
+        if not presorted:
+            order = np.argsort(hashes, kind='stable')
+            hashes, offsets, ref_ids = hashes[order], offsets[order], ref_ids[order]
+
+        self.hashes = hashes
+        self.offsets = offsets
+        self.ref_ids = ref_ids
+        self.names = list(names)
+        self.layout = layout
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    @classmethod
+    def from_fingerprints(cls, fingerprints: np.ndarray, offsets: np.ndarray, name: str,
+                          layout: FingerprintLayout) -> "PackedFingerprints":
+        """Packs the fingerprint rows and anchor offsets of a single reference or read."""
+        return cls(layout.pack(fingerprints), offsets, np.zeros(len(offsets), dtype=np.uint32), [name], layout)
+
+    @classmethod
+    def from_dict(cls, fingerprint_dict: dict, layout: FingerprintLayout = None) -> "PackedFingerprints":
+        """Converts a fingerprint dictionary, (f_a, f_p_1, dt_1, ...) -> [(offset, name)], into packed form.
+
+        The layout is inferred from the fingerprint length and the largest frequency bin if not given.
+        """
+        fingerprints = [key for key in fingerprint_dict if key != "params"]
+
+        if layout is None:
+            if not fingerprints:
+                raise ValueError("Cannot infer the layout of an empty fingerprint dictionary")
+            chain_length = (len(fingerprints[0]) - 1) // 2
+            max_freq = max(max((fingerprint[0],) + fingerprint[1::2]) for fingerprint in fingerprints)
+            layout = FingerprintLayout(chain_length, max(1, int(max_freq).bit_length()))
+
+        names = dict()
+        rows, offsets, ref_ids = [], [], []
+        for fingerprint in fingerprints:
+            for offset, name in fingerprint_dict[fingerprint]:
+                rows.append(fingerprint)
+                offsets.append(offset)
+                ref_ids.append(names.setdefault(name, len(names)))
+
+        rows = np.array(rows, dtype=np.int64).reshape(-1, layout.fingerprint_length)
+        return cls(layout.pack(rows), offsets, ref_ids, list(names), layout)
+
+    def to_dict(self) -> dict:
+        """Converts the packed fingerprints back into the dictionary form, (f_a, ...) -> [(offset, name)].
+        Saturated time deltas keep their saturated value.
+        """
+        unique, starts = np.unique(self.hashes, return_index=True)
+        stops = np.append(starts[1:], len(self.hashes))
+        fingerprints = self.layout.unpack(unique)
+
+        fingerprint_dict = dict()
+        for fingerprint, start, stop in zip(fingerprints, starts, stops):
+            fingerprint_dict[tuple(int(v) for v in fingerprint)] = [
+                (int(offset), self.names[ref_id]) for offset, ref_id in
+                zip(self.offsets[start:stop], self.ref_ids[start:stop])]
+
+        return fingerprint_dict
+
+    def lookup(self, hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Finds the range of entries matching every query hash.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: start and stop index into the entries for every query hash, equal for
+                hashes which are not present.
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        return np.searchsorted(self.hashes, hashes, 'left'), np.searchsorted(self.hashes, hashes, 'right')
+
+    @classmethod
+    def concatenate(cls, packed: Sequence["PackedFingerprints"]) -> "PackedFingerprints":
+        """Merges packed fingerprints of several references into one database, remapping the reference IDs."""
+        layout = packed[0].layout
+        names = dict()
+        hashes, offsets, ref_ids = [], [], []
+
+        for part in packed:
+            if part.layout != layout:
+                raise ValueError("Cannot merge fingerprints with layouts {} and {}".format(layout, part.layout))
+
+            mapping = np.array([names.setdefault(name, len(names)) for name in part.names], dtype=np.uint32)
+            hashes.append(part.hashes)
+            offsets.append(part.offsets)
+            ref_ids.append(mapping[part.ref_ids])
+
+        return cls(np.concatenate(hashes), np.concatenate(offsets), np.concatenate(ref_ids), list(names), layout)
+
+
+def parse_arguments() -> argparse.PARSER:
+    parser = argparse.ArgumentParser(description="Conversion between dictionary and packed fingerprint pickles")
+
+    parser.add_argument('direction', choices=['pack', 'unpack'], help='Conversion direction')
+    parser.add_argument('input', type=str, help='Input pickle')
+    parser.add_argument('output', type=str, help='Output pickle')
+    parser.add_argument('--freq_bits', type=int, help='Bits per frequency bin (inferred if not given)')
+    parser.add_argument('--delta_bits', type=int, help='Bits per time delta (remaining bits if not given)')
+    return parser.parse_args()
+
+
+def main():
+    # use the importable module so the pickled classes do not refer to __main__
+    from thesis.fingerprinting import packed
+
+    args = parse_arguments()
+    data = pp.load(open(args.input, 'rb'))
+
+    if args.direction == 'pack':
+        layout = None
+        if args.freq_bits is not None:
+            chain_length = (len(next(k for k in data if k != "params")) - 1) // 2
+            layout = packed.FingerprintLayout(chain_length, args.freq_bits, args.delta_bits)
+        result = packed.PackedFingerprints.from_dict(data, layout)
+    else:
+        result = data.to_dict()
+
+    pp.dump(result, open(args.output, 'wb'))
+
+
+if __name__ == "__main__":
+    main()
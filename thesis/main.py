@@ -1,6 +1,9 @@
-from thesis.utils.ioutil import save_similarity_result, extract_file_name
-from thesis.similarity.computer import ConstellationSimilarityComputer, LSHSimilarityComputer
-from thesis.utils import constants
+from typing import List, Tuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from thesis.utils.ioutil import save_similarity_result, extract_file_name, load_reference
+from thesis.similarity.computer import ConstellationSimilarityComputer, LSHSimilarityComputer, SimilarityResult
+from thesis.similarity.lsh_index import BandedLSHIndex
+from thesis.utils import constants, logging
 import pickle as pp
 import numpy as np
 import sys
@@ -10,48 +13,110 @@ __version__ = '0.0.1'
 __name__ == "__main__"
 # TODO: change database to fixed path
 
+logger = logging.get_logger(__name__)
+
 
 def parse_arguments() -> argparse.PARSER:
     parser = argparse.ArgumentParser(description="Wavelet transformation module")
 
     # required arguments
     parser.add_argument('--ref', required=True, type=str,
-                        help='File which contains the reference pipeline result.')
+                        help='File which contains the reference pipeline result, or a reference index directory.')
     parser.add_argument('--read', required=True, type=str, nargs='+',
                         help='File which contains the read pipeline result.')
     parser.add_argument('--similarity', required=True, type=str,
                         help='Similarity type to use for comparison (constellation, lsh)')
     parser.add_argument('--num_tables', type=int,
-                        help='Number of tables to be used for similarity in LSH', default=8)
-    parser.add_argument('--threshold', type=float, help='Threshold for similarity of minhash singature', default=0.5)
+                        help='Number of tables to be used for similarity in LSH (taken from the index if --ref is an '
+                             'LSH index)', default=8)
+    parser.add_argument('--threshold', type=float, help='Threshold for similarity of minhash singature (taken from the '
+                                                        'index if --ref is an LSH index)', default=0.5)
     parser.add_argument('--required_votes', type=int,
                         help='Number of required votes by the table to vet a vote', default=3)
+    parser.add_argument('--coherency', type=str,
+                        help='Offset coherency counting for constellation similarity (loop, vectorized)',
+                        default=constants.COHERENCY_MODE_LOOP)
+    parser.add_argument('--workers', type=int,
+                        help='Number of worker processes matching reads in parallel', default=1)
+    parser.add_argument('--chunksize', type=int,
+                        help='Number of reads handed to a worker at once', default=1)
     return parser.parse_args()
 
 
-def main():
-    args = parse_arguments()
-    reference = pp.load(open(args.ref, 'rb'))
-
-    similarity_computer = None
+def build_similarity_computer(args: argparse.Namespace, reference):
     if args.similarity == constants.SIMILARITY_CONSTELLATION:
-        similarity_computer = ConstellationSimilarityComputer(reference)
+        return ConstellationSimilarityComputer(reference, mode=args.coherency)
     elif args.similarity == constants.SIMILARITY_LSH:
-        similarity_computer = LSHSimilarityComputer(reference, args.num_tables, args.threshold, args.required_votes)
+        if isinstance(reference, BandedLSHIndex):
+            args.num_tables, args.threshold = reference.num_tables, reference.threshold
+        return LSHSimilarityComputer(reference, args.num_tables, args.threshold, args.required_votes)
     else:
         raise Exception("INVALID")
-    
-    reads = []
+
+
+def _save_result(args: argparse.Namespace, r: str, similarity_result) -> None:
+    print(similarity_result)
+    if args.similarity == constants.SIMILARITY_CONSTELLATION:
+        save_similarity_result(extract_file_name(r) + '_sim.txt', similarity_result)
+    else:
+        save_similarity_result(extract_file_name(r) + "{}_{}_{}".format(args.num_tables, args.required_votes, args.threshold) + "_sim.txt", similarity_result)
+
+
+# similarity computer of a query worker, inherited from the parent when processes are forked
+_worker_computer = None
+
+
+def _init_query_worker(args: argparse.Namespace) -> None:
+    global _worker_computer
+    if _worker_computer is None:
+        _worker_computer = build_similarity_computer(args, load_reference(args.ref))
+
+
+def _query_reads(reads: List[str]) -> List[Tuple[str, SimilarityResult]]:
+    return [(r, _worker_computer.compute_similarity(pp.load(open(r, 'rb')))) for r in reads]
+
+
+def query_parallel(args: argparse.Namespace) -> None:
+    """Matches the reads on a process pool against one loaded reference. The reference is shared with forked
+    workers copy-on-write, otherwise every worker loads it once (memory mapped for index directories). Results
+    are saved in completion order.
+
+    Args:
+        args (argparse.Namespace): Parsed arguments.
+    """
+    chunks = [args.read[i:i + args.chunksize] for i in range(0, len(args.read), args.chunksize)]
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_query_worker, initargs=(args,)) as executor:
+        futures = {executor.submit(_query_reads, chunk): chunk for chunk in chunks}
+
+        for future in as_completed(futures):
+            try:
+                results = future.result()
+            except Exception:       # pylint: disable=broad-except
+                logger.exception("Matching %s failed", futures[future])
+                continue
+
+            for r, similarity_result in results:
+                _save_result(args, r, similarity_result)
+
+
+def main():
+    global _worker_computer
+
+    args = parse_arguments()
+    reference = load_reference(args.ref)
+    similarity_computer = build_similarity_computer(args, reference)
+
+    if args.workers > 1:
+        _worker_computer = similarity_computer
+        query_parallel(args)
+        return
+
     for r in args.read:
         read = pp.load(open(r, 'rb'))
-        
-        similarity_result = similarity_computer.compute_similarity(read)
 
-        print(similarity_result)
-        if args.similarity == constants.SIMILARITY_CONSTELLATION:
-            save_similarity_result(extract_file_name(r) + '_sim.txt', similarity_result)
-        else:
-            save_similarity_result(extract_file_name(r) + "{}_{}_{}".format(args.num_tables, args.required_votes, args.threshold) + "_sim.txt", similarity_result)
+        similarity_result = similarity_computer.compute_similarity(read)
+        _save_result(args, r, similarity_result)
 
 
 if __name__ == "__main__":
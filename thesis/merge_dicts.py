@@ -2,11 +2,20 @@ from collections import defaultdict
 import pickle as pp
 import sys
 
+from thesis.fingerprinting.packed import PackedFingerprints
+
 
 def merge_dicts(dicts, suffix):
+    if all(isinstance(d, PackedFingerprints) for d in dicts):
+        final_dict = PackedFingerprints.concatenate(dicts)
+        pp.dump(final_dict, open("reference_database_"+suffix +".p", "wb"))
+        return final_dict
+
     final_dict = defaultdict(lambda: [])
 
     for d in dicts:
+        if isinstance(d, PackedFingerprints):
+            d = d.to_dict()
         for k, v in d.items():
             final_dict[k].extend(v)
     
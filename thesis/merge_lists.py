@@ -2,11 +2,20 @@ from collections import defaultdict
 import pickle as pp
 import sys
 
+from thesis.fingerprinting.minhash import MinHashSignatures
+
 
 def merge_lists(lists, suffix):
+    if all(isinstance(l, MinHashSignatures) for l in lists):
+        final_list = MinHashSignatures.concatenate(lists)
+        pp.dump(final_list, open("reference_database_"+suffix +".p", "wb"))
+        return final_list
+
     final_list = []
 
     for d in lists:
+        if isinstance(d, MinHashSignatures):
+            d = d.to_minhashes()
         final_list += d
     
     pp.dump(final_list, open("reference_database_"+suffix +".p", "wb"))
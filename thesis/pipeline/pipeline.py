@@ -1,21 +1,33 @@
-from typing import Optional, List
+from typing import Callable, Optional, List, Iterable, Iterator, Tuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pickle as pp
 import argparse
+import glob
+import hashlib
+import os
+
+import numpy as np
 
 from thesis.utils import logging, constants, ioutil
-from thesis.fingerprinting.generators import FingerprintGenerator, ConstellationMapGenerator, MinHashLSHGenerator
-from thesis.transforms.wavelet_transform import WaveletTransformator
+from thesis.fingerprinting.generators import FingerprintGenerator, ConstellationMapGenerator, MinHashLSHGenerator, \
+    print_progress
+from thesis.transforms.wavelet_transform import WaveletTransformator, decimation_factor
 from thesis.preprocess.preprocessor import Preprocessor, EmptyPreprocessor, TomboPreprocessor
+from thesis.utils.signal_extractor import SignalExtractor
+from thesis.utils.cache import StageCache
 
 logger = logging.get_logger(__name__)
 
 
-def parse_arguments() -> argparse.PARSER:
+def parse_arguments(argv: List[str] = None) -> argparse.PARSER:
     parser = argparse.ArgumentParser(description="Wavelet transformation module")
 
     # required arguments
-    parser.add_argument('--file', required=True, type=str,
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--file', type=str,
                         help='File which contains the signal. Can be .fast5 or a 1D numpy array (both as .p and .npy))')
+    source.add_argument('--batch', type=str,
+                        help='Directory, glob pattern or manifest file (one path per line) of signal files')
     parser.add_argument('--preprocess', type=str,
                         help="Preprocessing to use on the signal before transformation", default=constants.PREPROCESS_TOMBO)
     parser.add_argument('--transform', type=str,
@@ -27,8 +39,16 @@ def parse_arguments() -> argparse.PARSER:
 
     # optional arguments
     parser.add_argument('--id', type=str, help='ID used for the sequence')
+    parser.add_argument('--multi_read', action='store_true',
+                        help='Process every read of a multi-read fast5 file, one result per read')
+    parser.add_argument('--read_ids', type=str, nargs='+',
+                        help='Only process reads with these IDs (with --multi_read)')
     parser.add_argument('--discrete_wavelet', type=str,
                         help='Wavelet used for DWT')
+    parser.add_argument('--workers', type=int,
+                        help='Number of worker processes used with --batch', default=os.cpu_count())
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip reads whose pipeline result already exists in the destination (with --batch)')
     parser.add_argument('--destination',
                         type=str,
                         help='Directory where the resulting transformation should be saved',
@@ -37,10 +57,25 @@ def parse_arguments() -> argparse.PARSER:
     # optional arguments transform
     parser.add_argument('--scale', type=int,
                         help='Scale used for cwt', metavar='BOUND', default=129)
+    parser.add_argument('--scale_set', type=str,
+                        help='Spacing of the CWT scales up to --scale (linear, log)', default=constants.SCALE_SET_LINEAR)
+    parser.add_argument('--num_scales', type=str,
+                        help='Number of CWT scales, "auto" matches --x_size (defaults to the integer scales for '
+                             'linear and --scale scales for log)')
+    parser.add_argument('--scales', type=float, nargs='+',
+                        help='Explicit CWT scales, overrides --scale_set and --num_scales')
     parser.add_argument('--absolute', type=bool,
                         help='Should cwt coefficients be returned as absolute value', default=True)
     parser.add_argument('--level', type=int,
-                        help='Level for the multilevel DWT', default=5)
+                        help='Level for the multilevel DWT, the DWT-CWT transform decimates the signal by 2^level',
+                        default=5)
+    parser.add_argument('--cwt_backend', type=str,
+                        help='CWT implementation (pywt, fft)', default=constants.CWT_BACKEND_PYWT)
+    parser.add_argument('--dtype', type=str,
+                        help='Floating point type of the CWT coefficients (float32, float64)', default='float64')
+    parser.add_argument('--block_size', type=int,
+                        help='Stream the CWT in blocks of this many signal points instead of computing the whole '
+                             'scalogram at once')
 
     # optional arguments fingerprinting
     parser.add_argument('--x_size', type=int,
@@ -59,42 +94,85 @@ def parse_arguments() -> argparse.PARSER:
                         help='Length of the consecutive chain in each target zone', default=3)
     parser.add_argument('--signature_size', type=int,
                         help='Signature size for the MinHash', default=128)
-    return parser.parse_args()
+    parser.add_argument('--minhash_engine', type=str,
+                        help='MinHash implementation (datasketch, native)', default=constants.MINHASH_ENGINE_DATASKETCH)
+    parser.add_argument('--cache_dir', type=str,
+                        help='Directory of a cache of preprocessed signals and CWT coefficients (disabled if not set)')
+    parser.add_argument('--cache_size', type=int,
+                        help='Size limit of the cache in MB, least recently used entries are evicted')
+    parser.add_argument('--cache_hash_files', action='store_true',
+                        help='Identify cached input files by their content instead of path, size and time')
+    parser.add_argument('--packed', action='store_true',
+                        help='Store constellation fingerprints as packed uint64 hashes with parallel offset arrays')
+    return parser.parse_args(argv)
+
+
+def build_cache(args: argparse.PARSER) -> Optional[StageCache]:
+    if getattr(args, "cache_dir", None) is None:
+        return None
+
+    max_bytes = args.cache_size << 20 if args.cache_size is not None else None
+    return StageCache(args.cache_dir, max_bytes, args.cache_hash_files)
 
 
 def build_preprocessor(args: argparse.PARSER) -> Preprocessor:
     if args.preprocess.lower() == constants.PREPROCESS_NONE:
-        return EmptyPreprocessor()
+        return EmptyPreprocessor(build_cache(args))
 
     elif args.preprocess.lower() == constants.PREPROCESS_TOMBO:
-        return TomboPreprocessor()
+        return TomboPreprocessor(build_cache(args))
 
     else:
         return None
 
 
+def resolve_num_scales(args: argparse.PARSER) -> Optional[int]:
+    num_scales = getattr(args, "num_scales", None)
+    if num_scales is None:
+        return None
+    if num_scales == constants.NUM_SCALES_AUTO:
+        # the fingerprinters resize the scale axis to x_size rows
+        return args.x_size
+    return int(num_scales)
+
+
 def build_transformator(args: argparse.PARSER) -> Optional[WaveletTransformator]:
     if args.transform.lower() not in {constants.TRANSFORMS_CWT, constants.TRANSFORMS_DWT_CWT}:
         return None
 
-    return WaveletTransformator(**vars(args))
+    return WaveletTransformator(**dict(vars(args), cache=build_cache(args), num_scales=resolve_num_scales(args)))
+
 
+def build_fingerprinter(args: argparse.PARSER, progress: Optional[Callable[[int, Optional[int]], None]] = print_progress
+                        ) -> Optional[FingerprintGenerator]:
+    # window and shift sizes are given in signal samples, a decimating transform has fewer coefficient columns
+    factor = decimation_factor(args.transform.lower(), args.level)
+    if args.window_size % factor != 0 or args.shift_size % factor != 0:
+        raise ValueError("Window size {} and shift size {} have to be multiples of the decimation factor {}".format(
+            args.window_size, args.shift_size, factor))
+    window_size, shift_size = args.window_size // factor, args.shift_size // factor
 
-def build_fingerprinter(args: argparse.PARSER) -> Optional[FingerprintGenerator]:
     if args.fingerprinting.lower() == constants.FINGERPRINTING_CONSTELLATION:
-        return ConstellationMapGenerator(args.x_size, args.y_size, args.window_size, args.shift_size, args.top_wavelets, args.target_zone_size, args.chain_length)
+        return ConstellationMapGenerator(args.x_size, args.y_size, window_size, shift_size, args.top_wavelets, args.target_zone_size, args.chain_length, args.packed, progress)
 
     elif args.fingerprinting.lower() == constants.FINGERPRINTING_MINHASH:
-        return MinHashLSHGenerator(args.x_size, args.y_size, args.window_size, args.shift_size, args.top_wavelets, args.signature_size)
+        return MinHashLSHGenerator(args.x_size, args.y_size, window_size, shift_size, args.top_wavelets, args.signature_size, progress, args.minhash_engine)
 
     else:
         return None
 
 
+def _transform(transformator: WaveletTransformator, signal: np.ndarray):
+    # streaming transformators hand the fingerprinter a generator of coefficient blocks
+    if transformator.is_streaming():
+        return transformator.transform_blocks(signal)
+    return transformator.transform(signal)
+
+
 def pipeline(filename: str, file_id: str, preprocessor: Preprocessor, transformator: WaveletTransformator, fingerprinter: FingerprintGenerator) -> None:
     preprocess_result = preprocessor.preprocess(filename)
     logger.info("Signal preprocessing completed")
-    tranformation_result = transformator.transform(preprocess_result)
+    tranformation_result = _transform(transformator, preprocess_result)
     logger.info("Signal transformation completed")
     fingerprinting_result = fingerprinter.generate_fingerprints(tranformation_result, file_id)
     logger.info("Fingerprinting completed")
@@ -102,27 +180,74 @@ def pipeline(filename: str, file_id: str, preprocessor: Preprocessor, transforma
     return fingerprinting_result
 
 
-def __generate_pipeline_save_strings(args) -> List[str]:
+def pipeline_reads(filename: str,
+                   preprocessor: Preprocessor,
+                   transformator: WaveletTransformator,
+                   fingerprinter: FingerprintGenerator,
+                   read_ids: Iterable[str] = None) -> Iterator[Tuple[str, object]]:
+    """Runs the pipeline over every read of a (multi-read) fast5 file from one open file handle.
+
+    The read ID is used as the fingerprinting ID of every read.
+
+    Args:
+        filename (str): File which contains the reads.
+        preprocessor (Preprocessor): Preprocessor applied to every read.
+        transformator (WaveletTransformator): Transformator applied to every preprocessed read.
+        fingerprinter (FingerprintGenerator): Fingerprint generator applied to every transformed read.
+        read_ids (Iterable[str], optional): Only reads with these IDs are processed.
+
+    Yields:
+        Tuple[str, object]: Read ID and the fingerprinting result of the read.
+    """
+    for read_id, preprocess_result in preprocessor.preprocess_reads(filename, read_ids):
+        logger.info("Read %s preprocessing completed", read_id)
+        tranformation_result = _transform(transformator, preprocess_result)
+        fingerprinting_result = fingerprinter.generate_fingerprints(tranformation_result, read_id)
+        logger.info("Read %s fingerprinting completed", read_id)
+
+        yield read_id, fingerprinting_result
+
+
+def _scale_string(args) -> str:
+    # the integer scales [1, scale> keep the original names
+    if getattr(args, "scales", None) is not None:
+        digest = hashlib.sha1(" ".join(repr(float(s)) for s in args.scales).encode()).hexdigest()
+        return "scales-{}-{}".format(len(args.scales), digest[:8])
+
+    scale_set = getattr(args, "scale_set", constants.SCALE_SET_LINEAR)
+    num_scales = resolve_num_scales(args)
+    if scale_set == constants.SCALE_SET_LINEAR and num_scales is None:
+        return str(args.scale)
+    return "{}-{}-{}".format(args.scale, scale_set, num_scales if num_scales is not None else args.scale)
+
+
+def __generate_pipeline_save_strings(args, file_string: str = None) -> List[str]:
     # generate file string
-    file_string = ioutil.extract_file_name(args.file)
+    if file_string is None:
+        file_string = ioutil.extract_file_name(args.file)
     # # generate preprocess string
     preprocess_string = args.preprocess
 
     # generate transform string
     if args.transform == constants.TRANSFORMS_CWT:
-        transform_string = "cwt_{}_{}_{}".format(args.continuous_wavelet, args.scale, args.absolute)
+        transform_string = "cwt_{}_{}_{}".format(args.continuous_wavelet, _scale_string(args), args.absolute)
 
     elif args.transform == constants.TRANSFORMS_DWT_CWT:
         transform_string = "dwt_cwt_{}_{}_{}_{}_{}".format(
-            args.discrete_wavelet, args.level, args.continuous_wavelet, args.scale, args.absolute)
+            args.discrete_wavelet, args.level, args.continuous_wavelet, _scale_string(args), args.absolute)
 
     # generate fingerprinting string
     if args.fingerprinting == constants.FINGERPRINTING_CONSTELLATION:
         fingerprinting_string = "{}_{}_{}_{}_{}_{}_{}_{}".format(
             args.fingerprinting, args.x_size, args.y_size, args.window_size, args.shift_size, args.top_wavelets, args.target_zone_size, args.chain_length)
+        # packed and dictionary results of one configuration are kept apart
+        if getattr(args, "packed", False):
+            fingerprinting_string += "_packed"
     elif args.fingerprinting == constants.FINGERPRINTING_MINHASH:
         fingerprinting_string = "{}_{}_{}_{}_{}_{}_{}".format(
             args.fingerprinting, args.x_size, args.y_size, args.window_size, args.shift_size, args.top_wavelets, args.signature_size)
+        if getattr(args, "minhash_engine", constants.MINHASH_ENGINE_DATASKETCH) != constants.MINHASH_ENGINE_DATASKETCH:
+            fingerprinting_string += "_" + args.minhash_engine
     return [file_string, preprocess_string, transform_string, fingerprinting_string]
 
 
@@ -131,24 +256,147 @@ def _save_pipeline_result(file_template: str, args: List[str], destination_dir:
     pp.dump(pipeline_result, open(destination_dir + file_template.format(*args), "wb"))
 
 
-def main():
-    args = parse_arguments()
+def _pipeline_result_path(args: argparse.Namespace, file_string: str) -> str:
+    return args.destination + constants.PIPELINE_RESULT.format(*__generate_pipeline_save_strings(args, file_string))
+
+
+def build_pipeline(args: argparse.Namespace, progress: Optional[Callable[[int, Optional[int]], None]] = print_progress
+                   ) -> Optional[Tuple[Preprocessor, WaveletTransformator, FingerprintGenerator]]:
     # Construct objects needed to be passed
     preprocessor = build_preprocessor(args)
     if preprocessor is None:
-        return
+        return None
     logger.info("Preprocessor built")
 
     transformator = build_transformator(args)
     if transformator is None:
-        return
+        return None
     logger.info("Transformator built")
 
-    fingerprinter = build_fingerprinter(args)
+    fingerprinter = build_fingerprinter(args, progress)
     if fingerprinter is None:
-        return
+        return None
     logger.info("Fingerprinter built")
 
+    return preprocessor, transformator, fingerprinter
+
+
+def collect_batch_files(batch: str) -> List[str]:
+    """Lists the signal files of a batch.
+
+    Args:
+        batch (str): Directory (all .fast5 and .npy files in it), glob pattern or manifest file with one path per
+            line.
+
+    Returns:
+        List[str]: Sorted list of files in the batch.
+    """
+    if os.path.isdir(batch):
+        files = glob.glob(os.path.join(batch, "*.fast5")) + glob.glob(os.path.join(batch, "*.npy"))
+    elif os.path.isfile(batch):
+        with open(batch) as handle:
+            files = [line.strip() for line in handle if line.strip() and not line.startswith("#")]
+    else:
+        files = glob.glob(batch)
+
+    return sorted(files)
+
+
+# pipeline objects of a batch worker process, built once by _init_batch_worker
+_worker_pipeline = None
+
+
+def _init_batch_worker(args: argparse.Namespace) -> None:
+    global _worker_pipeline
+    # no progress output, the workers would interleave their progress lines
+    _worker_pipeline = (args, build_pipeline(args, progress=None))
+
+
+def _process_batch_file(filename: str) -> List[str]:
+    """Runs the pipeline over one file of the batch in a worker process and saves one result per read.
+
+    Args:
+        filename (str): File which contains the signal.
+
+    Returns:
+        List[str]: Paths of the written pipeline results.
+    """
+    args, (preprocessor, transformator, fingerprinter) = _worker_pipeline
+    written = []
+
+    if not args.multi_read:
+        file_id = ioutil.extract_file_name(filename)
+        path = _pipeline_result_path(args, file_id)
+        if args.resume and os.path.isfile(path):
+            return written
+
+        ioutil.save_pickle(path, pipeline(filename, file_id, preprocessor, transformator, fingerprinter))
+        written.append(path)
+        return written
+
+    read_ids = args.read_ids
+    if args.resume and filename.endswith(".fast5"):
+        all_ids = read_ids if read_ids is not None else [read_id for read_id, _ in
+                                                         SignalExtractor(filename).iterate_reads()]
+        read_ids = [read_id for read_id in all_ids if not os.path.isfile(_pipeline_result_path(args, read_id))]
+
+    for read_id, pipeline_result in pipeline_reads(filename, preprocessor, transformator, fingerprinter, read_ids):
+        path = _pipeline_result_path(args, read_id)
+        ioutil.save_pickle(path, pipeline_result)
+        written.append(path)
+
+    return written
+
+
+def run_batch(args: argparse.Namespace) -> None:
+    """Runs the pipeline over every file of args.batch on a process pool. The pipeline objects are built once per
+    worker process.
+
+    Args:
+        args (argparse.Namespace): Parsed pipeline arguments.
+    """
+    files = collect_batch_files(args.batch)
+    if args.resume and not args.multi_read:
+        files = [f for f in files if not os.path.isfile(_pipeline_result_path(args, ioutil.extract_file_name(f)))]
+    logger.info("Batch of %d files to process", len(files))
+
+    # the workers build their own pipeline objects, options which build none would fail every file
+    if build_pipeline(args, progress=None) is None:
+        logger.error("No pipeline can be built from the given preprocess, transform and fingerprinting options")
+        return
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_batch_worker, initargs=(args,)) as executor:
+        futures = {executor.submit(_process_batch_file, f): f for f in files}
+
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                written = future.result()
+            except Exception:       # pylint: disable=broad-except
+                logger.exception("Processing %s failed", futures[future])
+                continue
+
+            logger.info("%d/%d files processed (%s, %d results)", done, len(files), futures[future], len(written))
+
+
+def main():
+    args = parse_arguments()
+
+    if args.batch is not None:
+        run_batch(args)
+        return
+
+    built = build_pipeline(args)
+    if built is None:
+        return
+    preprocessor, transformator, fingerprinter = built
+
+    if args.multi_read:
+        for read_id, pipeline_result in pipeline_reads(args.file, preprocessor, transformator, fingerprinter,
+                                                       args.read_ids):
+            _save_pipeline_result(constants.PIPELINE_RESULT, __generate_pipeline_save_strings(args, read_id),
+                                  args.destination, pipeline_result)
+        return
+
     if args.id is None:
         file_id = ioutil.extract_file_name(args.file)
     else:
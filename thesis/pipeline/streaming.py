@@ -0,0 +1,226 @@
+"""Streaming pipeline from signal chunks to a classification.
+
+The stages run in their own threads connected by bounded queues:
+
+    signal chunks -> streaming CWT -> window fingerprints -> incremental similarity
+
+Every stage works on chunks as they arrive, so a read is classified while its
+signal is still being read and nothing is written to disk between the stages.
+A full queue blocks the stage feeding it, which bounds the memory of a stream.
+Classification stops as soon as the leading reference is ahead by the margin
+(see thesis.similarity.incremental), the remaining stages are then cancelled.
+
+Options after the streaming options are pipeline options:
+
+    python -m thesis.pipeline.streaming --file read.fast5 --ref reference_index/ --similarity constellation \\
+        --margin 10 -- --continuous_wavelet mexh --preprocess none --fingerprinting constellation
+"""
+from typing import Iterable, Iterator, List, Union
+import argparse
+import queue
+import threading
+
+import numpy as np
+
+from thesis.utils import constants, ioutil, logging
+from thesis.fingerprinting.generators import FingerprintGenerator
+from thesis.main import build_similarity_computer
+from thesis.pipeline import pipeline
+from thesis.preprocess.preprocessor import Preprocessor
+from thesis.similarity.computer import ConstellationSimilarityComputer, LSHSimilarityComputer
+from thesis.similarity.incremental import IncrementalSimilarity
+from thesis.transforms.wavelet_transform import WaveletTransformator
+
+logger = logging.get_logger(__name__)
+
+_END = object()
+
+
+class _Failure():
+
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+def _threaded(items: Iterable, queue_size: int, cancelled: threading.Event, threads: List[threading.Thread]
+              ) -> Iterator:
+    """Iterates over items in a background thread, handing them over through a queue of queue_size items.
+
+    Both sides stop once cancelled is set, the started thread is appended to threads so it can be joined.
+    """
+    handover = queue.Queue(maxsize=queue_size)
+
+    def put(item) -> bool:
+        while not cancelled.is_set():
+            try:
+                handover.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce() -> None:
+        end = _END
+        try:
+            for item in items:
+                if not put(item):
+                    return
+        except BaseException as e:      # pylint: disable=broad-except
+            end = _Failure(e)
+        finally:
+            # not delivered once cancelled, the consumer stops on its own then
+            put(end)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    threads.append(thread)
+    thread.start()
+
+    while True:
+        try:
+            item = handover.get(timeout=0.1)
+        except queue.Empty:
+            if cancelled.is_set():
+                return
+            continue
+        if item is _END:
+            break
+        if isinstance(item, _Failure):
+            raise item.error
+        yield item
+
+
+def stream_fingerprints(signal_chunks: Iterable[np.ndarray],
+                        transformator: WaveletTransformator,
+                        fingerprinter: FingerprintGenerator,
+                        file_id: str,
+                        queue_size: int = 4) -> Iterator:
+    """Connects the streaming transform and the fingerprinting of a signal arriving in chunks.
+
+    Args:
+        signal_chunks (Iterable[np.ndarray]): Consecutive preprocessed signal chunks.
+        transformator (WaveletTransformator): Transformator of the CWT transform.
+        fingerprinter (FingerprintGenerator): Fingerprint generator with generate_fingerprint_chunks.
+        file_id (str): ID of the read.
+        queue_size (int, optional): Capacity of the queues between the stages. Defaults to 4.
+
+    Yields:
+        Fingerprints of consecutive parts of the read. Closing the generator stops and joins all stage threads.
+    """
+    cancelled = threading.Event()
+    threads = []
+
+    try:
+        chunks = _threaded(signal_chunks, queue_size, cancelled, threads)
+        coefficients = _threaded(transformator.transform_stream(chunks), queue_size, cancelled, threads)
+        yield from _threaded(fingerprinter.generate_fingerprint_chunks(coefficients, file_id), queue_size,
+                             cancelled, threads)
+    finally:
+        cancelled.set()
+        for thread in threads:
+            thread.join()
+
+
+def classify_stream(signal_chunks: Iterable[np.ndarray],
+                    transformator: WaveletTransformator,
+                    fingerprinter: FingerprintGenerator,
+                    computer: Union[ConstellationSimilarityComputer, LSHSimilarityComputer],
+                    file_id: str = "read",
+                    margin: float = 10.0,
+                    min_fingerprints: int = 0,
+                    top_results: int = 1,
+                    queue_size: int = 4) -> IncrementalSimilarity:
+    """Classifies a signal arriving in chunks, stopping as soon as one reference clearly leads.
+
+    Args:
+        signal_chunks (Iterable[np.ndarray]): Consecutive preprocessed signal chunks.
+        transformator (WaveletTransformator): Transformator of the CWT transform.
+        fingerprinter (FingerprintGenerator): Fingerprint generator matching the reference database.
+        computer (Union[ConstellationSimilarityComputer, LSHSimilarityComputer]): Computer holding the database.
+        file_id (str, optional): ID of the read. Defaults to "read".
+        margin (float, optional): Lead in similarity percentage points needed to stop. Defaults to 10.
+        min_fingerprints (int, optional): Number of read fingerprints needed to stop. Defaults to 0.
+        top_results (int, optional): Number of offsets per reference in the result. Defaults to 1.
+        queue_size (int, optional): Capacity of the queues between the stages. Defaults to 4.
+
+    Returns:
+        IncrementalSimilarity: Similarity of the consumed part of the read, decided tells if it stopped early.
+    """
+    similarity = IncrementalSimilarity(computer, margin, min_fingerprints, top_results)
+    fingerprints = stream_fingerprints(signal_chunks, transformator, fingerprinter, file_id, queue_size)
+
+    try:
+        similarity.consume(fingerprints)
+    finally:
+        fingerprints.close()
+
+    return similarity
+
+
+def classify_file(filename: str,
+                  preprocessor: Preprocessor,
+                  transformator: WaveletTransformator,
+                  fingerprinter: FingerprintGenerator,
+                  computer: Union[ConstellationSimilarityComputer, LSHSimilarityComputer],
+                  chunk_size: int = 4000,
+                  **kwargs) -> IncrementalSimilarity:
+    """Classifies a signal file, reading and preprocessing it in chunks of chunk_size points. The remaining
+    keyword arguments are passed to classify_stream.
+    """
+    file_id = kwargs.pop("file_id", ioutil.extract_file_name(filename))
+    return classify_stream(preprocessor.preprocess_chunks(filename, chunk_size), transformator, fingerprinter,
+                           computer, file_id, **kwargs)
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Streaming classification of signal files",
+                                     epilog="Arguments after -- are pipeline arguments (see thesis.pipeline.pipeline)")
+
+    parser.add_argument('--file', required=True, type=str, nargs='+', help='Signal files to classify')
+    parser.add_argument('--ref', required=True, type=str,
+                        help='File which contains the reference pipeline result, or a reference index directory.')
+    parser.add_argument('--similarity', required=True, type=str,
+                        help='Similarity type to use for comparison (constellation, lsh)')
+    parser.add_argument('--margin', type=float,
+                        help='Lead of the top reference in similarity percentage points needed to stop', default=10.0)
+    parser.add_argument('--min_fingerprints', type=int,
+                        help='Number of read fingerprints needed before stopping', default=0)
+    parser.add_argument('--chunk_size', type=int, help='Number of signal points per chunk', default=4000)
+    parser.add_argument('--queue_size', type=int, help='Capacity of the queues between the stages', default=4)
+    parser.add_argument('--num_tables', type=int,
+                        help='Number of tables to be used for similarity in LSH', default=8)
+    parser.add_argument('--threshold', type=float, help='Threshold for similarity of minhash singature', default=0.5)
+    parser.add_argument('--required_votes', type=int,
+                        help='Number of required votes by the table to vet a vote', default=3)
+    parser.add_argument('--coherency', type=str,
+                        help='Offset coherency counting for constellation similarity (loop, vectorized)',
+                        default=constants.COHERENCY_MODE_LOOP)
+    parser.add_argument('pipeline', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    pipeline_argv = args.pipeline[1:] if args.pipeline[:1] == ["--"] else args.pipeline
+    args.pipeline = pipeline.parse_arguments(["--file", args.file[0]] + pipeline_argv)
+    return args
+
+
+def main():
+    args = parse_arguments()
+    # the fingerprinter only sees one chunk at a time, so no progress output
+    built = pipeline.build_pipeline(args.pipeline, progress=None)
+    if built is None:
+        return
+    preprocessor, transformator, fingerprinter = built
+    computer = build_similarity_computer(args, ioutil.load_reference(args.ref))
+
+    for filename in args.file:
+        similarity = classify_file(filename, preprocessor, transformator, fingerprinter, computer, args.chunk_size,
+                                   margin=args.margin, min_fingerprints=args.min_fingerprints,
+                                   queue_size=args.queue_size)
+
+        logger.info("%s: %s after %d fingerprints (lead %.2f)", filename,
+                    "classified as {}".format(similarity.leader) if similarity.decided else "undecided",
+                    similarity.number_of_fingerprints(), similarity.lead())
+        print(similarity.result())
+
+
+if __name__ == "__main__":
+    main()
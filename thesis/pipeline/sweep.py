@@ -0,0 +1,214 @@
+"""Parameter sweep of the pipeline sharing the preprocessing and CWT between configurations.
+
+Every option of SWEEP_PARAMETERS takes a list of values and the sweep runs the
+pipeline for every combination of them. Instead of running pipeline.py once per
+combination, every signal is preprocessed once per preprocessing, transformed
+once per (preprocessing, wavelet, scale), and per x_size with --num_scales auto,
+and the coefficients are handed to all fingerprinter configurations in memory. The remaining options are pipeline
+options shared by all combinations. Results are saved under the names
+pipeline.py gives them, so a sweep and single runs can be mixed.
+
+    python -m thesis.pipeline.sweep --batch reads/ --continuous_wavelet mexh gaus1 --scale 65 129 \\
+        --window_size 4096 8192 --shift_size 512 1024 --top_wavelets 15 25 --fingerprinting constellation minhash
+"""
+from typing import Dict, Iterator, List, Tuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import itertools
+import os
+import sys
+import time
+
+import numpy as np
+
+from thesis.utils import logging, constants, ioutil
+from thesis.pipeline import pipeline
+
+logger = logging.get_logger(__name__)
+
+# options computed once per signal and shared by every configuration below them
+PREPROCESS_PARAMETERS = ["preprocess"]
+TRANSFORM_PARAMETERS = ["continuous_wavelet", "scale"]
+FINGERPRINT_PARAMETERS = ["fingerprinting", "x_size", "y_size", "window_size", "shift_size", "top_wavelets",
+                          "target_zone_size", "chain_length", "signature_size"]
+SWEEP_PARAMETERS = PREPROCESS_PARAMETERS + TRANSFORM_PARAMETERS + FINGERPRINT_PARAMETERS
+
+STAGES = ["preprocess", "transform", "fingerprint"]
+
+
+def parse_arguments(argv: List[str] = None) -> Tuple[argparse.Namespace, Dict[str, list]]:
+    """Parses the swept options and the shared pipeline options.
+
+    Returns:
+        Tuple[argparse.Namespace, Dict[str, list]]: pipeline options holding the first value of every swept option,
+            and the values of every swept option.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(description="Pipeline parameter sweep", add_help=False)
+    defaults = pipeline.parse_arguments(["--file", "", "--continuous_wavelet", ""])
+
+    for name in SWEEP_PARAMETERS:
+        default = getattr(defaults, name)
+        parser.add_argument('--' + name, type=type(default) if default is not None else str, nargs='+')
+    grid, rest = parser.parse_known_args(argv)
+
+    grid = {name: values for name, values in vars(grid).items() if values is not None}
+    args = pipeline.parse_arguments(rest + list(itertools.chain.from_iterable(
+        ['--' + name, str(values[0])] for name, values in grid.items())))
+    grid = {name: grid.get(name, [getattr(args, name)]) for name in SWEEP_PARAMETERS}
+    args.batch_files = pipeline.collect_batch_files(args.batch) if args.batch is not None else [args.file]
+    return args, grid
+
+
+def _configurations(args: argparse.Namespace, grid: Dict[str, list], names: List[str]
+                    ) -> Iterator[argparse.Namespace]:
+    for values in itertools.product(*(grid[name] for name in names)):
+        configuration = argparse.Namespace(**vars(args))
+        configuration.__dict__.update(zip(names, values))
+        yield configuration
+
+
+def _transform_parameters(args: argparse.Namespace) -> List[str]:
+    # with the number of scales matching x_size every x_size needs its own transform
+    if args.num_scales == constants.NUM_SCALES_AUTO and args.scales is None:
+        return TRANSFORM_PARAMETERS + ["x_size"]
+    return TRANSFORM_PARAMETERS
+
+
+def _fingerprinters(args: argparse.Namespace, grid: Dict[str, list]) -> List[argparse.Namespace]:
+    """Fingerprinter configurations below a transform configuration, combinations which only differ in options
+    their fingerprinting does not use are kept once.
+    """
+    names = [name for name in FINGERPRINT_PARAMETERS if name not in _transform_parameters(args)]
+    configurations = dict()
+    for configuration in _configurations(args, grid, names):
+        name = pipeline._pipeline_result_path(configuration, "")
+        configurations.setdefault(name, configuration)
+    return list(configurations.values())
+
+
+def _signals(args: argparse.Namespace, preprocessor, filename: str) -> Iterator[Tuple[str, np.ndarray]]:
+    if args.multi_read:
+        yield from preprocessor.preprocess_reads(filename, args.read_ids)
+    else:
+        yield args.id or ioutil.extract_file_name(filename), preprocessor.preprocess(filename)
+
+
+def sweep_file(args: argparse.Namespace, grid: Dict[str, list], filename: str) -> Dict[str, List[float]]:
+    """Runs every configuration of the grid on one signal file and saves the results.
+
+    Returns:
+        Dict[str, List[float]]: number of runs and seconds spent in every stage, and the number of
+            (signal, configuration) results.
+    """
+    stats = {stage: [0, 0.0] for stage in STAGES}
+    stats["results"] = [0, 0.0]
+
+    def record(stage, start):
+        stats[stage][0] += 1
+        stats[stage][1] += time.perf_counter() - start
+
+    def timed(stage, function, *arguments):
+        start = time.perf_counter()
+        result = function(*arguments)
+        record(stage, start)
+        return result
+
+    for preprocess_args in _configurations(args, grid, PREPROCESS_PARAMETERS):
+        preprocessor = pipeline.build_preprocessor(preprocess_args)
+        signals = _signals(preprocess_args, preprocessor, filename)
+
+        while True:
+            start = time.perf_counter()
+            read = next(signals, None)
+            if read is None:
+                break
+            # only calls which return a read are runs of the preprocessing
+            record("preprocess", start)
+            file_id, signal = read
+
+            for transform_args in _configurations(preprocess_args, grid, _transform_parameters(args)):
+                configurations = [(c, pipeline._pipeline_result_path(c, file_id))
+                                  for c in _fingerprinters(transform_args, grid)]
+                if args.resume:
+                    configurations = [(c, path) for c, path in configurations if not os.path.isfile(path)]
+                if not configurations:
+                    continue
+
+                # shared by all fingerprinters, so never streamed in blocks
+                coefficients = timed("transform", pipeline.build_transformator(transform_args).transform, signal)
+
+                for configuration, path in configurations:
+                    try:
+                        # workers sweep in parallel, their progress lines would interleave
+                        fingerprinter = pipeline.build_fingerprinter(configuration, progress=None)
+                        result = timed("fingerprint", fingerprinter.generate_fingerprints, coefficients, file_id)
+                    except Exception:       # pylint: disable=broad-except
+                        logger.exception("Configuration %s failed on %s", path, file_id)
+                        continue
+
+                    ioutil.save_pickle(path, result)
+                    stats["results"][0] += 1
+
+    return stats
+
+
+# options and grid of a sweep worker process, set by _init_sweep_worker
+_worker_sweep = None
+
+
+def _init_sweep_worker(args: argparse.Namespace, grid: Dict[str, list]) -> None:
+    global _worker_sweep
+    _worker_sweep = (args, grid)
+
+
+def _sweep_worker_file(filename: str) -> Dict[str, List[float]]:
+    return sweep_file(*_worker_sweep, filename)
+
+
+def report(stats: Dict[str, List[float]]) -> None:
+    """Logs the time spent in every stage and the time a separate pipeline run per result would have spent."""
+    results = stats["results"][0]
+    total_saved = 0.0
+
+    for stage in STAGES:
+        runs, seconds = stats[stage]
+        # separate runs preprocess and transform once for every result
+        separate = seconds / runs * results if runs > 0 else 0.0
+        saved = max(separate - seconds, 0.0) if stage != "fingerprint" else 0.0
+        total_saved += saved
+        logger.info("%-11s %6d runs %10.2f s (%d separate runs %10.2f s, saved %10.2f s)", stage, runs, seconds,
+                    results if stage != "fingerprint" else runs, seconds + saved, saved)
+
+    logger.info("%d results, %.2f s saved against separate pipeline runs", results, total_saved)
+
+
+def main():
+    args, grid = parse_arguments()
+    files = args.batch_files
+    swept = {name: values for name, values in grid.items() if len(values) > 1}
+    logger.info("Sweep over %d files and %s", len(files), swept)
+
+    stats = {stage: [0, 0.0] for stage in STAGES + ["results"]}
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_sweep_worker,
+                             initargs=(args, grid)) as executor:
+        futures = {executor.submit(_sweep_worker_file, f): f for f in files}
+
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                file_stats = future.result()
+            except Exception:       # pylint: disable=broad-except
+                logger.exception("Sweeping %s failed", futures[future])
+                continue
+
+            for stage, (runs, seconds) in file_stats.items():
+                stats[stage][0] += runs
+                stats[stage][1] += seconds
+            logger.info("%d/%d files swept (%s, %d results)", done, len(files), futures[future],
+                        file_stats["results"][0])
+
+    report(stats)
+
+
+if __name__ == "__main__":
+    main()
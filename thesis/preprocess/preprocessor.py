@@ -1,34 +1,103 @@
 from abc import ABC, abstractmethod
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+import os
 
 import numpy as np
 
+from thesis.utils.cache import StageCache
 from thesis.utils.signal_extractor import SignalExtractor
 
 
 class Preprocessor(ABC):
+    """Preprocessing of the signal of a file or a read.
+
+    Args:
+        cache (StageCache, optional): cache of the preprocessed fast5 signals, keyed by the file identity, the read
+            and the preprocessor.
+    """
+
+    def __init__(self, cache: StageCache = None) -> None:
+        self._cache = cache
+
+    def _cached(self, filename: str, compute: Callable[[], Optional[np.ndarray]], read_id: str = None
+                ) -> Optional[np.ndarray]:
+        if self._cache is None:
+            return compute()
+
+        key = StageCache.key("preprocess", self._cache.file_identity(filename),
+                             {"preprocessor": type(self).__name__, "read_id": read_id})
+        return self._cache.get_or_compute(key, compute)
 
     @abstractmethod
     def preprocess(self, filename: str) -> np.ndarray:
         pass
 
+    @abstractmethod
+    def preprocess_read(self, signal_extractor: SignalExtractor) -> np.ndarray:
+        pass
+
+    def preprocess_reads(self, filename: str, read_ids: Iterable[str] = None) -> Iterator[Tuple[str, np.ndarray]]:
+        """Preprocesses every read of a (multi-read) fast5 file using a single file handle.
+
+        Files which are not fast5 files are treated as a single read named after the file.
+
+        Args:
+            filename (str): File which contains the signal.
+            read_ids (Iterable[str], optional): Only reads with these IDs are preprocessed.
+
+        Yields:
+            Tuple[str, np.ndarray]: Read ID and the preprocessed signal of the read.
+        """
+        if not filename.endswith(".fast5"):
+            yield os.path.splitext(os.path.basename(filename))[0], self.preprocess(filename)
+            return
+
+        signal_extractor = SignalExtractor(filename)
+        for read_id, read in signal_extractor.iterate_reads(read_ids):
+            yield read_id, self._cached(filename, lambda: self.preprocess_read(read), read_id)
+
+
+    def preprocess_chunks(self, filename: str, chunk_size: int) -> Iterator[np.ndarray]:
+        """Yields the preprocessed signal in consecutive chunks of chunk_size points.
+
+        The default implementation preprocesses the whole file first, preprocessors which can work on
+        partial signals override it.
+        """
+        signal = self.preprocess(filename)
+        for start in range(0, len(signal), chunk_size):
+            yield signal[start:start + chunk_size]
+
 
 class EmptyPreprocessor(Preprocessor):
 
     def preprocess(self, filename: str) -> np.ndarray:
         if filename.endswith(".fast5"):
-            signal_extractor = SignalExtractor(filename)
-            signal = signal_extractor.get_signal_continuous()
+            signal = self._cached(filename, lambda: self.preprocess_read(SignalExtractor(filename)))
         else:
             signal = np.load(filename)
 
         return signal
 
+    def preprocess_read(self, signal_extractor: SignalExtractor) -> np.ndarray:
+        return signal_extractor.get_signal_continuous()
+
+    def preprocess_chunks(self, filename: str, chunk_size: int) -> Iterator[np.ndarray]:
+        if filename.endswith(".fast5"):
+            yield from SignalExtractor(filename).iterate_signal_chunks(chunk_size)
+            return
+
+        signal = np.load(filename, mmap_mode='r')
+        for start in range(0, len(signal), chunk_size):
+            yield np.array(signal[start:start + chunk_size])
+
 
 class TomboPreprocessor(Preprocessor):
 
     def preprocess(self, filename: str) -> np.ndarray:
         if filename.endswith(".fast5"):
-            signal_extractor = SignalExtractor(filename)
-            return signal_extractor.get_signal_of_means()
+            return self._cached(filename, lambda: self.preprocess_read(SignalExtractor(filename)))
 
         return None
+
+    def preprocess_read(self, signal_extractor: SignalExtractor) -> np.ndarray:
+        return signal_extractor.get_signal_of_means()
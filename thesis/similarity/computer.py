@@ -1,11 +1,16 @@
 
 from collections import defaultdict, Mapping
-from typing import List, Tuple
+from typing import List, Tuple, Union
 
 import numpy as np
 from datasketch import MinHash, MinHashLSH
 
 import thesis.utils.logging as logging
+from thesis.fingerprinting.minhash import MinHashSignatures, parse_window_labels
+from thesis.fingerprinting.packed import PackedFingerprints
+from thesis.similarity.fingerprint_index import FingerprintIndex
+from thesis.similarity.lsh_index import BandedLSHIndex
+from thesis.utils import constants
 
 #logger = logging.get_logger(__name__)
 
@@ -54,13 +59,117 @@ class SimilarityResult(Mapping):
         return self._num_fngp
 
 
+def count_matches(ref_ids: np.ndarray, deltas: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Counts the matches of every (reference, offset difference) pair.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: reference ID, offset difference and number of matches of every
+            distinct pair.
+    """
+    if len(ref_ids) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    ref_ids = np.asarray(ref_ids, dtype=np.int64)
+    deltas = np.asarray(deltas, dtype=np.int64)
+
+    # (reference, offset difference) pairs are encoded as single integer keys and counted
+    smallest = deltas.min()
+    span = int(deltas.max() - smallest) + 1
+    keys = ref_ids * span + (deltas - smallest)
+    if span * (int(ref_ids.max()) + 1) <= 4 * len(keys) + (1 << 20):
+        counts = np.bincount(keys)
+        keys = np.flatnonzero(counts)
+        counts = counts[keys]
+    else:
+        keys, counts = np.unique(keys, return_counts=True)
+
+    return keys // span, keys % span + smallest, counts
+
+
+def top_offsets_of_counts(ref_ids: np.ndarray, deltas: np.ndarray, counts: np.ndarray, names: List[str],
+                          top_results: int) -> dict:
+    """Keeps the most frequent offset differences of every reference, ties broken by the smaller offset difference.
+
+    Args:
+        ref_ids (np.ndarray): reference ID of every distinct (reference, offset difference) pair.
+        deltas (np.ndarray): offset difference of every pair.
+        counts (np.ndarray): number of matches of every pair.
+        names (List[str]): reference name of every reference ID.
+        top_results (int): number of offset differences kept per reference.
+
+    Returns:
+        dict: reference name -> [(offset difference, number of matches)] in descending number of matches.
+    """
+    order = np.lexsort((deltas, -counts, ref_ids))
+    ref_ids, deltas, counts = ref_ids[order], deltas[order], counts[order]
+
+    # rank of every pair within its reference
+    first = np.searchsorted(ref_ids, ref_ids, 'left')
+    keep = np.arange(len(counts)) - first < top_results
+
+    results = dict()
+    for ref_id, delta, count in zip(ref_ids[keep].tolist(), deltas[keep].tolist(), counts[keep].tolist()):
+        results.setdefault(names[ref_id], []).append((delta, count))
+
+    return results
+
+
+def top_offsets_of_matches(ref_ids: np.ndarray, deltas: np.ndarray, names: List[str], top_results: int) -> dict:
+    """Counts the matches of every (reference, offset difference) pair and keeps the most frequent offset
+    differences of every reference, see top_offsets_of_counts.
+    """
+    return top_offsets_of_counts(*count_matches(ref_ids, deltas), names, top_results)
+
+
 class ConstellationSimilarityComputer():
 
-    def __init__(self, database: dict, top_results: int = 1) -> None:
+    def __init__(self, database: Union[dict, PackedFingerprints, FingerprintIndex], top_results: int = 1,
+                 mode: str = constants.COHERENCY_MODE_LOOP) -> None:
+        if mode not in {constants.COHERENCY_MODE_LOOP, constants.COHERENCY_MODE_VECTORIZED}:
+            raise ValueError("Unknown coherency mode {}".format(mode))
+
         self._database = database
         self._top_results = top_results
+        self._mode = mode
+
+        # sorted hash arrays are joined by the vectorized mode and by match, a dictionary database is packed once
+        self._packed = None if isinstance(database, dict) else database
+        if mode == constants.COHERENCY_MODE_VECTORIZED:
+            self._packed_database()
+
+    @property
+    def names(self) -> List[str]:
+        return self._packed_database().names
+
+    def _packed_database(self) -> Union[PackedFingerprints, FingerprintIndex]:
+        if self._packed is None:
+            self._packed = PackedFingerprints.from_dict(self._database)
+        return self._packed
+
+    def match(self, read: Union[dict, PackedFingerprints]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Matches the read fingerprints with the database.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: reference ID and offset difference of every match, and the
+                distinct fingerprint hashes of the read.
+        """
+        read = self._pack_read(read)
+        ref_ids, deltas = self._match_pairs(read)
+        return ref_ids, deltas, np.unique(read.hashes)
+
+    def compute_similarity(self, read: Union[dict, PackedFingerprints]) -> SimilarityResult:
+        if self._mode == constants.COHERENCY_MODE_VECTORIZED:
+            ref_ids, deltas, hashes = self.match(read)
+            return SimilarityResult(top_offsets_of_matches(ref_ids, deltas, self.names, self._top_results),
+                                    len(hashes))
+
+        # packed fingerprints and the memory-mapped index share the sorted hash lookup
+        if not isinstance(self._database, dict):
+            return self._compute_packed_similarity(self._pack_read(read))
+
+        if isinstance(read, PackedFingerprints):
+            read = read.to_dict()
 
-    def compute_similarity(self,  read: dict) -> SimilarityResult:
         coherency_counter = defaultdict(lambda: defaultdict(lambda: 0))
         fngp_count = len(read)
 
@@ -89,70 +198,160 @@ class ConstellationSimilarityComputer():
 
         print("{}/{}".format(fngp_solved, fngp_solved))
 
+        return SimilarityResult(self._top_offsets(coherency_counter), fngp_count)
+
+    def _pack_read(self, read: Union[dict, PackedFingerprints]) -> PackedFingerprints:
+        layout = self._packed_database().layout
+        if not isinstance(read, PackedFingerprints):
+            return PackedFingerprints.from_dict(read, layout)
+
+        if read.layout != layout:
+            raise ValueError("Read layout {} does not match the database layout {}".format(read.layout, layout))
+        return read
+
+    def _match_pairs(self, read: PackedFingerprints) -> Tuple[np.ndarray, np.ndarray]:
+        """Joins the read with the database on the fingerprint hashes.
+
+        Every database entry is paired with every read entry of the same hash, all pairs are expanded at once
+        from the matching hash ranges.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: reference ID and offset difference (database offset - read offset) of
+                every matching pair.
+        """
+        database = self._packed_database()
+        unique, read_starts, read_counts = np.unique(read.hashes, return_index=True, return_counts=True)
+        db_starts, db_stops = database.lookup(unique)
+        db_counts = db_stops - db_starts
+
+        # database entry of every match, one per database entry of every matching hash
+        groups = np.repeat(np.arange(len(unique)), db_counts)
+        entries = np.arange(db_counts.sum()) - np.repeat(np.cumsum(db_counts) - db_counts, db_counts) + \
+            np.repeat(db_starts, db_counts)
+
+        # every database entry is paired with each read entry of its hash
+        repeats = read_counts[groups]
+        db_entries = np.repeat(entries, repeats)
+        read_entries = np.arange(repeats.sum()) - np.repeat(np.cumsum(repeats) - repeats, repeats) + \
+            np.repeat(read_starts[groups], repeats)
+
+        deltas = database.offsets[db_entries].astype(np.int64) - read.offsets[read_entries].astype(np.int64)
+        return database.ref_ids[db_entries], deltas
+
+    def _compute_packed_similarity(self, read: PackedFingerprints) -> SimilarityResult:
+        coherency_counter = defaultdict(lambda: defaultdict(lambda: 0))
+
+        # entries of equal hashes are adjacent in both the read and the database
+        database = self._packed_database()
+        unique, read_starts, read_counts = np.unique(read.hashes, return_index=True, return_counts=True)
+        db_starts, db_stops = database.lookup(unique)
+
+        for i in np.flatnonzero(db_stops > db_starts):
+            read_offsets = read.offsets[read_starts[i]:read_starts[i] + read_counts[i]].astype(np.int64)
+            db_offsets = self._database.offsets[db_starts[i]:db_stops[i]].astype(np.int64)
+            db_ref_ids = self._database.ref_ids[db_starts[i]:db_stops[i]]
+
+            for db_offset, ref_id in zip(db_offsets, db_ref_ids):
+                counter = coherency_counter[self._database.names[ref_id]]
+                for read_offset in read_offsets:
+                    counter[int(db_offset - read_offset)] += 1
+
+        return SimilarityResult(self._top_offsets(coherency_counter), len(unique))
+
+    def _top_offsets(self, coherency_counter: dict) -> dict:
         top_results = dict()
         for key, value in coherency_counter.items():
             results = sorted(value.items(), key=lambda x: x[1], reverse=True)[:self._top_results]
 
             top_results[key] = results
 
-        return SimilarityResult(top_results, fngp_count)
+        return top_results
 
 
 class LSHSimilarityComputer():
 
-    def __init__(self, minhashes: List[Tuple[MinHash, str]], num_tables: int = 8, threshold: float = 0.5, required_votes: int = 3,
+    def __init__(self, minhashes: Union[List[Tuple[MinHash, str]], MinHashSignatures, BandedLSHIndex], num_tables: int = 8, threshold: float = 0.5, required_votes: int = 3,
                  top_results: int = 1):
         self._num_tables = num_tables
         self._threshold = threshold
         self._required_votes = required_votes
         self._top_results = top_results
+
+        # native signatures are indexed in a banded bucket table instead of datasketch, a saved index is used as is
+        self._index = None
+        if isinstance(minhashes, BandedLSHIndex):
+            self._index = minhashes
+            self._num_tables, self._threshold = minhashes.num_tables, minhashes.threshold
+            return
+        if isinstance(minhashes, MinHashSignatures):
+            self._index = BandedLSHIndex.build(minhashes, num_tables, threshold)
+            return
+
         if len(minhashes[0][0].digest()) % num_tables != 0:
             raise Exception("Minhash signature not compatible with number of tables")
 
+        # labels are parsed once, the tables are keyed by the window index
+        self._ref_ids, self._offsets, self._names = parse_window_labels([idx for _, idx in minhashes])
         self._database = [MinHashLSH(threshold=self._threshold, num_perm=len(minhashes[0][0]) // num_tables)
                           for i in range(num_tables)]
 
-        for minhash, idx in minhashes:
+        for window, (minhash, _) in enumerate(minhashes):
             digests = self._separate_digest(minhash.digest(), self._num_tables)
 
             for i, digest in enumerate(digests):
                 m = MinHash(hashvalues=digest)
-                self._database[i].insert(idx, m)
+                self._database[i].insert(window, m)
 
     def _separate_digest(self, digest: np.ndarray, num_parts: int) -> List[np.ndarray]:
         return np.array_split(digest, num_parts)
 
-    def _extract_id_offset(self, label: str) -> Tuple[str, int]:
-        parts = label.split(":")
-        return parts[0], int(parts[1])
-
-    def compute_similarity(self, read: List[Tuple[MinHash, str]]) -> SimilarityResult:
-        coherency_counter = defaultdict(lambda: defaultdict(lambda: 0))
-
-        for minhash, idx in read:
-            _, read_offset = self._extract_id_offset(idx)
-            #print("read_offset", read_offset)
-
-            digests = self._separate_digest(minhash.digest(), len(self._database))
-            #print("digests", digests)
-
-            candidates = defaultdict(lambda: 0)
-            for i, digest in enumerate(digests):
-                query_minhash = MinHash(hashvalues=digest)
-                votes = self._database[i].query(query_minhash)
-                #print("votes", votes)
-                for v in votes:
-                    candidates[v] += 1
-
-            for i, v in filter(lambda x: x[1] >= self._required_votes, candidates.items()):
-                vote_id, vote_offset = self._extract_id_offset(i)
-                coherency_counter[vote_id][vote_offset - read_offset] += 1
-
-        #print("Coherency counter", coherency_counter)
-        top_results = dict()
-        for key, value in coherency_counter.items():
-            results = sorted(value.items(), key=lambda x: x[1], reverse=True)[:self._top_results]
-
-            top_results[key] = results
-
-        return SimilarityResult(top_results, len(read))
+    @property
+    def names(self) -> List[str]:
+        return self._index.names if self._index is not None else self._names
+
+    def match(self, read: Union[List[Tuple[MinHash, str]], MinHashSignatures]
+              ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Matches the read windows with the database.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: reference ID and offset difference of every voted match, and
+                the offsets of the read windows.
+        """
+        if self._index is not None:
+            return self._match_index(read)
+
+        if isinstance(read, MinHashSignatures):
+            digests, read_offsets = read.signatures.astype(np.uint64), read.offsets
+        else:
+            digests = [minhash.digest() for minhash, _ in read]
+            _, read_offsets, _ = parse_window_labels([idx for _, idx in read])
+
+        # every table votes at most once for a (read window, database window) pair
+        read_windows, windows = [], []
+        for read_window, digest in enumerate(digests):
+            for i, part in enumerate(self._separate_digest(digest, len(self._database))):
+                votes = self._database[i].query(MinHash(hashvalues=part))
+                read_windows.extend([read_window] * len(votes))
+                windows.extend(votes)
+
+        pairs, counts = np.unique(np.array(read_windows, dtype=np.int64) * len(self._offsets) +
+                                  np.array(windows, dtype=np.int64), return_counts=True)
+        pairs = pairs[counts >= self._required_votes]
+        read_windows, windows = pairs // len(self._offsets), pairs % len(self._offsets)
+
+        deltas = self._offsets[windows].astype(np.int64) - read_offsets[read_windows].astype(np.int64)
+        return self._ref_ids[windows], deltas, np.asarray(read_offsets)
+
+    def compute_similarity(self, read: Union[List[Tuple[MinHash, str]], MinHashSignatures]) -> SimilarityResult:
+        ref_ids, deltas, _ = self.match(read)
+        return SimilarityResult(top_offsets_of_matches(ref_ids, deltas, self.names, self._top_results), len(read))
+
+    def _match_index(self, read: Union[List[Tuple[MinHash, str]], MinHashSignatures]
+                     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if not isinstance(read, MinHashSignatures):
+            read = MinHashSignatures.from_minhashes(read)
+
+        read_windows, windows = self._index.query(read, self._required_votes)
+        deltas = self._index.offsets[windows].astype(np.int64) - read.offsets[read_windows].astype(np.int64)
+
+        return self._index.ref_ids[windows], deltas, read.offsets
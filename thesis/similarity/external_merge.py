@@ -0,0 +1,390 @@
+"""Out-of-core merge of per-reference pipeline results into reference indexes.
+
+merge_dicts.py and merge_lists.py hold every input and the merged database in
+memory at once. This merge only ever holds one input per worker process:
+
+    1. spill    every input is loaded, packed and written as runs of at most a fixed
+                number of entries into a temporary directory, the runs are then packed
+                into the layout of all inputs and sorted, both in parallel
+    2. merge    the runs of all inputs are k-way merged block by block straight into
+                the .npy arrays of a FingerprintIndex or BandedLSHIndex directory
+
+Reference IDs are remapped to one global name table in input order, and ties
+between equal hashes keep the input order, so the result is the index
+fingerprint_index.build_index or BandedLSHIndex.build would build in memory.
+--memory bounds the run and block sizes, a single input pickle still has to fit
+into the memory of its worker.
+
+    python -m thesis.similarity.external_merge constellation reference_index/ pipeline_*_constellation_*.p
+    python -m thesis.similarity.external_merge lsh reference_lsh/ pipeline_*_minhash_*.p --num_tables 8
+"""
+from typing import Callable, Iterator, List, Sequence, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import os
+import pickle as pp
+import tempfile
+
+import numpy as np
+
+from thesis.fingerprinting.packed import FingerprintLayout, PackedFingerprints
+from thesis.similarity.fingerprint_index import FingerprintIndex
+from thesis.similarity.lsh_index import BandedLSHIndex, band_keys, load_signatures, optimal_band_parameters
+from thesis.utils import logging
+
+logger = logging.get_logger(__name__)
+
+# approximate peak bytes per entry while spilling and merging, used to turn the memory limit into run and
+# block sizes
+_SPILL_BYTES = {"constellation": 160, "lsh": 64}
+_MERGE_BYTES = 64
+
+
+class _ArrayWriter():
+    """Appends blocks to a raw file and turns it into an .npy array once the length is known."""
+
+    def __init__(self, path: str, dtype) -> None:
+        self._path = path
+        self._dtype = np.dtype(dtype)
+        self._raw = open(path + ".raw", "wb")
+        self._length = 0
+
+    def append(self, values: np.ndarray) -> None:
+        values = np.ascontiguousarray(values, dtype=self._dtype)
+        self._raw.write(values.tobytes())
+        self._length += len(values)
+
+    def close(self, block_size: int) -> None:
+        self._raw.close()
+        array = np.lib.format.open_memmap(self._path, mode="w+", dtype=self._dtype, shape=(self._length,))
+        if self._length > 0:
+            raw = np.memmap(self._path + ".raw", dtype=self._dtype, mode="r", shape=(self._length,))
+            for start in range(0, self._length, block_size):
+                array[start:start + block_size] = raw[start:start + block_size]
+            del raw
+        array.flush()
+        del array
+        os.remove(self._path + ".raw")
+
+
+def _save_run(prefix: str, **arrays: np.ndarray) -> None:
+    for name, values in arrays.items():
+        np.save("{}_{}.npy".format(prefix, name), values)
+
+
+def _open_run(prefix: str, names: Sequence[str]) -> List[np.ndarray]:
+    if os.path.isdir(prefix):
+        return [np.load(os.path.join(prefix, name + ".npy"), mmap_mode="r") for name in names]
+    return [np.load("{}_{}.npy".format(prefix, name), mmap_mode="r") for name in names]
+
+
+def merge_runs(runs: Sequence[Tuple[np.ndarray, ...]], block_size: int
+               ) -> Iterator[Tuple[np.ndarray, List[np.ndarray], np.ndarray]]:
+    """K-way merges runs sorted by their first array.
+
+    At most block_size entries of every run are read at a time. All entries up to the smallest last key of the
+    blocks are merged and yielded, entries with equal keys keep the order of the runs.
+
+    Args:
+        runs (Sequence[Tuple[np.ndarray, ...]]): sorted keys and parallel payload arrays of every run.
+        block_size (int): number of entries read from a run at a time.
+
+    Yields:
+        Tuple[np.ndarray, List[np.ndarray], np.ndarray]: next merged keys, their payload arrays and the index of the
+            run of every entry.
+    """
+    positions = [0] * len(runs)
+
+    while True:
+        active = [i for i, run in enumerate(runs) if positions[i] < len(run[0])]
+        if not active:
+            return
+
+        stops = {i: min(positions[i] + block_size, len(runs[i][0])) for i in active}
+        # runs whose block does not reach their end limit the entries which are final, an entry equal to the
+        # limit is only final in the limiting run and the runs before it
+        limits = [(runs[i][0][stops[i] - 1], i) for i in active if stops[i] < len(runs[i][0])]
+        cutoff, limiting = min(limits) if limits else (None, None)
+
+        pieces, sources = [], []
+        for i in active:
+            keys = runs[i][0][positions[i]:stops[i]]
+            if cutoff is None:
+                take = len(keys)
+            else:
+                take = int(np.searchsorted(keys, cutoff, "right" if i <= limiting else "left"))
+            if take > 0:
+                pieces.append([np.asarray(array[positions[i]:positions[i] + take]) for array in runs[i]])
+                sources.append(np.full(take, i, dtype=np.int64))
+                positions[i] += take
+
+        order = np.argsort(np.concatenate([piece[0] for piece in pieces]), kind="stable")
+        merged = [np.concatenate([piece[k] for piece in pieces])[order] for k in range(len(runs[active[0]]))]
+        yield merged[0], merged[1:], np.concatenate(sources)[order]
+
+
+def _write_postings(merged: Iterator[Tuple[np.ndarray, List[np.ndarray], np.ndarray]],
+                    keys: _ArrayWriter, bounds: _ArrayWriter,
+                    payload: Callable[[List[np.ndarray], np.ndarray], None]) -> None:
+    """Writes the unique keys and the postings bounds of merged blocks, payload writes the postings."""
+    previous, position = None, 0
+
+    for block, arrays, sources in merged:
+        first = np.ones(len(block), dtype=bool)
+        first[1:] = block[1:] != block[:-1]
+        if previous is not None:
+            first[0] = block[0] != previous
+
+        keys.append(block[first])
+        bounds.append(position + np.flatnonzero(first))
+        payload(arrays, sources)
+        previous, position = block[-1], position + len(block)
+
+    bounds.append([position])
+
+
+def _global_names(inputs: Sequence[dict]) -> Tuple[List[str], List[np.ndarray]]:
+    """Global name table in input order and the local to global reference ID mapping of every input."""
+    names = dict()
+    mappings = [np.array([names.setdefault(name, len(names)) for name in spilled["names"]], dtype=np.uint32)
+                for spilled in inputs]
+    return list(names), mappings
+
+
+def _remap(ref_ids: np.ndarray, sources: np.ndarray, run_mappings: Sequence[np.ndarray]) -> np.ndarray:
+    """Maps the local reference IDs of merged entries to global IDs through the mapping of their run."""
+    remapped = np.empty_like(ref_ids)
+    for i in np.unique(sources):
+        mask = sources == i
+        remapped[mask] = run_mappings[i][ref_ids[mask]]
+    return remapped
+
+
+def _spill_fingerprints(path: str, directory: str, number: int, run_size: int) -> dict:
+    """Spills a constellation pipeline result (dictionary or packed) into runs. Runs of packed results are sorted by
+    hash, runs of dictionaries keep the dictionary order until _sort_run sorts them.
+    """
+    with open(path, "rb") as handle:
+        reference = pp.load(handle)
+
+    runs = []
+
+    def spill(hashes, offsets, ref_ids):
+        prefix = os.path.join(directory, "run_{}_{}".format(number, len(runs)))
+        _save_run(prefix, hashes=hashes, offsets=offsets, ref_ids=ref_ids)
+        runs.append(prefix)
+
+    if isinstance(reference, PackedFingerprints):
+        layout, names = reference.layout, reference.names
+        for start in range(0, len(reference), run_size):
+            spill(reference.hashes[start:start + run_size], reference.offsets[start:start + run_size],
+                  reference.ref_ids[start:start + run_size])
+    else:
+        layout = PackedFingerprints.from_dict({k: [] for k in reference if k != "params"}).layout
+        names = dict()
+        rows, offsets, ref_ids = [], [], []
+
+        for fingerprint, postings in reference.items():
+            if fingerprint == "params":
+                continue
+            for offset, name in postings:
+                rows.append(fingerprint)
+                offsets.append(offset)
+                ref_ids.append(names.setdefault(name, len(names)))
+
+            if len(rows) >= run_size:
+                spill(layout.pack(rows), np.array(offsets, dtype=np.uint32), np.array(ref_ids, dtype=np.uint32))
+                rows, offsets, ref_ids = [], [], []
+
+        if rows:
+            spill(layout.pack(rows), np.array(offsets, dtype=np.uint32), np.array(ref_ids, dtype=np.uint32))
+        names = list(names)
+
+    return {"layout": layout, "names": names, "runs": runs, "sorted": isinstance(reference, PackedFingerprints)}
+
+
+def _sort_run(prefix: str, source: FingerprintLayout, layout: FingerprintLayout) -> None:
+    """Repacks the hashes of a run into the layout of all inputs and sorts the run by them.
+
+    Saturating the deltas to fewer bits can make distinct hashes equal and change their order, so the run is sorted
+    after repacking. The sort is stable and dictionary runs are still in dictionary order, so equal hashes end up in
+    the order build_index gives them.
+    """
+    hashes, offsets, ref_ids = [np.load("{}_{}.npy".format(prefix, name)) for name in ["hashes", "offsets", "ref_ids"]]
+    if source != layout:
+        hashes = layout.pack(source.unpack(hashes))
+    order = np.argsort(hashes, kind="stable")
+    _save_run(prefix, hashes=hashes[order], offsets=offsets[order], ref_ids=ref_ids[order])
+
+
+def merge_fingerprints(paths: Sequence[str], destination: str, memory: int = 1024, workers: int = 1,
+                       temporary: str = None) -> FingerprintIndex:
+    """Merges constellation pipeline results into a FingerprintIndex directory.
+
+    Args:
+        paths (Sequence[str]): pickled fingerprint dictionaries or packed fingerprints.
+        destination (str): directory of the index.
+        memory (int, optional): memory limit in MB for the runs and merge blocks. Defaults to 1024.
+        workers (int, optional): number of inputs spilled in parallel. Defaults to 1.
+        temporary (str, optional): directory of the temporary runs. Defaults to the system temporary directory.
+
+    Returns:
+        FingerprintIndex: the merged index, opened memory mapped.
+    """
+    run_size = max(1, (memory << 20) // (workers * _SPILL_BYTES["constellation"]))
+
+    with tempfile.TemporaryDirectory(dir=temporary) as directory:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            inputs = list(executor.map(_spill_fingerprints, paths, [directory] * len(paths), range(len(paths)),
+                                       [run_size] * len(paths)))
+            logger.info("Spilled %d inputs into %d runs", len(inputs), sum(len(i["runs"]) for i in inputs))
+
+            if len({spilled["layout"].chain_length for spilled in inputs}) > 1:
+                raise ValueError("Cannot merge fingerprints with different chain lengths")
+            # the widest frequency bins hold the fingerprints of all inputs
+            layout = max((spilled["layout"] for spilled in inputs), key=lambda l: l.freq_bits)
+            sorts = [(prefix, spilled["layout"]) for spilled in inputs
+                     if not spilled["sorted"] or spilled["layout"] != layout for prefix in spilled["runs"]]
+            list(executor.map(_sort_run, [prefix for prefix, _ in sorts], [source for _, source in sorts],
+                              [layout] * len(sorts)))
+
+        names, mappings = _global_names(inputs)
+        prefixes = [(prefix, number) for number, spilled in enumerate(inputs) for prefix in spilled["runs"]]
+        runs = [_open_run(prefix, ["hashes", "offsets", "ref_ids"]) for prefix, _ in prefixes]
+        run_mappings = [mappings[number] for _, number in prefixes]
+        block_size = max(1, (memory << 20) // (max(len(runs), 1) * _MERGE_BYTES))
+
+        os.makedirs(destination, exist_ok=True)
+        writers = {name: _ArrayWriter(os.path.join(destination, name + ".npy"), dtype) for name, dtype in
+                   [("hashes", np.uint64), ("bounds", np.int64), ("offsets", np.uint32), ("ref_ids", np.uint32)]}
+
+        def write(arrays, sources):
+            offsets, ref_ids = arrays
+            writers["offsets"].append(offsets)
+            writers["ref_ids"].append(_remap(ref_ids, sources, run_mappings))
+
+        _write_postings(merge_runs(runs, block_size), writers["hashes"], writers["bounds"], write)
+        del runs
+        for writer in writers.values():
+            writer.close(block_size)
+
+    index = FingerprintIndex(*_open_run(destination, ["hashes", "bounds", "offsets", "ref_ids"]), names, layout)
+    index.save_meta(destination)
+    return index
+
+
+def _spill_signatures(path: str, directory: str, number: int, run_size: int, num_tables: int,
+                      threshold: float) -> dict:
+    """Spills the band keys of a MinHash pipeline result (native or datasketch) into runs sorted by key."""
+    with open(path, "rb") as handle:
+        database = load_signatures([pp.load(handle)])
+
+    if database.signature_size % num_tables != 0:
+        raise ValueError("Minhash signature not compatible with number of tables")
+    bands, rows = optimal_band_parameters(threshold, database.signature_size // num_tables)
+    windows = max(1, run_size // (num_tables * bands))
+
+    prefix = os.path.join(directory, "windows_{}".format(number))
+    _save_run(prefix, offsets=database.offsets, ref_ids=database.ref_ids)
+
+    runs = []
+    for start in range(0, len(database), windows):
+        keys = band_keys(database.signatures[start:start + windows], num_tables, bands, rows).ravel()
+        order = np.argsort(keys, kind="stable")
+        runs.append(os.path.join(directory, "run_{}_{}".format(number, len(runs))))
+        _save_run(runs[-1], keys=keys[order], postings=start + (order // (num_tables * bands)).astype(np.int64))
+
+    return {"names": database.names, "windows": prefix, "runs": runs, "length": len(database),
+            "parameters": (database.engine, database.seed, database.signature_size, bands, rows)}
+
+
+def merge_signatures(paths: Sequence[str], destination: str, num_tables: int = 8, threshold: float = 0.5,
+                     memory: int = 1024, workers: int = 1, temporary: str = None) -> BandedLSHIndex:
+    """Merges MinHash pipeline results into a BandedLSHIndex directory.
+
+    Args:
+        paths (Sequence[str]): pickled native signatures or datasketch (MinHash, "name:offset") lists.
+        destination (str): directory of the index.
+        num_tables (int, optional): number of tables to be used for similarity in LSH. Defaults to 8.
+        threshold (float, optional): threshold for similarity of minhash signatures. Defaults to 0.5.
+        memory (int, optional): memory limit in MB for the runs and merge blocks. Defaults to 1024.
+        workers (int, optional): number of inputs spilled in parallel. Defaults to 1.
+        temporary (str, optional): directory of the temporary runs. Defaults to the system temporary directory.
+
+    Returns:
+        BandedLSHIndex: the merged index, opened memory mapped.
+    """
+    run_size = max(1, (memory << 20) // (workers * _SPILL_BYTES["lsh"]))
+
+    with tempfile.TemporaryDirectory(dir=temporary) as directory:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            inputs = list(executor.map(_spill_signatures, paths, [directory] * len(paths), range(len(paths)),
+                                       [run_size] * len(paths), [num_tables] * len(paths),
+                                       [threshold] * len(paths)))
+        logger.info("Spilled %d inputs into %d runs", len(inputs), sum(len(i["runs"]) for i in inputs))
+
+        if len({spilled["parameters"] for spilled in inputs}) > 1:
+            raise ValueError("Cannot merge signatures of different hash permutations")
+        engine, seed, signature_size, bands, rows = inputs[0]["parameters"]
+
+        names, mappings = _global_names(inputs)
+        bases = np.cumsum([0] + [spilled["length"] for spilled in inputs])
+        prefixes = [(prefix, number) for number, spilled in enumerate(inputs) for prefix in spilled["runs"]]
+        runs = [_open_run(prefix, ["keys", "postings"]) for prefix, _ in prefixes]
+        run_bases = np.array([bases[number] for _, number in prefixes], dtype=np.int64)
+        block_size = max(1, (memory << 20) // (max(len(runs), 1) * _MERGE_BYTES))
+
+        os.makedirs(destination, exist_ok=True)
+        writers = {name: _ArrayWriter(os.path.join(destination, name + ".npy"), dtype) for name, dtype in
+                   [("keys", np.uint64), ("bounds", np.int64), ("postings", np.int64), ("offsets", np.uint32),
+                    ("ref_ids", np.uint32)]}
+
+        def write(arrays, sources):
+            writers["postings"].append(arrays[0] + run_bases[sources])
+
+        _write_postings(merge_runs(runs, block_size), writers["keys"], writers["bounds"], write)
+        del runs
+
+        for spilled, mapping in zip(inputs, mappings):
+            offsets, ref_ids = _open_run(spilled["windows"], ["offsets", "ref_ids"])
+            for start in range(0, len(offsets), block_size):
+                writers["offsets"].append(offsets[start:start + block_size])
+                writers["ref_ids"].append(mapping[ref_ids[start:start + block_size]])
+            del offsets, ref_ids
+
+        for writer in writers.values():
+            writer.close(block_size)
+
+    index = BandedLSHIndex(*_open_run(destination, ["keys", "bounds", "postings", "offsets", "ref_ids"]), names,
+                           num_tables, threshold, bands, rows, signature_size, seed, engine)
+    index.save_meta(destination)
+    return index
+
+
+def parse_arguments() -> argparse.PARSER:
+    parser = argparse.ArgumentParser(description="Out-of-core merge of pipeline results into a reference index")
+
+    parser.add_argument('type', choices=['constellation', 'lsh'], help='Type of the pipeline results and the index')
+    parser.add_argument('destination', type=str, help='Directory of the index')
+    parser.add_argument('inputs', type=str, nargs='+', help='Pipeline result pickles of the references')
+    parser.add_argument('--memory', type=int, help='Memory limit in MB for the sorted runs and merge blocks',
+                        default=1024)
+    parser.add_argument('--workers', type=int, help='Number of inputs spilled in parallel', default=1)
+    parser.add_argument('--tmp_dir', type=str, help='Directory of the temporary sorted runs')
+    parser.add_argument('--num_tables', type=int, help='Number of tables to be used for similarity in LSH', default=8)
+    parser.add_argument('--threshold', type=float, help='Threshold for similarity of minhash singature', default=0.5)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.type == 'constellation':
+        index = merge_fingerprints(args.inputs, args.destination, args.memory, args.workers, args.tmp_dir)
+    else:
+        index = merge_signatures(args.inputs, args.destination, args.num_tables, args.threshold, args.memory,
+                                 args.workers, args.tmp_dir)
+    logger.info("Merged %d entries of %d references into %s", len(index), len(index.names), args.destination)
+
+
+if __name__ == "__main__":
+    main()
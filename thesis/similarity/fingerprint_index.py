@@ -0,0 +1,141 @@
+"""Memory-mapped reference index of packed constellation fingerprints.
+
+An index is a directory with a meta.json description and one .npy file per array:
+
+    hashes.npy    sorted unique uint64 fingerprint hashes
+    bounds.npy    int64 postings offsets, the postings of hashes[i] are [bounds[i], bounds[i + 1])
+    offsets.npy   uint32 anchor offset of every posting
+    ref_ids.npy   uint32 reference ID of every posting
+
+The arrays are opened with np.load(mmap_mode='r'), so opening an index only reads
+meta.json and concurrent processes share the page cache. Indexes are built from
+merge_dicts.py output or directly from pipeline results:
+
+    python -m thesis.similarity.fingerprint_index reference_index/ reference_database.p
+    python -m thesis.similarity.fingerprint_index reference_index/ pipeline_*_constellation_*.p
+"""
+from typing import List, Tuple, Union
+import argparse
+import json
+import os
+import pickle as pp
+
+import numpy as np
+
+from thesis.fingerprinting.packed import FingerprintLayout, PackedFingerprints
+
+META_FILE = "meta.json"
+
+INDEX_TYPE = "constellation"
+
+_ARRAYS = ["hashes", "bounds", "offsets", "ref_ids"]
+
+
+class FingerprintIndex():
+    """Sorted hash index with the lookup interface of PackedFingerprints.
+
+    Attributes:
+        hashes (np.ndarray): sorted unique uint64 fingerprint hashes.
+        bounds (np.ndarray): postings offsets of every hash.
+        offsets (np.ndarray): uint32 anchor offset of every posting.
+        ref_ids (np.ndarray): uint32 reference ID of every posting.
+        names (List[str]): reference name of every reference ID.
+        layout (FingerprintLayout): bit layout of the hashes.
+    """
+
+    def __init__(self, hashes: np.ndarray, bounds: np.ndarray, offsets: np.ndarray, ref_ids: np.ndarray,
+                 names: List[str], layout: FingerprintLayout) -> None:
+        self.hashes = hashes
+        self.bounds = bounds
+        self.offsets = offsets
+        self.ref_ids = ref_ids
+        self.names = names
+        self.layout = layout
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    @classmethod
+    def from_packed(cls, packed: PackedFingerprints) -> "FingerprintIndex":
+        hashes, starts = np.unique(packed.hashes, return_index=True)
+        return cls(hashes, np.append(starts, len(packed.hashes)).astype(np.int64), packed.offsets, packed.ref_ids,
+                   packed.names, packed.layout)
+
+    def lookup(self, hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Finds the range of postings matching every query hash.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: start and stop index into the postings for every query hash, equal for
+                hashes which are not present.
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if len(self.hashes) == 0:
+            return np.zeros(len(hashes), dtype=np.int64), np.zeros(len(hashes), dtype=np.int64)
+
+        positions = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+        found = self.hashes[positions] == hashes
+        starts = np.asarray(self.bounds[positions])
+        return starts, np.where(found, self.bounds[positions + 1], starts)
+
+    def save(self, directory: str) -> None:
+        """Writes the index into the directory, which is created if needed."""
+        os.makedirs(directory, exist_ok=True)
+        for name in _ARRAYS:
+            np.save(os.path.join(directory, name + ".npy"), getattr(self, name))
+        self.save_meta(directory)
+
+    def save_meta(self, directory: str) -> None:
+        """Writes only the meta.json description, for arrays written into the directory by other means."""
+        meta = {
+            "type": INDEX_TYPE,
+            "names": self.names,
+            "layout": {
+                "chain_length": self.layout.chain_length,
+                "freq_bits": self.layout.freq_bits,
+                "delta_bits": self.layout.delta_bits,
+            },
+        }
+        with open(os.path.join(directory, META_FILE), "w") as handle:
+            json.dump(meta, handle)
+
+    @classmethod
+    def open(cls, directory: str) -> "FingerprintIndex":
+        """Opens a saved index, the arrays are memory mapped read-only."""
+        with open(os.path.join(directory, META_FILE)) as handle:
+            meta = json.load(handle)
+        if meta.get("type") != INDEX_TYPE:
+            raise ValueError("{} is not a constellation fingerprint index".format(directory))
+
+        arrays = [np.load(os.path.join(directory, name + ".npy"), mmap_mode='r') for name in _ARRAYS]
+        return cls(*arrays, meta["names"], FingerprintLayout(**meta["layout"]))
+
+
+def build_index(references: List[Union[dict, PackedFingerprints]]) -> FingerprintIndex:
+    """Builds an index from fingerprint dictionaries or packed fingerprints of one or more references."""
+    layout = next((r.layout for r in references if isinstance(r, PackedFingerprints)), None)
+    if layout is None:
+        # dictionaries share the layout of the largest frequency bin among all of them
+        layout = max((PackedFingerprints.from_dict({k: [] for k in r if k != "params"}).layout for r in references),
+                     key=lambda l: l.freq_bits)
+
+    packed = [r if isinstance(r, PackedFingerprints) else PackedFingerprints.from_dict(r, layout) for r in references]
+    return FingerprintIndex.from_packed(packed[0] if len(packed) == 1 else PackedFingerprints.concatenate(packed))
+
+
+def parse_arguments() -> argparse.PARSER:
+    parser = argparse.ArgumentParser(description="Builds a memory-mapped constellation reference index")
+
+    parser.add_argument('destination', type=str, help='Directory of the index')
+    parser.add_argument('inputs', type=str, nargs='+',
+                        help='Reference database or pipeline result pickles (dictionary or packed)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    references = [pp.load(open(path, 'rb')) for path in args.inputs]
+    build_index(references).save(args.destination)
+
+
+if __name__ == "__main__":
+    main()
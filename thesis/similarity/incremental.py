@@ -0,0 +1,126 @@
+"""Incremental similarity of reads whose fingerprints arrive in chunks.
+
+The offset-coherency counts of all chunks seen so far are kept per (reference,
+offset difference). After every chunk the similarity of every reference, the
+percentage of read fingerprints supporting its best offset, is compared between
+the leading reference and the runner-up. This lead is the "subsequent
+difference" analyse_results.find_subsequent_difference computes offline from the
+saved results, and classification stops once it reaches the margin.
+"""
+from typing import Iterable, Optional, Union
+
+import numpy as np
+
+from thesis.similarity.computer import ConstellationSimilarityComputer, LSHSimilarityComputer, SimilarityResult, \
+    count_matches, top_offsets_of_counts
+
+# (reference, offset difference) pairs are kept as single integer keys, offset differences of uint32 offsets fit
+# into the lower bits once shifted to be non-negative
+_DELTA_BITS = 33
+_DELTA_SHIFT = 1 << 32
+
+
+class IncrementalSimilarity():
+    """Running offset-coherency counts of one read.
+
+    Args:
+        computer (Union[ConstellationSimilarityComputer, LSHSimilarityComputer]): Computer holding the database.
+        margin (float, optional): Lead of the top reference over the runner-up, in similarity percentage points,
+            needed for a decision. Defaults to 10.
+        min_fingerprints (int, optional): Number of distinct read fingerprints (windows for LSH) needed before a
+            decision. Defaults to 0.
+        top_results (int, optional): Number of offsets per reference in the partial results. Defaults to 1.
+    """
+
+    def __init__(self, computer: Union[ConstellationSimilarityComputer, LSHSimilarityComputer], margin: float = 10.0,
+                 min_fingerprints: int = 0, top_results: int = 1) -> None:
+        self._computer = computer
+        self._margin = margin
+        self._min_fingerprints = min_fingerprints
+        self._top_results = top_results
+
+        # sorted pair keys and their counts
+        self._pairs = np.empty(0, dtype=np.int64)
+        self._counts = np.empty(0, dtype=np.int64)
+        self._best = np.zeros(len(computer.names), dtype=np.int64)
+        self._fingerprints = set()
+
+    def update(self, fingerprints) -> bool:
+        """Adds the fingerprints of the next chunk of the read.
+
+        Args:
+            fingerprints: Fingerprints of the chunk, in any form the computer accepts.
+
+        Returns:
+            bool: True if the read is classified.
+        """
+        ref_ids, deltas, keys = self._computer.match(fingerprints)
+        self._fingerprints.update(np.unique(np.asarray(keys).astype(np.int64)).tolist())
+
+        ref_ids, deltas, counts = count_matches(ref_ids, deltas)
+        pairs = (ref_ids << _DELTA_BITS) + (deltas + _DELTA_SHIFT)
+
+        # pairs seen in earlier chunks are added to, new pairs are inserted in order
+        positions = np.searchsorted(self._pairs, pairs)
+        seen = positions < len(self._pairs)
+        seen[seen] = self._pairs[positions[seen]] == pairs[seen]
+        np.add.at(self._counts, positions[seen], counts[seen])
+
+        totals = counts.copy()
+        totals[seen] = self._counts[positions[seen]]
+        np.maximum.at(self._best, ref_ids, totals)
+
+        self._pairs = np.insert(self._pairs, positions[~seen], pairs[~seen])
+        self._counts = np.insert(self._counts, positions[~seen], counts[~seen])
+
+        return self.decided
+
+    def consume(self, chunks: Iterable) -> int:
+        """Adds chunks until the read is classified or the chunks run out.
+
+        Returns:
+            int: Number of chunks used.
+        """
+        used = 0
+        for chunk in chunks:
+            used += 1
+            if self.update(chunk):
+                break
+
+        return used
+
+    def number_of_fingerprints(self) -> int:
+        return len(self._fingerprints)
+
+    def similarities(self) -> np.ndarray:
+        """Similarity percentage of the best offset of every reference."""
+        return 100 * self._best / max(self.number_of_fingerprints(), 1)
+
+    def lead(self) -> float:
+        """Similarity of the top reference minus the similarity of the runner-up."""
+        similarities = np.sort(self.similarities())[::-1]
+        if len(similarities) == 0:
+            return 0.0
+        return float(similarities[0] - (similarities[1] if len(similarities) > 1 else 0))
+
+    @property
+    def decided(self) -> bool:
+        return self.number_of_fingerprints() >= self._min_fingerprints and self._best.any() and \
+            self.lead() >= self._margin
+
+    @property
+    def leader(self) -> Optional[str]:
+        """Name of the currently leading reference, None before any match."""
+        if not self._best.any():
+            return None
+        return self._computer.names[int(np.argmax(self._best))]
+
+    def result(self) -> SimilarityResult:
+        """Partial similarity result of the chunks seen so far."""
+        if len(self._pairs) == 0:
+            return SimilarityResult(dict(), self.number_of_fingerprints())
+
+        ref_ids = self._pairs >> _DELTA_BITS
+        deltas = (self._pairs & ((1 << _DELTA_BITS) - 1)) - _DELTA_SHIFT
+        return SimilarityResult(top_offsets_of_counts(ref_ids, deltas, self._counts, self._computer.names,
+                                                      self._top_results), self.number_of_fingerprints())
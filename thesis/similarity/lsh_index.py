@@ -0,0 +1,229 @@
+"""Banded LSH index over MinHash signature arrays.
+
+The signatures are split into num_tables equal parts like LSHSimilarityComputer
+does, and every part is banded exactly like a datasketch.MinHashLSH with the
+same threshold would band it. Every band of every window is hashed into a
+single uint64 key, the keys of all bands are kept in one sorted array of unique
+keys with posting offsets into the window indices sharing the key. A query of
+all windows of a read is a single searchsorted over its band keys.
+
+An index is built once and saved as a directory of .npy arrays with a meta.json
+description, which is opened memory mapped without rebuilding the tables:
+
+    python -m thesis.similarity.lsh_index reference_lsh/ reference_database.p --num_tables 8 --threshold 0.5
+"""
+from typing import List, Tuple
+import argparse
+import json
+import os
+import pickle as pp
+
+import numpy as np
+
+from thesis.fingerprinting.minhash import MinHashSignatures
+
+META_FILE = "meta.json"
+
+INDEX_TYPE = "lsh"
+
+_ARRAYS = ["keys", "bounds", "postings", "offsets", "ref_ids"]
+
+_FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+_FNV_PRIME = np.uint64(0x100000001b3)
+_INTEGRATION_POINTS = 1001
+
+
+def _trapezoid(values: np.ndarray, width: float) -> np.ndarray:
+    # integral of equidistant samples over an interval of the given width, along the last axis
+    return (values.sum(axis=-1) - (values[..., 0] + values[..., -1]) / 2) * width / (values.shape[-1] - 1)
+
+
+def optimal_band_parameters(threshold: float, num_perm: int, false_positive_weight: float = 0.5,
+                            false_negative_weight: float = 0.5) -> Tuple[int, int]:
+    """Number of bands and rows per band minimising the weighted false positive and false negative
+    probabilities, the parameters datasketch.MinHashLSH chooses for the same arguments.
+    """
+    bands, rows = zip(*[(b, r) for b in range(1, num_perm + 1) for r in range(1, num_perm // b + 1)])
+    bands, rows = np.array(bands, dtype=np.float64)[:, None], np.array(rows, dtype=np.float64)[:, None]
+
+    below = np.linspace(0.0, threshold, _INTEGRATION_POINTS)
+    above = np.linspace(threshold, 1.0, _INTEGRATION_POINTS)
+    false_positive = _trapezoid(1 - (1 - below ** rows) ** bands, threshold)
+    false_negative = _trapezoid((1 - above ** rows) ** bands, 1.0 - threshold)
+
+    best = np.argmin(false_positive * false_positive_weight + false_negative * false_negative_weight)
+    return int(bands[best, 0]), int(rows[best, 0])
+
+
+def band_keys(signatures: np.ndarray, num_tables: int, bands: int, rows: int) -> np.ndarray:
+    """Hashes every band of every table of the signatures.
+
+    Args:
+        signatures (np.ndarray): (number of windows, signature size) signatures.
+        num_tables (int): number of equal signature parts.
+        bands (int): number of bands per part.
+        rows (int): number of signature values per band.
+
+    Returns:
+        np.ndarray: (number of windows, num_tables * bands) uint64 keys, distinct for every table and band.
+    """
+    signatures = np.asarray(signatures, dtype=np.uint64)
+    table_size = signatures.shape[1] // num_tables
+    keys = np.empty((len(signatures), num_tables * bands), dtype=np.uint64)
+
+    for table in range(num_tables):
+        for band in range(bands):
+            # the band ID gets its own multiply step, XORed into the offset alone it would share the bits of the
+            # first value, and bands of different tables could collide
+            key = np.full(len(signatures), _FNV_OFFSET ^ np.uint64(table * bands + band), dtype=np.uint64) * _FNV_PRIME
+            start = table * table_size + band * rows
+            for column in range(start, start + rows):
+                key = (key ^ signatures[:, column]) * _FNV_PRIME
+            keys[:, table * bands + band] = key
+
+    return keys
+
+
+class BandedLSHIndex():
+    """Bucket table of the signature bands of a reference database.
+
+    Built from a signature database with BandedLSHIndex.build or opened from disk with BandedLSHIndex.open.
+
+    Attributes:
+        keys (np.ndarray): sorted unique uint64 band keys.
+        bounds (np.ndarray): postings[bounds[i]:bounds[i + 1]] are the windows with band key keys[i].
+        postings (np.ndarray): window indices grouped by band key.
+        offsets (np.ndarray): window offset of every indexed window.
+        ref_ids (np.ndarray): reference ID of every indexed window.
+        names (List[str]): reference name of every reference ID.
+    """
+
+    def __init__(self, keys: np.ndarray, bounds: np.ndarray, postings: np.ndarray, offsets: np.ndarray,
+                 ref_ids: np.ndarray, names: List[str], num_tables: int, threshold: float, bands: int, rows: int,
+                 signature_size: int, seed: int, engine: str) -> None:
+        self.keys = keys
+        self.bounds = bounds
+        self.postings = postings
+        self.offsets = offsets
+        self.ref_ids = ref_ids
+        self.names = names
+        self.num_tables = num_tables
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = rows
+        self.signature_size = signature_size
+        self.seed = seed
+        self.engine = engine
+
+    @classmethod
+    def build(cls, database: MinHashSignatures, num_tables: int = 8, threshold: float = 0.5) -> "BandedLSHIndex":
+        """Bands and indexes the signatures of a reference database."""
+        if database.signature_size % num_tables != 0:
+            raise ValueError("Minhash signature not compatible with number of tables")
+
+        bands, rows = optimal_band_parameters(threshold, database.signature_size // num_tables)
+        keys = band_keys(database.signatures, num_tables, bands, rows).ravel()
+        order = np.argsort(keys, kind='stable')
+        unique, starts = np.unique(keys[order], return_index=True)
+        postings = (order // (num_tables * bands)).astype(np.int64)
+
+        return cls(unique, np.append(starts, len(keys)).astype(np.int64), postings, database.offsets,
+                   database.ref_ids, database.names, num_tables, threshold, bands, rows, database.signature_size,
+                   database.seed, database.engine)
+
+    def save(self, directory: str) -> None:
+        """Writes the index into the directory, which is created if needed."""
+        os.makedirs(directory, exist_ok=True)
+        for name in _ARRAYS:
+            np.save(os.path.join(directory, name + ".npy"), getattr(self, name))
+        self.save_meta(directory)
+
+    def save_meta(self, directory: str) -> None:
+        """Writes only the meta.json description, for arrays written into the directory by other means."""
+        meta = {
+            "type": INDEX_TYPE,
+            "names": self.names,
+            "num_tables": self.num_tables,
+            "threshold": self.threshold,
+            "bands": self.bands,
+            "rows": self.rows,
+            "signature_size": self.signature_size,
+            "seed": self.seed,
+            "engine": self.engine,
+        }
+        with open(os.path.join(directory, META_FILE), "w") as handle:
+            json.dump(meta, handle)
+
+    @classmethod
+    def open(cls, directory: str) -> "BandedLSHIndex":
+        """Opens a saved index, the arrays are memory mapped read-only."""
+        with open(os.path.join(directory, META_FILE)) as handle:
+            meta = json.load(handle)
+        if meta.pop("type", None) != INDEX_TYPE:
+            raise ValueError("{} is not an LSH index".format(directory))
+
+        arrays = [np.load(os.path.join(directory, name + ".npy"), mmap_mode='r') for name in _ARRAYS]
+        return cls(*arrays, **meta)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def query(self, read: MinHashSignatures, required_votes: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """Finds the indexed windows sharing a band with at least required_votes tables of each read window.
+
+        Args:
+            read (MinHashSignatures): signatures of the read windows.
+            required_votes (int, optional): number of tables which have to vote for a candidate. Defaults to 1.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: read window index and indexed window index of every candidate pair.
+        """
+        if (read.engine, read.seed, read.signature_size) != (self.engine, self.seed, self.signature_size):
+            raise ValueError("Read signatures are not compatible with the index")
+        if len(self) == 0 or len(read) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        keys = band_keys(read.signatures, self.num_tables, self.bands, self.rows)
+        positions = np.minimum(np.searchsorted(self.keys, keys.ravel()), len(self.keys) - 1)
+        found = np.flatnonzero(self.keys[positions] == keys.ravel())
+
+        starts = self.bounds[positions[found]]
+        counts = self.bounds[positions[found] + 1] - starts
+        # posting index of every (read band, indexed window) match
+        matches = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        windows = self.postings[matches]
+        queries = np.repeat(found // self.bands, counts)        # read window * num_tables + table
+
+        # a table votes once for a candidate even if several of its bands match
+        votes = np.unique(queries * len(self) + windows)
+        pairs, counts = np.unique((votes // len(self)) // self.num_tables * len(self) + votes % len(self),
+                                  return_counts=True)
+        pairs = pairs[counts >= required_votes]
+
+        return pairs // len(self), pairs % len(self)
+
+
+def load_signatures(references: list) -> MinHashSignatures:
+    """Merges native signatures or (MinHash, "name:offset") lists of the datasketch engine into one database."""
+    references = [r if isinstance(r, MinHashSignatures) else MinHashSignatures.from_minhashes(r) for r in references]
+    return references[0] if len(references) == 1 else MinHashSignatures.concatenate(references)
+
+
+def parse_arguments() -> argparse.PARSER:
+    parser = argparse.ArgumentParser(description="Builds a memory-mapped banded LSH reference index")
+
+    parser.add_argument('destination', type=str, help='Directory of the index')
+    parser.add_argument('inputs', type=str, nargs='+', help='MinHash reference database or pipeline result pickles')
+    parser.add_argument('--num_tables', type=int, help='Number of tables to be used for similarity in LSH', default=8)
+    parser.add_argument('--threshold', type=float, help='Threshold for similarity of minhash singature', default=0.5)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    references = [pp.load(open(path, 'rb')) for path in args.inputs]
+    BandedLSHIndex.build(load_signatures(references), args.num_tables, args.threshold).save(args.destination)
+
+
+if __name__ == "__main__":
+    main()
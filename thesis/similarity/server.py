@@ -0,0 +1,230 @@
+"""Resident similarity service keeping a reference database loaded.
+
+The server listens on a Unix domain socket or a localhost TCP port. Requests and
+responses are pickled dictionaries in frames prefixed with their 8 byte big
+endian length:
+
+    {"read": <fingerprints>}                     match a pipeline result
+    {"path": <signal file>, "id": <optional>}    run the pipeline on a signal file and match it
+
+Responses are {"result": SimilarityResult} or {"error": message}. Pickle frames are
+only meant for trusted local clients.
+
+Matching runs on a pool of worker processes, forked workers share the reference
+and spawned ones load it once. At most --max_concurrent requests are in flight,
+further requests wait for a slot after they are read. A connection is only read
+again once its response is written, which pushes back on the clients.
+
+    python -m thesis.similarity.server --ref reference_index/ --similarity constellation --socket /tmp/thesis.sock \\
+        --pipeline "--continuous_wavelet mexh --preprocess none"
+"""
+from typing import Optional, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import asyncio
+import os
+import pickle as pp
+import shlex
+import socket
+import struct
+
+from thesis.main import build_similarity_computer
+from thesis.pipeline import pipeline
+from thesis.similarity.computer import SimilarityResult
+from thesis.utils import constants, ioutil, logging
+
+logger = logging.get_logger(__name__)
+
+_HEADER = struct.Struct(">Q")
+
+# similarity computer and pipeline objects of the server, inherited by forked workers or set by _init_server_worker
+_server_computer = None
+_server_pipeline = None
+
+
+def _build_server_pipeline(args: argparse.Namespace) -> Optional[tuple]:
+    if args.pipeline is None:
+        return None
+    pipeline_args = pipeline.parse_arguments(["--file", ""] + shlex.split(args.pipeline))
+    # requests run concurrently, their progress lines would interleave
+    return pipeline.build_pipeline(pipeline_args, progress=None)
+
+
+def _init_server_worker(args: argparse.Namespace) -> None:
+    global _server_computer, _server_pipeline
+    if _server_computer is None:
+        _server_computer = build_similarity_computer(args, ioutil.load_reference(args.ref))
+    if _server_pipeline is None:
+        _server_pipeline = _build_server_pipeline(args)
+
+
+def encode_frame(message: dict) -> bytes:
+    payload = pp.dumps(message, protocol=pp.HIGHEST_PROTOCOL)
+    return _HEADER.pack(len(payload)) + payload
+
+
+def _handle_request(request: dict) -> dict:
+    try:
+        if "read" in request:
+            read = request["read"]
+        elif "path" in request:
+            if _server_pipeline is None:
+                raise ValueError("The server was started without --pipeline, signal paths are not accepted")
+            file_id = request.get("id") or ioutil.extract_file_name(request["path"])
+            read = pipeline.pipeline(request["path"], file_id, *_server_pipeline)
+        else:
+            raise ValueError("Request needs a read or a path")
+
+        return {"result": _server_computer.compute_similarity(read)}
+    except Exception as e:      # pylint: disable=broad-except
+        return {"error": "{}: {}".format(type(e).__name__, e)}
+
+
+class SimilarityServer():
+    """Asyncio server answering similarity requests on a process pool.
+
+    Args:
+        executor (ProcessPoolExecutor): Pool which runs the requests.
+        max_concurrent (int): Maximum number of requests in flight.
+    """
+
+    def __init__(self, executor: ProcessPoolExecutor, max_concurrent: int) -> None:
+        self._executor = executor
+        self._max_concurrent = max_concurrent
+        self._slots = None
+
+    async def _read_frame(self, reader: asyncio.StreamReader) -> Optional[dict]:
+        try:
+            header = await reader.readexactly(_HEADER.size)
+        except asyncio.IncompleteReadError:
+            return None
+        return pp.loads(await reader.readexactly(_HEADER.unpack(header)[0]))
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                request = await self._read_frame(reader)
+                if request is None:
+                    break
+                # idle connections do not hold a slot
+                async with self._slots:
+                    response = await loop.run_in_executor(self._executor, _handle_request, request)
+
+                writer.write(encode_frame(response))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path: str = None, port: int = None) -> None:
+        # created inside the running loop
+        self._slots = asyncio.Semaphore(self._max_concurrent)
+
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            server = await asyncio.start_unix_server(self.handle_connection, path=socket_path)
+            logger.info("Listening on %s", socket_path)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host="127.0.0.1", port=port)
+            logger.info("Listening on 127.0.0.1:%d", port)
+
+        async with server:
+            await server.serve_forever()
+
+
+class SimilarityClient():
+    """Blocking client of the similarity server.
+
+    Args:
+        address (Union[str, Tuple[str, int]]): Unix socket path or (host, port) of the server.
+    """
+
+    def __init__(self, address: Union[str, Tuple[str, int]]) -> None:
+        if isinstance(address, str):
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.connect(address)
+
+    def __enter__(self) -> "SimilarityClient":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._socket.close()
+
+    def _receive_exactly(self, size: int) -> bytes:
+        parts = []
+        while size > 0:
+            part = self._socket.recv(min(size, 1 << 20))
+            if not part:
+                raise ConnectionError("Connection closed by the server")
+            parts.append(part)
+            size -= len(part)
+        return b"".join(parts)
+
+    def request(self, message: dict) -> SimilarityResult:
+        self._socket.sendall(encode_frame(message))
+        response = pp.loads(self._receive_exactly(_HEADER.unpack(self._receive_exactly(_HEADER.size))[0]))
+
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+    def query(self, read) -> SimilarityResult:
+        """Matches a pipeline result (fingerprints) against the reference of the server."""
+        return self.request({"read": read})
+
+    def query_signal(self, path: str, file_id: str = None) -> SimilarityResult:
+        """Runs the server's pipeline on a signal file on the server's host and matches the result."""
+        return self.request({"path": path, "id": file_id})
+
+
+def parse_arguments() -> argparse.PARSER:
+    parser = argparse.ArgumentParser(description="Similarity server")
+
+    parser.add_argument('--ref', required=True, type=str,
+                        help='File which contains the reference pipeline result, or a reference index directory.')
+    parser.add_argument('--similarity', required=True, type=str,
+                        help='Similarity type to use for comparison (constellation, lsh)')
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument('--socket', type=str, help='Unix domain socket path to listen on')
+    address.add_argument('--port', type=int, help='Localhost TCP port to listen on')
+    parser.add_argument('--pipeline', type=str,
+                        help='Pipeline arguments used for signal path requests, e.g. "--continuous_wavelet mexh"')
+    parser.add_argument('--workers', type=int, help='Number of worker processes', default=os.cpu_count())
+    parser.add_argument('--max_concurrent', type=int,
+                        help='Maximum number of requests in flight (defaults to twice the workers)')
+    parser.add_argument('--num_tables', type=int,
+                        help='Number of tables to be used for similarity in LSH', default=8)
+    parser.add_argument('--threshold', type=float, help='Threshold for similarity of minhash singature', default=0.5)
+    parser.add_argument('--required_votes', type=int,
+                        help='Number of required votes by the table to vet a vote', default=3)
+    parser.add_argument('--coherency', type=str,
+                        help='Offset coherency counting for constellation similarity (loop, vectorized)',
+                        default=constants.COHERENCY_MODE_LOOP)
+    return parser.parse_args()
+
+
+def main():
+    global _server_computer, _server_pipeline
+
+    args = parse_arguments()
+    _server_computer = build_similarity_computer(args, ioutil.load_reference(args.ref))
+    logger.info("Reference %s loaded", args.ref)
+
+    _server_pipeline = _build_server_pipeline(args)
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_server_worker,
+                             initargs=(args,)) as executor:
+        server = SimilarityServer(executor, args.max_concurrent or 2 * args.workers)
+        asyncio.run(server.serve(args.socket, args.port))
+
+
+if __name__ == "__main__":
+    main()
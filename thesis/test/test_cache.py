@@ -0,0 +1,58 @@
+import h5py
+import numpy as np
+import pytest
+
+from thesis.pipeline import pipeline
+from thesis.utils.cache import StageCache
+
+
+def _write_fast5(path: str, length: int = 20000) -> None:
+    with h5py.File(path, 'w') as handle:
+        channel = handle.create_group('UniqueGlobalKey/channel_id')
+        channel.attrs['digitisation'] = 8192.0
+        channel.attrs['offset'] = 6.0
+        channel.attrs['range'] = 1402.882
+        channel.attrs['sampling_rate'] = 4000.0
+        signal = np.random.RandomState(0).randint(300, 900, length).astype(np.int16)
+        handle.create_group('Raw/Reads/Read_1').create_dataset('Signal', data=signal)
+
+
+def test_get_or_compute_returns_computed_array_on_miss(tmp_path):
+    cache = StageCache(str(tmp_path))
+    computed = np.arange(5.0)
+
+    array = cache.get_or_compute("key", lambda: computed)
+    assert array is computed
+
+    cached = cache.get_or_compute("key", lambda: None)
+    assert not cached.flags.writeable
+    np.testing.assert_array_equal(cached, computed)
+
+
+def test_cached_dwt_cwt_pipeline(tmp_path):
+    filename = str(tmp_path / "read.fast5")
+    _write_fast5(filename)
+    argv = ["--file", filename, "--continuous_wavelet", "mexh", "--preprocess", "none", "--transform", "dwt-cwt",
+            "--discrete_wavelet", "db2", "--level", "2", "--window_size", "2048", "--shift_size", "256"]
+
+    def run(extra):
+        built = pipeline.build_pipeline(pipeline.parse_arguments(argv + extra), progress=None)
+        return pipeline.pipeline(filename, "read", *built)
+
+    expected = run([])
+    cached = ["--cache_dir", str(tmp_path / "cache")]
+    # the second run reads the preprocessed signal and the coefficients memory mapped
+    assert run(cached) == expected
+    assert run(cached) == expected
+
+
+def test_put_removes_temporary_file_on_failure(tmp_path, monkeypatch):
+    cache = StageCache(str(tmp_path))
+
+    def fail(*args, **kwargs):
+        raise OSError("No space left on device")
+    monkeypatch.setattr(np, "save", fail)
+
+    with pytest.raises(OSError):
+        cache.put("key", np.arange(5.0))
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,42 @@
+import pickle as pp
+
+import numpy as np
+
+from thesis.fingerprinting.packed import PackedFingerprints
+from thesis.similarity import external_merge
+from thesis.similarity.fingerprint_index import build_index
+
+
+def _fingerprints(seed: int, max_freq: int, name: str, number: int = 3000) -> dict:
+    random = np.random.RandomState(seed)
+    fingerprints = dict()
+    for _ in range(number):
+        # chain length 3 with deltas far beyond what a 9 bit frequency layout can hold
+        pairs = np.stack([random.randint(0, max_freq, 3), random.randint(0, 5000, 3)], 1).ravel()
+        key = (int(random.randint(0, max_freq)),) + tuple(int(v) for v in pairs)
+        fingerprints[key] = [(int(offset), name) for offset in random.randint(0, 100000, random.randint(1, 4))]
+    return fingerprints
+
+
+def test_merge_fingerprints_mixed_layouts(tmp_path, monkeypatch):
+    references = [_fingerprints(0, 512, "wide"), _fingerprints(1, 16, "narrow"), _fingerprints(2, 16, "wide")]
+    layouts = [PackedFingerprints.from_dict(reference).layout for reference in references]
+    assert layouts[0].freq_bits == 9 and layouts[1].freq_bits == 4 and layouts[0].delta_bits < layouts[1].delta_bits
+
+    paths = []
+    for number, reference in enumerate(references):
+        paths.append(str(tmp_path / "reference_{}.p".format(number)))
+        with open(paths[-1], "wb") as handle:
+            pp.dump(reference, handle)
+
+    # several runs per input and small merge blocks
+    monkeypatch.setattr(external_merge, "_SPILL_BYTES", {"constellation": (1 << 20) // 700, "lsh": 64})
+    monkeypatch.setattr(external_merge, "_MERGE_BYTES", (1 << 20) // 37)
+    merged = external_merge.merge_fingerprints(paths, str(tmp_path / "index"), memory=1,
+                                               temporary=str(tmp_path))
+    expected = build_index(references)
+
+    assert merged.names == expected.names
+    assert merged.layout == expected.layout
+    for name in ["hashes", "bounds", "offsets", "ref_ids"]:
+        np.testing.assert_array_equal(getattr(merged, name), getattr(expected, name))
@@ -0,0 +1,21 @@
+import numpy as np
+
+from thesis.similarity.lsh_index import band_keys
+
+
+def test_band_keys_differ_between_tables_and_bands():
+    num_tables, bands, rows = 8, 2, 3
+    # small values make it likely that a value cancels out the band ID if both share the same bits
+    signatures = np.random.RandomState(0).randint(0, 16, (2000, num_tables * bands * rows))
+    keys = band_keys(signatures, num_tables, bands, rows)
+
+    sets = [set(keys[:, column].tolist()) for column in range(num_tables * bands)]
+    for first in range(len(sets)):
+        for second in range(first + 1, len(sets)):
+            assert not sets[first] & sets[second]
+
+
+def test_band_keys_of_first_values_differing_by_the_table():
+    # (5, 7, 9) in table 0 and (4, 7, 9) in table 1 differ in the first value exactly by the XOR of the tables
+    keys = band_keys(np.array([[5, 7, 9, 4, 7, 9]]), 2, 1, 3)
+    assert keys[0, 0] != keys[0, 1]
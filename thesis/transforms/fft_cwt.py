@@ -0,0 +1,291 @@
+"""Continuous wavelet transform computed as batched FFT multiplications.
+
+The wavelet kernels of all scales are sampled exactly like pywt.cwt does, folded
+with its differentiation and scale normalisation, and cached in the frequency
+domain per (wavelet, scales, FFT size). The signal is then transformed with
+overlap-save: every block costs one forward FFT and one batched inverse FFT over
+all scales.
+
+The result matches pywt.cwt (method 'conv') up to floating point error: the
+maximum absolute difference stays below 1e-10 times the largest coefficient
+magnitude for float64 output and below 1e-6 times it for float32 output.
+"""
+from typing import Dict, Iterator, Optional, Tuple
+import inspect
+
+import numpy as np
+import pywt
+
+try:
+    _PRECISION = inspect.signature(pywt.cwt).parameters['precision'].default
+except KeyError:
+    # older pywt releases sample the wavelet with a fixed precision
+    _PRECISION = 10
+
+_MIN_FFT_SIZE = 1024
+_MAX_BLOCK_FFT_SIZE = 2 ** 15
+
+_sampled_kernels: Dict[Tuple, "SampledKernels"] = dict()
+_kernel_banks: Dict[Tuple, "CWTKernelBank"] = dict()
+
+
+def _next_power_of_two(n: int) -> int:
+    return 1 << max(0, int(n) - 1).bit_length()
+
+
+class SampledKernels():
+    """Time domain wavelet kernels of a set of scales, sampled exactly like pywt.cwt does.
+
+    The differentiation and the scale normalisation of pywt.cwt are folded into
+    the kernels, and every kernel is delayed so that the coefficients of all
+    scales for signal sample n are found at index n + delay of the linear
+    convolution.
+    """
+
+    def __init__(self, wavelet: str, scales: np.ndarray) -> None:
+        wavelet_object = pywt.DiscreteContinuousWavelet(wavelet)
+        self.complex = wavelet_object.complex_cwt
+
+        int_psi, x = pywt.integrate_wavelet(wavelet_object, precision=_PRECISION)
+        if self.complex:
+            int_psi = np.conj(int_psi)
+        step = x[1] - x[0]
+
+        kernels = []
+        delays = []
+        for scale in scales:
+            j = (np.arange(scale * (x[-1] - x[0]) + 1) / (scale * step)).astype(int)
+            j = j[j < int_psi.size]
+            int_psi_scale = int_psi[j][::-1]
+            if int_psi_scale.size < 2:
+                raise ValueError("Selected scale of {} too small.".format(scale))
+
+            # -sqrt(scale) * diff(conv(signal, kernel)) == conv(signal, folded)[1:-1]
+            kernels.append(-np.sqrt(scale) * np.diff(np.concatenate(([0], int_psi_scale, [0]))))
+            delays.append(1 + (int_psi_scale.size - 2) // 2)
+
+        self.delay = max(delays)
+        self.size = max(self.delay - d + k.size for k, d in zip(kernels, delays))
+        self.kernels = np.zeros((len(kernels), self.size), dtype=kernels[0].dtype)
+        for i, (kernel, delay) in enumerate(zip(kernels, delays)):
+            start = self.delay - delay
+            self.kernels[i, start:start + kernel.size] = kernel
+
+
+class CWTKernelBank():
+    """Frequency domain wavelet kernels of a set of scales for a fixed FFT size."""
+
+    def __init__(self, sampled: SampledKernels, fft_size: int) -> None:
+        if fft_size < sampled.size:
+            raise ValueError("FFT size {} smaller than the kernel size {}".format(fft_size, sampled.size))
+
+        self.complex = sampled.complex
+        self.delay = sampled.delay
+        self.kernel_size = sampled.size
+        self.fft_size = fft_size
+
+        if self.complex:
+            self.spectrum = np.fft.fft(sampled.kernels, fft_size, axis=-1)
+        else:
+            self.spectrum = np.fft.rfft(sampled.kernels, fft_size, axis=-1)
+
+    @property
+    def num_scales(self) -> int:
+        return self.spectrum.shape[0]
+
+    @property
+    def block_size(self) -> int:
+        """Number of output samples produced from one FFT block."""
+        return self.fft_size - self.kernel_size + 1
+
+    def convolve_block(self, block: np.ndarray) -> np.ndarray:
+        """Returns the valid part of the circular convolution of one input block with all kernels."""
+        if self.complex:
+            result = np.fft.ifft(np.fft.fft(block, self.fft_size) * self.spectrum, axis=-1)
+        else:
+            result = np.fft.irfft(np.fft.rfft(block, self.fft_size) * self.spectrum, self.fft_size, axis=-1)
+
+        return result[:, self.kernel_size - 1:]
+
+
+def get_kernel_bank(wavelet: str, scales: np.ndarray, signal_length: int) -> CWTKernelBank:
+    """Returns the cached kernel bank for the wavelet, scales and the FFT size bucket of the signal length.
+
+    Signals are bucketed by the power of two FFT size which holds them in a single block. Long signals share
+    the largest bucket and are processed in multiple overlap-save blocks.
+    """
+    scales = tuple(float(s) for s in np.atleast_1d(scales))
+    if (wavelet, scales) not in _sampled_kernels:
+        _sampled_kernels[(wavelet, scales)] = SampledKernels(wavelet, np.array(scales))
+    sampled = _sampled_kernels[(wavelet, scales)]
+
+    largest = max(_MAX_BLOCK_FFT_SIZE, _next_power_of_two(4 * sampled.size))
+    fft_size = max(_MIN_FFT_SIZE, min(largest, _next_power_of_two(signal_length + sampled.size - 1)))
+
+    key = (wavelet, scales, fft_size)
+    if key not in _kernel_banks:
+        _kernel_banks[key] = CWTKernelBank(sampled, fft_size)
+
+    return _kernel_banks[key]
+
+
+def _transform_range(signal: np.ndarray, bank: CWTKernelBank, start: int, stop: int, signal_start: int = 0
+                     ) -> Iterator[Tuple[int, np.ndarray]]:
+    """Yields (column, coefficients) blocks covering the output columns [start, stop).
+
+    The signal holds the samples from index signal_start on, all samples the columns need have to be in it.
+    Samples before index 0 and after the signal are zero.
+    """
+    length = len(signal)
+    overlap = bank.kernel_size - 1
+
+    for column in range(start, stop, bank.block_size):
+        # input samples needed for the linear convolution at indices [column + delay, ...)
+        first = column + bank.delay - overlap - signal_start
+        block = np.zeros(bank.fft_size, dtype=signal.dtype)
+        source_start, source_stop = max(first, 0), min(first + bank.fft_size, length)
+        if source_stop > source_start:
+            block[source_start - first:source_stop - first] = signal[source_start:source_stop]
+
+        yield column, bank.convolve_block(block)[:, :min(bank.block_size, stop - column)]
+
+
+def fft_cwt(signal: np.ndarray,
+            scales: np.ndarray,
+            wavelet: str,
+            absolute: bool = True,
+            dtype: np.dtype = np.float64,
+            out: np.ndarray = None) -> np.ndarray:
+    """Transforms the signal with the continuous wavelet transform using cached FFT kernels.
+
+    Args:
+        signal (np.ndarray): Signal to be transformed.
+        scales (np.ndarray): Scales of the transform.
+        wavelet (str): Continuous wavelet to be used for the transform.
+        absolute (bool, optional): Indicates if absolute values of the coefficients should be returned. Defaults
+            to True.
+        dtype (np.dtype, optional): Floating point type of the result, the complex counterpart is used for
+            complex wavelets when absolute is False. Defaults to np.float64.
+        out (np.ndarray, optional): Preallocated (scales, signal length) result buffer.
+
+    Returns:
+        np.ndarray: 2D array of transform coefficients.
+    """
+    signal = np.asarray(signal, dtype=np.float64)
+    bank = get_kernel_bank(wavelet, scales, len(signal))
+
+    if out is None:
+        out_dtype = np.result_type(dtype, np.complex64) if bank.complex and not absolute else dtype
+        out = np.empty((bank.num_scales, len(signal)), dtype=out_dtype)
+
+    for column, coefficients in _transform_range(signal, bank, 0, len(signal)):
+        if absolute:
+            coefficients = np.abs(coefficients)
+        np.copyto(out[:, column:column + coefficients.shape[1]], coefficients, casting='same_kind')
+
+    return out
+
+
+def fft_cwt_blocks(signal: np.ndarray,
+                   scales: np.ndarray,
+                   wavelet: str,
+                   absolute: bool = True,
+                   dtype: np.dtype = np.float64,
+                   block_size: int = None) -> Iterator[np.ndarray]:
+    """Transforms the signal block by block, never holding more than one block of coefficients.
+
+    Every block is computed from the signal extended by the full kernel support on both sides, so the
+    concatenated blocks are equal to the result of fft_cwt.
+
+    Args:
+        signal (np.ndarray): Signal to be transformed.
+        scales (np.ndarray): Scales of the transform.
+        wavelet (str): Continuous wavelet to be used for the transform.
+        absolute (bool, optional): Indicates if absolute values of the coefficients should be returned. Defaults
+            to True.
+        dtype (np.dtype, optional): Floating point type of the result. Defaults to np.float64.
+        block_size (int, optional): Number of signal samples per block. Defaults to the block size of the FFT
+            kernels.
+
+    Yields:
+        np.ndarray: (scales, block size) coefficient blocks in signal order.
+    """
+    signal = np.asarray(signal, dtype=np.float64)
+    bank = get_kernel_bank(wavelet, scales, len(signal) if block_size is None else block_size)
+    if block_size is None:
+        block_size = bank.block_size
+
+    for start in range(0, len(signal), block_size):
+        stop = min(start + block_size, len(signal))
+        out_dtype = np.result_type(dtype, np.complex64) if bank.complex and not absolute else dtype
+        out = np.empty((bank.num_scales, stop - start), dtype=out_dtype)
+
+        for column, coefficients in _transform_range(signal, bank, start, stop):
+            if absolute:
+                coefficients = np.abs(coefficients)
+            np.copyto(out[:, column - start:column - start + coefficients.shape[1]], coefficients,
+                      casting='same_kind')
+
+        yield out
+
+
+class StreamingCWT():
+    """Continuous wavelet transform of a signal which arrives in chunks.
+
+    Coefficients of a signal point are produced as soon as all samples within the kernel support after it
+    have arrived, only the samples still needed are buffered. The concatenated output of push and finish is
+    equal to fft_cwt of the whole signal up to floating point error.
+
+    Args:
+        scales (np.ndarray): Scales of the transform.
+        wavelet (str): Continuous wavelet to be used for the transform.
+        absolute (bool, optional): Indicates if absolute values of the coefficients should be returned. Defaults
+            to True.
+        dtype (np.dtype, optional): Floating point type of the result. Defaults to np.float64.
+        chunk_size (int, optional): Expected number of samples per chunk, used to choose the FFT size.
+            Defaults to 16384.
+    """
+
+    def __init__(self, scales: np.ndarray, wavelet: str, absolute: bool = True, dtype: np.dtype = np.float64,
+                 chunk_size: int = 16384) -> None:
+        self._bank = get_kernel_bank(wavelet, scales, chunk_size)
+        self._absolute = absolute
+        self._dtype = np.result_type(dtype, np.complex64) if self._bank.complex and not absolute else dtype
+
+        self._buffer = np.empty(0, dtype=np.float64)
+        self._buffer_start = 0
+        self._column = 0
+
+    def _transform(self, stop: int) -> Optional[np.ndarray]:
+        if stop <= self._column:
+            return None
+
+        out = np.empty((self._bank.num_scales, stop - self._column), dtype=self._dtype)
+        for column, coefficients in _transform_range(self._buffer, self._bank, self._column, stop,
+                                                     self._buffer_start):
+            if self._absolute:
+                coefficients = np.abs(coefficients)
+            np.copyto(out[:, column - self._column:column - self._column + coefficients.shape[1]], coefficients,
+                      casting='same_kind')
+        self._column = stop
+
+        # keep the samples the next column needs
+        first = max(self._column + self._bank.delay - (self._bank.kernel_size - 1), 0)
+        self._buffer = self._buffer[max(first - self._buffer_start, 0):]
+        self._buffer_start = max(first, self._buffer_start)
+
+        return out
+
+    def push(self, chunk: np.ndarray) -> Optional[np.ndarray]:
+        """Adds the next chunk of the signal.
+
+        Returns:
+            Optional[np.ndarray]: Coefficients of the signal points completed by the chunk, None if there are none.
+        """
+        self._buffer = np.concatenate((self._buffer, np.asarray(chunk, dtype=np.float64)))
+        received = self._buffer_start + len(self._buffer)
+        return self._transform(received - self._bank.delay)
+
+    def finish(self) -> Optional[np.ndarray]:
+        """Returns the coefficients of the remaining signal points, the signal is zero after its end."""
+        return self._transform(self._buffer_start + len(self._buffer))
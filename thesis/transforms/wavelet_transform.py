@@ -1,4 +1,4 @@
-from typing import List
+from typing import Iterable, Iterator, List, Sequence, Union
 import argparse
 import os
 
@@ -9,38 +9,155 @@ from thesis.utils import logging
 from thesis.utils import array_util
 from thesis.utils import constants
 from thesis.utils import signal_extractor
+from thesis.utils.cache import StageCache
+from thesis.transforms.fft_cwt import SampledKernels, StreamingCWT, fft_cwt, fft_cwt_blocks
 
 logger = logging.get_logger(__name__)
 
 
-def cwt(signal: np.ndarray, wavelet: str, scale: int, absolute: bool = True) -> np.ndarray:
+def cwt_scales(scale: int, scale_set: str = constants.SCALE_SET_LINEAR, num_scales: int = None) -> np.ndarray:
+    """Returns the scales of a scale set with the upper scale limit scale.
+
+    Linear scales without a count are the integer scales [1, scale>. Linear scales with a count
+    are the scales which resizing the rows of the integer scale CWT to num_scales rows samples,
+    so a CWT over them matches the resized CWT without computing the dropped scales. Log scales
+    are num_scales (scale if not given) geometrically spaced scales from 1 to scale.
+
+    Args:
+        scale (int): The upper scale limit.
+        scale_set (str, optional): Spacing of the scales ("linear" or "log"). Defaults to "linear".
+        num_scales (int, optional): Number of scales. Defaults to None.
+
+    Returns:
+        np.ndarray: Scales in ascending order.
+    """
+    if scale_set == constants.SCALE_SET_LINEAR:
+        if num_scales is None:
+            return np.arange(1, scale + 1)
+        # source row of every target row of a linear resize from scale to num_scales rows
+        rows = (np.arange(num_scales) + 0.5) * scale / num_scales - 0.5
+        return np.clip(rows, 0, scale - 1) + 1
+
+    if scale_set == constants.SCALE_SET_LOG:
+        return np.geomspace(1, scale, num_scales if num_scales is not None else scale)
+
+    raise ValueError("Unknown scale set {}".format(scale_set))
+
+
+def cwt(signal: np.ndarray,
+        wavelet: str,
+        scale: Union[int, Sequence[float]],
+        absolute: bool = True,
+        backend: str = constants.CWT_BACKEND_PYWT,
+        dtype: np.dtype = np.float64) -> np.ndarray:
     """Transforms given signal using the continuous wavelet transform.
 
     The signal is transformed using the continuous wavelet transform using the given wavelet, for
-    scales in range [1, scale>.
+    scales in range [1, scale> or for the given scales (see cwt_scales).
 
     Args:
         signal (np.ndarray): Signal to be transformed.
         wavelet (str): wavelet to be used for the transform
-        scale (int): The upper scale limit for the transform.
+        scale (Union[int, Sequence[float]]): The upper scale limit for the transform, or the scales.
         absolute (bool, optional): Indicates if the coefficients should be returned . Defaults to
             True.
+        backend (str, optional): CWT implementation, pywt.cwt ("pywt") or the cached FFT kernel
+            engine ("fft", see thesis.transforms.fft_cwt for its tolerance). Defaults to "pywt".
+        dtype (np.dtype, optional): Floating point type of the coefficients. Defaults to np.float64.
 
     Returns:
         np.ndarray: 2D array of transform coefficients.
     """
-    coefficients, _ = pywt.cwt(signal, np.arange(1, scale + 1), wavelet)
+    scales = np.arange(1, scale + 1) if np.isscalar(scale) else np.asarray(scale, dtype=np.float64)
+    if backend == constants.CWT_BACKEND_FFT:
+        return fft_cwt(signal, scales, wavelet, absolute, dtype)
+
+    if backend != constants.CWT_BACKEND_PYWT:
+        raise ValueError("Unknown CWT backend {}".format(backend))
+
+    coefficients, _ = pywt.cwt(signal, scales, wavelet)
     if absolute:
-        return abs(coefficients)
+        coefficients = abs(coefficients)
+    if coefficients.dtype.kind != 'c':
+        coefficients = coefficients.astype(dtype, copy=False)
     return coefficients
 
 
+def cwt_blocks(signal: np.ndarray,
+               wavelet: str,
+               scale: Union[int, Sequence[float]],
+               absolute: bool = True,
+               backend: str = constants.CWT_BACKEND_PYWT,
+               dtype: np.dtype = np.float64,
+               block_size: int = 16384) -> Iterator[np.ndarray]:
+    """Transforms given signal using the continuous wavelet transform, one block of samples at a time.
+
+    Each block is transformed together with the neighbouring samples within the support of the
+    largest scale wavelet, so there are no edge effects at block borders and the concatenated blocks
+    are equal to the output of cwt. Only one block of coefficients is held in memory at a time.
+
+    Args:
+        signal (np.ndarray): Signal to be transformed.
+        wavelet (str): wavelet to be used for the transform
+        scale (Union[int, Sequence[float]]): The upper scale limit for the transform, or the scales.
+        absolute (bool, optional): Indicates if the coefficients should be returned . Defaults to
+            True.
+        backend (str, optional): CWT implementation ("pywt" or "fft"). Defaults to "pywt".
+        dtype (np.dtype, optional): Floating point type of the coefficients. Defaults to np.float64.
+        block_size (int, optional): Number of signal samples per block. Defaults to 16384.
+
+    Yields:
+        np.ndarray: 2D arrays of transform coefficients of consecutive signal blocks.
+    """
+    scales = np.arange(1, scale + 1) if np.isscalar(scale) else np.asarray(scale, dtype=np.float64)
+    if backend == constants.CWT_BACKEND_FFT:
+        yield from fft_cwt_blocks(signal, scales, wavelet, absolute, dtype, block_size)
+        return
+
+    halo = SampledKernels(wavelet, scales).size
+    for start in range(0, len(signal), block_size):
+        stop = min(start + block_size, len(signal))
+        left = max(0, start - halo)
+        coefficients = cwt(signal[left:stop + halo], wavelet, scales, absolute, backend, dtype)
+        yield coefficients[:, start - left:stop - left]
+
+
 def dwt(signal: np.ndarray, wavelet: str, level: int) -> List[np.ndarray]:
-    # TODO add documentation
-    if level > 1:
-        c_a, c_d = pywt.dwt(signal, wavelet)
-        return [c_a, c_d]
-    return pywt.wavedec(signal, wavelet, level=level)
+    """Multilevel discrete wavelet decomposition of the signal.
+
+    Args:
+        signal (np.ndarray): Signal to be transformed.
+        wavelet (str): wavelet to be used for the transform
+        level (int): Decomposition level.
+
+    Returns:
+        List[np.ndarray]: Coefficients [cA_level, cD_level, ..., cD_1] as returned by pywt.wavedec.
+    """
+    # pywt rejects read-only buffers such as memory mapped cache entries
+    return pywt.wavedec(np.array(signal), wavelet, level=level)
+
+
+def dwt_approximation(signal: np.ndarray, wavelet: str, level: int) -> np.ndarray:
+    """Approximation band of the multilevel DWT, the signal low-pass filtered and decimated by 2^level.
+
+    Equal to dwt(signal, wavelet, level)[0], without computing the detail bands.
+
+    Args:
+        signal (np.ndarray): Signal to be transformed.
+        wavelet (str): wavelet to be used for the transform
+        level (int): Decomposition level.
+
+    Returns:
+        np.ndarray: Approximation coefficients cA_level.
+    """
+    # pywt rejects read-only buffers such as memory mapped cache entries
+    return pywt.downcoef('a', np.array(signal), wavelet, level=level)
+
+
+def decimation_factor(transform: str, level: int) -> int:
+    if transform == constants.TRANSFORMS_DWT_CWT:
+        return 2 ** level
+    return 1
 
 
 def save_cwt(coefficients: np.ndarray,
@@ -73,19 +190,88 @@ def save_dwt(coefficients: List[np.ndarray],
 
 class WaveletTransformator():
 
-    __allowed_keys = {"transform", "continuous_wavelet", "discrete_wavelet", "scale", "absolute", "level"}
+    __allowed_keys = {"transform", "continuous_wavelet", "discrete_wavelet", "scale", "absolute", "level",
+                      "cwt_backend", "dtype", "block_size", "cache", "scale_set", "num_scales", "scales"}
+
+    # keys which do not change the coefficients of transform
+    __uncached_keys = {"block_size", "cache"}
+
+    __defaults = {"cwt_backend": constants.CWT_BACKEND_PYWT, "dtype": "float64",
+                  "scale_set": constants.SCALE_SET_LINEAR}
 
     def __init__(self, **kwargs: str) -> None:
         self.__dict__.update(("_" + k, v) for k, v in kwargs.items() if k in self.__allowed_keys)
+        self.__dict__.update(("_" + k, v) for k, v in self.__defaults.items() if kwargs.get(k) is None)
+
+    def decimation_factor(self) -> int:
+        """Number of signal samples per coefficient column, 2^level for the DWT-CWT transform and 1 for CWT."""
+        return decimation_factor(self._transform, getattr(self, "_level", None))
+
+    def cwt_scales(self) -> np.ndarray:
+        """Scales of the CWT, the explicit scales if given, otherwise the scale set up to scale."""
+        #pylint: disable=maybe-no-member
+        if getattr(self, "_scales", None) is not None:
+            return np.asarray(self._scales, dtype=np.float64)
+        return cwt_scales(self._scale, self._scale_set, getattr(self, "_num_scales", None))
 
     def transform(self, signal: np.ndarray) -> np.ndarray:
+        """Transforms the whole signal. With a StageCache passed as cache the coefficients are cached by the content
+        of the signal and the transform parameters, cached coefficients are returned memory mapped read-only.
+        """
+        cache = getattr(self, "_cache", None)
+        if cache is None:
+            return self._transform_signal(signal)
+
+        parameters = {k: getattr(self, "_" + k, None) for k in self.__allowed_keys - self.__uncached_keys}
+        key = StageCache.key("transform", StageCache.array_identity(signal), parameters)
+        return cache.get_or_compute(key, lambda: self._transform_signal(signal))
+
+    def _transform_signal(self, signal: np.ndarray) -> np.ndarray:
         #pylint: disable=maybe-no-member
         if self._transform == constants.TRANSFORMS_CWT:
-            return cwt(signal, self._continuous_wavelet, self._scale, self._absolute)
+            return cwt(signal, self._continuous_wavelet, self.cwt_scales(), self._absolute, self._cwt_backend,
+                       np.dtype(self._dtype))
 
         if self._transform == constants.TRANSFORMS_DWT_CWT:
-            dwt_transform = dwt(signal, self._discrete_wavelet, self._level)
-            return cwt(dwt_transform, self._continuous_wavelet, self._scale, self._absolute)
+            dwt_transform = dwt_approximation(signal, self._discrete_wavelet, self._level)
+            return cwt(dwt_transform, self._continuous_wavelet, self.cwt_scales(), self._absolute, self._cwt_backend,
+                       np.dtype(self._dtype))
+
+    def is_streaming(self) -> bool:
+        """Checks if the transformator is configured to stream coefficient blocks (block_size is set)."""
+        return getattr(self, "_block_size", None) is not None
+
+    def transform_blocks(self, signal: np.ndarray) -> Iterator[np.ndarray]:
+        """Transforms the signal as a stream of coefficient blocks of block_size samples, so peak memory
+        does not grow with the signal length. The concatenated blocks are equal to transform(signal).
+        """
+        #pylint: disable=maybe-no-member
+        if self._transform == constants.TRANSFORMS_DWT_CWT:
+            signal = dwt_approximation(signal, self._discrete_wavelet, self._level)
+
+        return cwt_blocks(signal, self._continuous_wavelet, self.cwt_scales(), self._absolute, self._cwt_backend,
+                          np.dtype(self._dtype), self._block_size)
+
+    def transform_stream(self, chunks: Iterable[np.ndarray]) -> Iterator[np.ndarray]:
+        """Transforms a signal arriving in chunks, yielding coefficient blocks as soon as they are complete.
+
+        Streaming always uses the FFT kernels (see StreamingCWT), pywt has no incremental transform. The
+        DWT-CWT transform needs the whole signal and cannot be streamed.
+        """
+        #pylint: disable=maybe-no-member
+        if self._transform != constants.TRANSFORMS_CWT:
+            raise ValueError("Only the {} transform can be streamed".format(constants.TRANSFORMS_CWT))
+
+        stream = StreamingCWT(self.cwt_scales(), self._continuous_wavelet, self._absolute,
+                              np.dtype(self._dtype), getattr(self, "_block_size", None) or 16384)
+        for chunk in chunks:
+            coefficients = stream.push(chunk)
+            if coefficients is not None:
+                yield coefficients
+
+        coefficients = stream.finish()
+        if coefficients is not None:
+            yield coefficients
 
 
 def parse_arguments() -> argparse.PARSER:
@@ -30,4 +30,33 @@ def cut_np_1D_ndarray(array: np.ndarray,
                    end_offset: int
                    ) -> np.ndarray:
     #TODO: add documentation
-    return array[max(0, start_offset) : min(end_offset, len(array))]
\ No newline at end of file
+    return array[max(0, start_offset) : min(end_offset, len(array))]
+
+def segment_means(array: np.ndarray,
+                  starts: np.ndarray,
+                  lengths: np.ndarray
+                  ) -> np.ndarray:
+    """Computes the mean of every segment array[start:start + length] at once.
+
+    The segment sums are taken as differences of a cumulative sum, so the cost
+    does not depend on the number of segments in Python operations. Segments are
+    clipped to the array bounds like regular slicing, empty segments yield nan.
+
+    Args:
+        array (np.ndarray): 1D array over which the means are computed
+        starts (np.ndarray): start index of every segment
+        lengths (np.ndarray): length of every segment
+
+    Returns:
+        np.ndarray: float64 array with one mean per segment
+    """
+    cumulative = np.empty(len(array) + 1, dtype=np.float64)
+    cumulative[0] = 0
+    np.cumsum(array, dtype=np.float64, out=cumulative[1:])
+
+    starts = np.clip(np.asarray(starts, dtype=np.int64), 0, len(array))
+    ends = np.clip(starts + np.asarray(lengths, dtype=np.int64), starts, len(array))
+    counts = ends - starts
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (cumulative[ends] - cumulative[starts]) / counts
@@ -0,0 +1,121 @@
+"""On-disk cache of preprocessed signals and CWT scalograms.
+
+Every entry is a single .npy file named after a hash of its key, the stage name,
+the identity of the input and the stage parameters. Input files are identified
+by path, size and modification time (or by a hash of their content), in-memory
+signals by a hash of their content. Hits are opened with np.load(mmap_mode='r'),
+so they are read-only and only the pages which are used are read. The least
+recently used entries are evicted once the cache grows over its size limit.
+"""
+from typing import Callable, Optional
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+_READ_SIZE = 1 << 20
+
+
+class StageCache():
+    """Cache of stage outputs in a directory.
+
+    Args:
+        directory (str): directory of the cache entries, created if needed.
+        max_bytes (int, optional): size limit of all entries, unlimited if None.
+        hash_files (bool, optional): identify input files by a hash of their content instead of their path, size
+            and modification time. Defaults to False.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = None, hash_files: bool = False) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._hash_files = hash_files
+
+    def file_identity(self, filename: str) -> str:
+        if not self._hash_files:
+            status = os.stat(filename)
+            return "{}:{}:{}".format(os.path.abspath(filename), status.st_size, status.st_mtime_ns)
+
+        digest = hashlib.sha1()
+        with open(filename, "rb") as handle:
+            for block in iter(lambda: handle.read(_READ_SIZE), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def array_identity(array: np.ndarray) -> str:
+        array = np.ascontiguousarray(array)
+        digest = hashlib.sha1("{}:{}".format(array.dtype.str, array.shape).encode())
+        digest.update(array.data)
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(stage: str, identity: str, parameters: dict) -> str:
+        return hashlib.sha1(json.dumps([stage, identity, parameters], sort_keys=True, default=str).encode()
+                            ).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._directory, key + ".npy")
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Opens the entry memory mapped, None if it is not cached."""
+        path = self._path(key)
+        try:
+            array = np.load(path, mmap_mode='r')
+            os.utime(path)      # recently used
+        except (FileNotFoundError, ValueError):
+            return None
+        return array
+
+    def put(self, key: str, array: np.ndarray) -> None:
+        """Stores the array, replacing an entry of the same key."""
+        handle, temporary = tempfile.mkstemp(suffix=".npy.tmp", dir=self._directory)
+        try:
+            with os.fdopen(handle, "wb") as file:
+                np.save(file, np.asarray(array))
+            # concurrent workers never see a partially written entry
+            os.replace(temporary, self._path(key))
+        except BaseException:
+            # evict only counts complete entries, a failed write would stay forever
+            os.remove(temporary)
+            raise
+
+        self.evict()
+
+    def get_or_compute(self, key: str, compute: Callable[[], Optional[np.ndarray]]) -> Optional[np.ndarray]:
+        """Returns the memory mapped entry on a hit, on a miss the computed array itself after storing it."""
+        array = self.get(key)
+        if array is not None:
+            return array
+
+        array = compute()
+        if array is not None:
+            self.put(key, array)
+        return array
+
+    def evict(self) -> None:
+        """Removes the least recently used entries until the cache fits into its size limit."""
+        if self._max_bytes is None:
+            return
+
+        entries = []
+        for name in os.listdir(self._directory):
+            if name.endswith(".npy"):
+                try:
+                    status = os.stat(os.path.join(self._directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((status.st_mtime_ns, status.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self._directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
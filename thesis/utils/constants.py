@@ -24,10 +24,25 @@ TRANSFORMS_CWT = "cwt"
 
 TRANSFORMS_DWT_CWT = "dwt-cwt"
 
+CWT_BACKEND_PYWT = "pywt"
+
+CWT_BACKEND_FFT = "fft"
+
+SCALE_SET_LINEAR = "linear"
+
+SCALE_SET_LOG = "log"
+
+"""Number of CWT scales chosen to match the x_size of the fingerprints."""
+NUM_SCALES_AUTO = "auto"
+
 FINGERPRINTING_CONSTELLATION = "constellation"
 
 FINGERPRINTING_MINHASH = "minhash"
 
+MINHASH_ENGINE_DATASKETCH = "datasketch"
+
+MINHASH_ENGINE_NATIVE = "native"
+
 """Format string for saving the wavelet fingerprinting pipeline output. The format should be:
 "pipeline_<file>_<preprocess_descriptor>_<transform_descriptor>_<fingerprinting_descriptor>"
 """
@@ -36,3 +51,7 @@ PIPELINE_RESULT = "pipeline_{}_{}_{}_{}.p"
 SIMILARITY_CONSTELLATION = "constellation"
 
 SIMILARITY_LSH = "lsh"
+
+COHERENCY_MODE_LOOP = "loop"
+
+COHERENCY_MODE_VECTORIZED = "vectorized"
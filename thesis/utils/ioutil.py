@@ -1,6 +1,10 @@
+import json
 import os
+import pickle as pp
+import tempfile
 
 from thesis.similarity.computer import SimilarityResult
+from thesis.similarity import fingerprint_index, lsh_index
 
 
 def save_similarity_result(filename: str, result: SimilarityResult) -> None:
@@ -8,5 +12,33 @@ def save_similarity_result(filename: str, result: SimilarityResult) -> None:
         h.write(str(result))
 
 
+def save_pickle(filename: str, obj) -> None:
+    """Pickles obj into a temporary file next to filename and renames it, so readers never see a partial file."""
+    handle, temporary = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        with os.fdopen(handle, "wb") as h:
+            pp.dump(obj, h)
+        os.replace(temporary, filename)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
 def extract_file_name(filename: str) -> str:
     return os.path.splitext(os.path.basename(filename))[0]
+
+
+def load_reference(path: str):
+    """Loads a reference database: index directories are opened memory mapped, anything else is unpickled."""
+    if os.path.isdir(path):
+        with open(os.path.join(path, fingerprint_index.META_FILE)) as h:
+            index_type = json.load(h).get("type")
+
+        if index_type == fingerprint_index.INDEX_TYPE:
+            return fingerprint_index.FingerprintIndex.open(path)
+        if index_type == lsh_index.INDEX_TYPE:
+            return lsh_index.BandedLSHIndex.open(path)
+        raise ValueError("Unknown reference index type {} in {}".format(index_type, path))
+
+    with open(path, 'rb') as h:
+        return pp.load(h)
@@ -1,17 +1,75 @@
 import io
 import os
-from queue import Queue
+from collections import defaultdict
+from fnmatch import fnmatchcase
 
 import numpy as np
 import h5py
 from Bio import SeqIO       # pylint: disable=import-error
 
 import thesis.proto.signal_pb2 as signal_pb2
+from thesis.utils import array_util
+
+
+def raw_to_picoampere(discrete_signal: np.ndarray,
+                      offset: float,
+                      raw_unit: float,
+                      dtype: np.dtype = np.float64,
+                      out: np.ndarray = None
+                      ) -> np.ndarray:
+    """Converts discrete DAC values to picoamperes as (x + offset) * raw_unit.
+
+    Parameters
+    ----------
+    discrete_signal : np.ndarray
+        Discrete signal values read from the fast5 file
+    offset : float
+        Channel offset
+    raw_unit : float
+        Channel range divided by the digitisation
+    dtype : np.dtype
+        Floating point type of the result, ignored if out is given
+    out : np.ndarray, optional
+        Preallocated buffer of the same shape as discrete_signal
+
+    Returns
+    -------
+    signal : np.ndarray
+        Signal in picoamperes
+
+    Raises
+    ------
+    ValueError
+        Raised if the shape of out does not match the discrete signal
+    """
+    if out is None:
+        out = np.empty(discrete_signal.shape, dtype=dtype)
+    elif out.shape != discrete_signal.shape:
+        raise ValueError("Output buffer of shape {} does not match signal of shape {}".format(
+            out.shape, discrete_signal.shape))
+
+    np.add(discrete_signal, offset, out=out, dtype=out.dtype)
+    np.multiply(out, raw_unit, out=out)
+
+    return out
 
 
 class SignalExtractor():
     # TODO: add documentation
 
+    """Known fast5 locations of the keys used by the extractor, in order of preference. Path segments can contain
+    shell-style wildcards which are matched against the members of the parent group, the last match in sorted order
+    (the most recent analysis) is taken.
+    """
+    _KEY_TEMPLATES = {
+        'Signal': ['Raw/Reads/*/Signal', 'Raw/Signal', 'read_*/Raw/Signal'],
+        'channel_id': ['UniqueGlobalKey/channel_id', 'channel_id', 'read_*/channel_id'],
+        'BaseCalled_template': ['Analyses/RawGenomeCorrected_*/BaseCalled_template',
+                                'Analyses/Basecall_1D_*/BaseCalled_template'],
+        'Fastq': ['Analyses/Basecall_1D_*/BaseCalled_template/Fastq'],
+        'Fasta': ['Analyses/Basecall_1D_*/BaseCalled_template/Fasta'],
+    }
+
     def __init__(self, path_to_file):
         if not os.path.isfile(path_to_file):
             raise FileNotFoundError("The file {} could not be found".format(path_to_file))
@@ -19,9 +77,22 @@ class SignalExtractor():
         self._path_to_file = path_to_file
         print(path_to_file)
         self._file_handle = h5py.File(path_to_file, 'r')
-        self._key_dict_hierarchical = dict()
-        self._key_dict_flat = dict()
-        self._generate_key_dict()
+        self._init_read(self._file_handle)
+
+    @classmethod
+    def _from_group(cls, path_to_file, file_handle, group):
+        """Creates an extractor for a single read group which shares the file handle
+        of an already opened (multi-read) fast5 file.
+        """
+        extractor = cls.__new__(cls)
+        extractor._path_to_file = path_to_file
+        extractor._file_handle = file_handle
+        extractor._init_read(group)
+        return extractor
+
+    def _init_read(self, root):
+        self._root = root
+        self._key_cache = dict()
         self._sequence = None
         self._events = None
         self._nanopolish_events = None
@@ -70,38 +141,135 @@ class SignalExtractor():
         if self._discrete_signal is not None:
             return self._discrete_signal
 
-        signal = self._key_dict_flat['Signal']
+        signal = self._get_key('Signal')
 
         self._discrete_signal = np.array(signal)
 
         return self._discrete_signal
 
-    def get_signal_continuous(self):
+    def get_signal_continuous(self, dtype: np.dtype = np.float64, out: np.ndarray = None) -> np.ndarray:
         """Returns all continuous/raw signal values associated with the current
         file.
 
+        The conversion from the discrete DAC values to picoamperes is done in a
+        single vectorized pass. The result for the default call is cached.
+
         Parameters
         ----------
+        dtype : np.dtype
+            Floating point type of the returned signal (np.float32 or np.float64)
+        out : np.ndarray, optional
+            Preallocated buffer with the same shape as the discrete signal into
+            which the result is written. A call with a buffer is not cached.
 
         Returns
         -------
         signal : np.array
             Continuous/ras signal values from file
         """
-        if self._continous_signal is not None:
+        if out is None and self._continous_signal is not None and self._continous_signal.dtype == dtype:
             return self._continous_signal
 
         discrete_signal = self.get_signal_discrete()
+        signal = raw_to_picoampere(discrete_signal, self._offset, self._raw_unit, dtype, out)
+
+        if out is None:
+            self._continous_signal = signal
+
+        return signal
 
-        info = self.get_channel_info()
-        rng = info.range
-        digitisation = info.digitisation
-        raw_unit = rng / digitisation
-        offset = info.offset
+    def iterate_signal_chunks(self, chunk_size: int, dtype: np.dtype = np.float64):
+        """Yields the continuous signal in consecutive chunks, reading only one
+        chunk of the discrete signal from the file at a time.
 
-        self._continous_signal = np.array(list(map(lambda x: (x + offset) * raw_unit, discrete_signal)))
+        Parameters
+        ----------
+        chunk_size : int
+            Number of signal values per chunk
+        dtype : np.dtype
+            Floating point type of the returned chunks
+
+        Yields
+        ------
+        chunk : np.array
+            Continuous signal values of the next chunk
+        """
+        signal = self._get_key('Signal')
+        for start in range(0, len(signal), chunk_size):
+            yield raw_to_picoampere(signal[start:start + chunk_size], self._offset, self._raw_unit, dtype)
 
-        return self._continous_signal
+    def is_multi_read(self) -> bool:
+        """Checks if the file stores multiple reads in top level read_* groups.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        multi_read : bool
+            True for multi-read fast5 files
+        """
+        return self._root == self._file_handle and any(key.startswith('read_') for key in self._file_handle.keys())
+
+    def iterate_reads(self, read_ids=None):
+        """Iterates over the reads of the file using the already opened file handle.
+        Single-read files yield exactly one read.
+
+        Parameters
+        ----------
+        read_ids : iterable of string, optional
+            Only reads with these IDs are yielded
+
+        Returns
+        -------
+        reads : generator of (string, SignalExtractor)
+            Read ID and an extractor bound to the read group
+        """
+        if read_ids is not None:
+            read_ids = set(read_ids)
+
+        if not self.is_multi_read():
+            read_id = self._read_id(self._get_key('Signal').parent)
+            if read_ids is None or read_id in read_ids:
+                yield read_id, self
+            return
+
+        for key in self._file_handle.keys():
+            if not key.startswith('read_'):
+                continue
+
+            group = self._file_handle[key]
+            read_id = self._read_id(group['Raw']) if 'Raw' in group else key[len('read_'):]
+            if read_ids is not None and read_id not in read_ids:
+                continue
+
+            yield read_id, SignalExtractor._from_group(self._path_to_file, self._file_handle, group)
+
+    def signals(self, read_ids=None, dtype: np.dtype = np.float64):
+        """Streams the continuous signal of every read in the file.
+
+        Parameters
+        ----------
+        read_ids : iterable of string, optional
+            Only reads with these IDs are yielded
+        dtype : np.dtype
+            Floating point type of the signals
+
+        Returns
+        -------
+        signals : generator of (string, np.array, ChannelInfo)
+            Read ID, continuous signal and channel info of every read
+        """
+        for read_id, read in self.iterate_reads(read_ids):
+            yield read_id, read.get_signal_continuous(dtype), read.get_channel_info()
+
+    @staticmethod
+    def _read_id(group) -> str:
+        read_id = group.attrs.get('read_id', group.name.rsplit('/', 1)[-1])
+        if isinstance(read_id, bytes):
+            read_id = read_id.decode()
+
+        return read_id
 
     def get_nucleotide_positions(self, nucleotide):
         """Returns all indices of positions where the specified nucleotide has
@@ -127,83 +295,156 @@ class SignalExtractor():
         Returns
         -------
         """
-        attrs = self._key_dict_flat['channel_id'].attrs
+        attrs = self._get_key('channel_id').attrs
         self._digitisation = float(attrs['digitisation'])
         self._offset = float(attrs['offset'])
         self._range = float(attrs['range'])
         self._raw_unit = self._range / self._digitisation
         #self._raw_unit = self._digitisation / self._range
 
-    def _generate_key_dict(self):
-        """Generates key dictionary for accessing all groups in fast5 file for easier access in other methods.
-        Two dictionaries are generated:
-            _key_dict_flat : (key string) -> (HDF5 group object)
-            _key_dict_hierarchical : (HDF5 group object) -> ([key string])
+    def _get_key(self, key):
+        """Returns the HDF5 group or dataset stored under the given key.
+
+        The key is first looked up in the known fast5 layouts and only if none of
+        them match the file is searched for a member with the same name. Results,
+        including misses, are cached.
+
+        Parameters
+        ----------
+        key : string
+            Name of the group or dataset
+
+        Returns
+        -------
+        obj : h5py.Group or h5py.Dataset
+            Object stored under the key
+
+        Raises
+        ------
+        KeyError
+            Raised if the file does not contain the key
+        """
+        if key not in self._key_cache:
+            self._key_cache[key] = self._resolve_key(key)
+
+        obj = self._key_cache[key]
+        if obj is None:
+            raise KeyError(key)
+
+        return obj
+
+    def _resolve_key(self, key):
+        for template in self._KEY_TEMPLATES.get(key, []):
+            obj = SignalExtractor._find_path(self._root, template.split('/'))
+            if obj is not None:
+                return obj
+
+        path = self._root.visit(lambda name: name if name.rsplit('/', 1)[-1] == key else None)
+        if path is None:
+            return None
+
+        return self._root[path]
+
+    @staticmethod
+    def _find_path(group, segments):
+        """Follows the path segments from the group, expanding wildcard segments.
 
         Parameters
         ----------
+        group : h5py.Group
+            Group from which the path starts
+        segments : [string]
+            Path segments, possibly containing wildcards
 
         Returns
         -------
+        obj : h5py.Group or h5py.Dataset
+            Object at the end of the path or None if the path does not exist
         """
-        queue = Queue()
-        queue.put(self._file_handle)
+        if not segments:
+            return group
 
-        while not queue.empty():
-            tmp = queue.get()
-            tmp_keys = []
-            try:
-                for key in tmp.keys():
-                    tmp_keys.append(key)
-                    queue.put(tmp[key])
-                    self._key_dict_flat[key] = tmp[key]
+        if not isinstance(group, h5py.Group):
+            return None
 
-                self._key_dict_hierarchical[tmp] = tmp_keys
+        segment = segments[0]
+        if any(c in segment for c in '*?['):
+            candidates = sorted((k for k in group.keys() if fnmatchcase(k, segment)), reverse=True)
+        else:
+            candidates = [segment] if segment in group else []
 
-            except AttributeError:
-                continue
+        for candidate in candidates:
+            obj = SignalExtractor._find_path(group[candidate], segments[1:])
+            if obj is not None:
+                return obj
 
-        """UNCOMMENT TO VIEW DICT ELEMENTS
-        print("Hierarchical dict representation")
-        for key, value in self._key_dict_hierarchical.items():
-            print(key, value)
-        print(" ")
-        print("Flat dict representation: ")
+        return None
 
-        for key, value in self._key_dict_flat.items():
-            print(key, value)
+    def get_key_index(self):
+        """Generates an index of all groups and datasets in the fast5 file. The whole
+        file is walked, so this is meant for debugging only.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        index : dict
+            (key string) -> ([path string]) for every member of the file
         """
+        index = defaultdict(list)
+        self._root.visit(lambda name: index[name.rsplit('/', 1)[-1]].append(name))
 
-        return
+        return dict(index)
 
     def get_signal_of_means(self):
-        alignment = self._key_dict_flat['BaseCalled_template']
-        events = np.array(alignment.get('Events'))
-        signal = self.get_signal_continuous()                            # events is a vector of shape (x, )
+        """Returns the mean of the continuous signal over every basecalled event.
 
-        signal_list = []
-        for row in events:
-            start = row[2]
-            length = row[3]
-            samples = signal[start:(start+length)]
-            signal_list.append(np.mean(samples))
+        The events table is read as a whole and the means are computed from its
+        start and length columns with a single segment reduction.
 
-        signal_list = np.array(signal_list)
+        Parameters
+        ----------
 
-        return signal_list
+        Returns
+        -------
+        signal : np.array
+            Mean signal value of every event
+        """
+        events = self._get_events()
+        names = events.dtype.names
+        signal = self.get_signal_continuous()
+
+        return array_util.segment_means(signal, events[names[2]], events[names[3]])
 
     def get_signal_of_norm_means(self):
-        alignment = self._key_dict_flat['BaseCalled_template']
-        events = np.array(alignment.get('Events'))
-        signal = self.get_signal_continuous()                            # events is a vector of shape (x, )
+        """Returns the normalized event means stored in the events table.
+
+        Parameters
+        ----------
 
-        signal_list = []
-        for row in events:
-            signal_list.append(row[0])
+        Returns
+        -------
+        signal : np.array
+            Normalized mean signal value of every event
+        """
+        events = self._get_events()
+
+        return np.array(events[events.dtype.names[0]])
 
-        signal_list = np.array(signal_list)
+    def _get_events(self):
+        """Reads the whole events table of the template alignment.
 
-        return signal_list
+        Parameters
+        ----------
+
+        Returns
+        -------
+        events : np.array
+            Structured array with one row per event
+        """
+        alignment = self._get_key('BaseCalled_template')
+        return alignment['Events'][()]
 
     def _extract_file_format(self, file_format):
         """Extracts the specified file format from fast5 file. If no file with the specified format is found,
@@ -228,7 +469,7 @@ class SignalExtractor():
         result = None
 
         try:
-            dataset = self._key_dict_flat[file_format]
+            dataset = self._get_key(file_format)
             string = dataset[()]
             result = list(SeqIO.parse(io.StringIO(string), file_format.lower()))  # for simple conversion
             # we can remove list
@@ -239,7 +480,7 @@ class SignalExtractor():
         return result
 
     def get_channel_info(self):
-        channel_id_attrs = self._key_dict_flat['channel_id'].attrs
+        channel_id_attrs = self._get_key('channel_id').attrs
         return SignalExtractor._create_channelInfo(channel_id_attrs)
 
     @staticmethod